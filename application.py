@@ -15,8 +15,19 @@ cfg = Config(create=True)
 
 import database
 
-from shared import db
-from controllers import subscription, message, service, gcm, mqtt
+from shared import db, zmq_relay_socket
+from controllers import subscription, message, service, gcm, mqtt, stats, health
+from dispatch import dispatcher, coalescer
+from relay import RelayPump
+from routing import configure_replicas, configure_shards
+from tracing import tracer
+from scheduler import scheduler
+from health import monitor
+from gateway import gateway
+from purge import purger
+from housekeeping import housekeeper
+from retry import retry_worker
+from wire import payload_format
 from utils import Error
 
 gcm_enabled = True
@@ -39,6 +50,8 @@ app = Flask(__name__)
 app.debug = cfg.debug
 app.config['SQLALCHEMY_DATABASE_URI'] = cfg.database_uri
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+configure_replicas(app, cfg.database_replica_uris, cfg.database_replica_sticky_seconds)
+configure_shards(app, cfg.database_shard_uris)
 db.init_app(app)
 db.app = app
 
@@ -51,6 +64,24 @@ except Exception as err:
     else:
         sys.exit(1)
 
+dispatcher.init_app(app, cfg.dispatch_workers)
+coalescer.init_app(app)
+tracer.init_app(app, cfg.trace_sample_rate, cfg.trace_file, cfg.trace_format)
+scheduler.init_app(app, cfg.schedule_window, cfg.schedule_rate)
+purger.init_app(app, cfg.purge_batch_size, cfg.purge_interval)
+housekeeper.init_app(app, cfg.housekeeping_interval, cfg.purge_batch_size)
+retry_worker.init_app(app, cfg.retry_interval, cfg.retry_backoff, cfg.retry_max_attempts)
+
+relay_pump = None
+if cfg.zeromq_relay_uri:
+    relay_pump = RelayPump(app, zmq_relay_socket, format_=payload_format(cfg.zeromq_payload_format))
+    relay_pump.start()
+
+if cfg.websocket_port:
+    gateway.start(cfg.websocket_host, cfg.websocket_port, cfg.websocket_ping_interval)
+
+monitor.init_app(app, cfg.health_cache_seconds, relay_pump)
+
 
 @app.route('/')
 def index():
@@ -65,8 +96,7 @@ def robots_txt():
 
 @app.route('/version')
 def version():
-    with open('.git/refs/heads/master', 'r') as f:
-        return f.read(7)
+    return monitor.version
 
 
 @app.errorhandler(429)
@@ -77,6 +107,8 @@ def limit_rate(e):
 app.register_blueprint(subscription)
 app.register_blueprint(message)
 app.register_blueprint(service)
+app.register_blueprint(stats)
+app.register_blueprint(health)
 if gcm_enabled:
     app.register_blueprint(gcm)
 if mqtt_enabled:
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+""" measures how many device notifications per second the dispatch path sustains
+
+usage: python benchmarks/dispatch.py --subscribers 10,1000,10000,100000 --messages 3
+
+Runs against a throwaway SQLite database, a local fake GCM endpoint and an
+in-process MQTT broker stand-in, so nothing leaves the machine. For every
+size a service is seeded with that many subscribers, each registered for
+both GCM and MQTT, and every message is pushed through each channel's
+prepare, deliver and report steps on its own, deliver being the network
+time and the rest DB time. The "all" row sends the same messages once more
+through dispatch.deliver_message, which runs the channels concurrently.
+"""
+import argparse
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+
+class _FakeGcm(BaseHTTPRequestHandler):
+    """ accepts every registration id of a multicast request """
+    latency = 0.0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.latency:
+            time.sleep(self.latency)
+        results = [dict(message_id=str(i)) for i in range(len(body['registration_ids']))]
+        payload = json.dumps(dict(success=len(results), failure=0, results=results)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class _FakeBroker(socketserver.BaseRequestHandler):
+    """ speaks just enough MQTT 3.1.1 for QoS 0 publishers, and counts the publishes """
+    published = 0
+    lock = threading.Lock()
+
+    def _read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        while True:
+            header = self._read(1)
+            if header is None:
+                return
+            length, shift = 0, 0
+            while True:
+                byte = self._read(1)
+                if byte is None:
+                    return
+                length |= (byte[0] & 0x7f) << shift
+                shift += 7
+                if not byte[0] & 0x80:
+                    break
+            if length and self._read(length) is None:
+                return
+            kind = header[0] >> 4
+            if kind == 1:  # CONNECT
+                self.request.sendall(b'\x20\x02\x00\x00')
+            elif kind == 3:  # PUBLISH
+                with self.lock:
+                    _FakeBroker.published += 1
+            elif kind == 12:  # PINGREQ
+                self.request.sendall(b'\xd0\x00')
+            elif kind == 14:  # DISCONNECT
+                return
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _seed(db, Service, Subscription, Gcm, MQTT, subscribers):
+    service = Service('benchmark {}'.format(subscribers))
+    db.session.add(service)
+    db.session.commit()
+    devices = [str(uuid4()) for _ in range(subscribers)]
+    for start in range(0, subscribers, 10000):
+        chunk = devices[start:start + 10000]
+        db.session.execute(Subscription.__table__.insert(),
+                           [dict(device=d, service_id=service.id, last_read=0, unread=0) for d in chunk])
+        db.session.execute(Gcm.__table__.insert(), [dict(uuid=d, gcmid='gcm-' + d) for d in chunk])
+        db.session.execute(MQTT.__table__.insert(), [dict(uuid=d) for d in chunk])
+    db.session.commit()
+    return service
+
+
+def _measure(db, Subscription, channel, message):
+    """ runs one channel's steps for message, returns (notified, total, db, network) seconds """
+    start = time.perf_counter()
+    devices = Subscription.devices_of(message.service)
+    batch = channel.prepare(message, devices)
+    prepared = time.perf_counter()
+    result = channel.deliver(batch, dict(message=message.as_dict(), encrypted=False)) if batch else None
+    sent = time.perf_counter()
+    reached = channel.report(message, batch, result) if batch else []
+    Subscription.mark_read(message.service, reached, message.id)
+    db.session.commit()
+    end = time.perf_counter()
+    return len(reached), end - start, (prepared - start) + (end - sent), sent - prepared
+
+
+def _measure_all(message, deliver_message):
+    """ the whole concurrent delivery through dispatch.deliver_message """
+    start = time.perf_counter()
+    deliver_message(message)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", default="10,1000,10000,100000",
+                        help="comma separated subscriber counts, one service each")
+    parser.add_argument("--messages", type=int, default=3, help="messages sent per service")
+    parser.add_argument("--gcm-latency", type=float, default=0.0,
+                        help="seconds the fake GCM endpoint waits before answering")
+    args = parser.parse_args()
+    sizes = [int(n) for n in args.subscribers.split(",")]
+
+    _FakeGcm.latency = args.gcm_latency
+    gcm_server = _serve(ThreadingHTTPServer(('127.0.0.1', 0), _FakeGcm))
+    broker = _serve(_ThreadingTCPServer(('127.0.0.1', 0), _FakeBroker))
+
+    workdir = tempfile.mkdtemp(prefix="pushfish-bench-")
+    os.environ["PUSHFISH_CONFIG"] = os.path.join(workdir, "pushfish-api.cfg")
+    os.environ["PUSHFISH_DB"] = "sqlite:///" + os.path.join(workdir, "pushfish-api.db")
+    os.environ["PUSHFISH_GOOGLE_API_KEY"] = "benchmark"
+    os.environ["MQTT_ADDRESS"] = "127.0.0.1:{}".format(broker.server_address[1])
+
+    from application import app
+    from database import init_db
+    from shared import db
+    from models import Service, Message, Subscription, Gcm, MQTT
+    from models import gcm as gcm_module
+    from channels import registry
+    from dispatch import deliver_message
+
+    gcm_module.gcm_url = 'http://127.0.0.1:{}/gcm/send'.format(gcm_server.server_address[1])
+    channels = [registry.get('gcm'), registry.get('mqtt')]
+
+    print("{:>11} {:<5} {:>10} {:>9} {:>9} {:>9} {:>12}".format(
+        "subscribers", "chan", "notified", "total s", "db s", "net s", "notif/s"))
+    with app.app_context():
+        init_db()
+        for size in sizes:
+            service = _seed(db, Service, Subscription, Gcm, MQTT, size)
+            results = {channel.name: [0, 0.0, 0.0, 0.0] for channel in channels}
+            combined = 0.0
+            for i in range(args.messages):
+                message = Message(service, "benchmark message {} ".format(i) + "x" * 200, "bench", 3)
+                db.session.add(message)
+                db.session.commit()
+                for channel in channels:
+                    results[channel.name] = [a + b for a, b in
+                                             zip(results[channel.name], _measure(db, Subscription, channel, message))]
+                combined += _measure_all(message, deliver_message)
+            for name, (notified, total, db_time, net_time) in results.items():
+                print("{:>11} {:<5} {:>10} {:>9.3f} {:>9.3f} {:>9.3f} {:>12.0f}".format(
+                    size, name, notified, total, db_time, net_time, notified / total if total else 0))
+            notified = sum(r[0] for r in results.values())
+            print("{:>11} {:<5} {:>10} {:>9.3f} {:>9} {:>9} {:>12.0f}".format(
+                size, "all", notified, combined, "", "", notified / combined if combined else 0))
+
+    print("mqtt publishes received by the broker stand-in: {}".format(_FakeBroker.published))
+    gcm_server.shutdown()
+    broker.shutdown()
+
+
+if __name__ == "__main__":
+    main()
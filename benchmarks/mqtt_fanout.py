@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+""" compares per-device and per-service MQTT fan-out against a local broker
+
+usage: python benchmarks/mqtt_fanout.py --broker localhost:1883 --devices 50000 --subscribers 200
+
+device mode publishes one copy per device uuid through MQTT.mqtt_send, and a
+single wildcard client counts what arrives. service mode publishes once to a
+service topic that --subscribers clients listen on, so the broker does the
+fan-out. Both report the publish time on the API side and the time until the
+last copy was delivered.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from uuid import uuid4
+
+import paho.mqtt.client as mqtt_api
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+
+def _split_address(address):
+    if ":" in address:
+        host, port = address.split(":")
+        return host, int(port)
+    return address, 1883
+
+
+class _Counter:
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.last = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def on_message(self, client, userdata, message):
+        with self._lock:
+            self.received += 1
+            self.last = time.perf_counter()
+            if self.received >= self.expected:
+                self.done.set()
+
+
+def _listen(address, topic, counter):
+    host, port = _split_address(address)
+    client = mqtt_api.Client()
+    client.on_message = counter.on_message
+    client.connect(host, port, 60)
+    client.subscribe(topic)
+    client.loop_start()
+    return client
+
+
+def _run(address, topics, listeners, expected, timeout):
+    from models import MQTT
+    data = dict(message=dict(message="benchmark " + "x" * 200, title="bench", level=3), encrypted=False)
+    counter = _Counter(expected)
+    clients = [_listen(address, topic, counter) for topic in listeners]
+    # let the subscriptions settle before publishing
+    time.sleep(1)
+
+    start = time.perf_counter()
+    MQTT.mqtt_send(topics, data)
+    published = time.perf_counter()
+    counter.done.wait(timeout)
+
+    for client in clients:
+        client.loop_stop()
+        client.disconnect()
+
+    delivered = (counter.last or published) - start
+    return len(topics), published - start, counter.received, delivered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--broker", default="localhost:1883")
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--subscribers", type=int, default=100,
+                        help="clients listening on the service topic in service mode")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    os.environ["MQTT_ADDRESS"] = args.broker
+    from config import Config
+    Config(create=True)
+
+    devices = [str(uuid4()) for _ in range(args.devices)]
+    # '+' matches every single level topic, i.e. every device uuid
+    device = _run(args.broker, devices, ["+"], args.devices, args.timeout)
+
+    service_topic = "service/bench-{}".format(uuid4().hex[:12])
+    service = _run(args.broker, [service_topic], [service_topic] * args.subscribers,
+                   args.subscribers, args.timeout)
+
+    print("{:<8} {:>10} {:>12} {:>10} {:>12}".format("mode", "publishes", "publish s", "received", "delivered s"))
+    for name, (publishes, publish_time, received, delivered) in (("device", device), ("service", service)):
+        print("{:<8} {:>10} {:>12.3f} {:>10} {:>12.3f}".format(name, publishes, publish_time, received, delivered))
+
+
+if __name__ == "__main__":
+    main()
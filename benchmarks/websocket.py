@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+""" measures how many idle WebSocket connections the gateway holds, at what memory cost
+
+usage: python benchmarks/websocket.py --connections 1000,10000,20000
+
+Starts the gateway on a free local port and opens the connections from a
+child process, so the resident memory growth of this process is the
+gateway's alone. For every count the connections are opened, the growth
+per connection is reported, one message is pushed to every device and the
+time until the last one got it is measured, then the connections are
+closed again. Every connection takes a file descriptor on both sides, the
+soft limit is raised to the hard one.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+CONNECT_BATCH = 500  # connections opened at once by the client process
+
+
+def _raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def _rss():
+    """ resident memory of this process in bytes """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def _clients(port, devices):
+    """ connects every device, reports ready, and reports when all got a push """
+    from websockets.asyncio.client import connect
+    url = 'ws://127.0.0.1:{}/?uuid={}'
+    sockets = []
+    for start in range(0, len(devices), CONNECT_BATCH):
+        sockets += await asyncio.gather(*[connect(url.format(port, d), compression=None, ping_interval=None,
+                                                  open_timeout=60)
+                                          for d in devices[start:start + CONNECT_BATCH]])
+    print('ready', flush=True)
+    await asyncio.gather(*[s.recv() for s in sockets])
+    print('received {}'.format(time.time()), flush=True)
+    await asyncio.gather(*[s.close() for s in sockets])
+
+
+def client_main(port):
+    """ connects the devices read from stdin, one per line """
+    _raise_fd_limit()
+    asyncio.run(_clients(port, sys.stdin.read().split()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", default="1000,10000",
+                        help="comma separated connection counts")
+    parser.add_argument("--client-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.client_port:
+        client_main(args.client_port)
+        return
+
+    limit = _raise_fd_limit()
+    counts = [int(n) for n in args.connections.split(",")]
+    if max(counts) + 100 > limit:
+        print("the file descriptor limit of {} allows fewer connections".format(limit), file=sys.stderr)
+        sys.exit(1)
+
+    workdir = tempfile.mkdtemp(prefix="pushfish-bench-")
+    os.environ["PUSHFISH_CONFIG"] = os.path.join(workdir, "pushfish-api.cfg")
+    os.environ["PUSHFISH_DB"] = "sqlite:///" + os.path.join(workdir, "pushfish-api.db")
+    from config import Config
+    Config(create=True)
+    from gateway import gateway
+
+    if not gateway.start('127.0.0.1', 0, ping_interval=60):
+        sys.exit(1)
+
+    print("{:>11} {:>10} {:>12} {:>10} {:>12}".format(
+        "connections", "open s", "KiB / conn", "push ms", "pushes/s"))
+    for count in counts:
+        devices = [str(uuid4()) for _ in range(count)]
+        before = _rss()
+        start = time.perf_counter()
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--client-port", str(gateway.port)],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        child.stdin.write('\n'.join(devices))
+        child.stdin.close()
+        assert child.stdout.readline().strip() == 'ready'
+        while gateway.stats()['connections'] < count:
+            time.sleep(0.01)
+        opened = time.perf_counter() - start
+        per_connection = (_rss() - before) / count / 1024
+
+        sent_at = time.time()
+        sent = gateway.send(devices, dict(message={'message': 'benchmark'}, encrypted=False))
+        received_at = float(child.stdout.readline().split()[1])
+        child.wait()
+        pushed = received_at - sent_at
+        print("{:>11} {:>10.2f} {:>12.1f} {:>10.1f} {:>12.0f}".format(
+            count, opened, per_connection, pushed * 1000, len(sent) / pushed if pushed else 0))
+        while gateway.stats()['connections']:
+            time.sleep(0.01)
+
+    gateway.stop()
+
+
+if __name__ == "__main__":
+    main()
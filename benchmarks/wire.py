@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+""" compares the JSON and MessagePack wire formats on typical message payloads
+
+usage: python benchmarks/wire.py --rounds 20000
+
+Builds the push payload (wire.message_payload) of messages with short,
+typical and long texts, with and without a title and link, plus an inbox
+of 50 of them, and reports the encoded size, its gzip size and the encode
+and decode time per payload in each format.
+"""
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+TEXTS = {
+    'short': 'Build #1284 passed',
+    'typical': 'Disk usage on db-2 is at 91%, the nightly backup may fail. ' * 3,
+    'long': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 40,
+}
+
+
+def _payloads(Service, Message, message_payload):
+    service = Service('benchmark')
+    service.timestamp_created = datetime.utcnow()
+    payloads = {}
+    for name, text in TEXTS.items():
+        message = Message(service, text, 'Build server', 4, 'https://ci.example.com/builds/1284')
+        message.timestamp_created = datetime.utcnow()
+        payloads[name] = message_payload(message)
+    bare = Message(service, TEXTS['short'])
+    bare.timestamp_created = datetime.utcnow()
+    payloads['bare'] = message_payload(bare)
+    payloads['inbox'] = {'messages': [payloads['typical']['message']] * 50}
+    return payloads
+
+
+def _time(fn, arg, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(arg)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=20000, help="encodes and decodes timed per payload")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="pushfish-bench-")
+    os.environ["PUSHFISH_CONFIG"] = os.path.join(workdir, "pushfish-api.cfg")
+    os.environ["PUSHFISH_DB"] = "sqlite:///" + os.path.join(workdir, "pushfish-api.db")
+    from config import Config
+    Config(create=True)
+    from models import Service, Message
+    from wire import FORMAT_JSON, FORMAT_MSGPACK, encode, decode, message_payload, msgpack
+
+    if msgpack is None:
+        print("msgpack is not installed", file=sys.stderr)
+        sys.exit(1)
+
+    print("{:<8} {:<8} {:>7} {:>7} {:>10} {:>10}".format("payload", "format", "bytes", "gzip", "encode us",
+                                                         "decode us"))
+    for name, payload in _payloads(Service, Message, message_payload).items():
+        rounds = max(1, args.rounds // 50) if name == 'inbox' else args.rounds
+        for format_ in (FORMAT_JSON, FORMAT_MSGPACK):
+            encoded = encode(payload, format_)
+            data = encoded.encode('utf-8') if isinstance(encoded, str) else encoded
+            assert decode(encoded, format_) == payload
+            print("{:<8} {:<8} {:>7} {:>7} {:>10.2f} {:>10.2f}".format(
+                name, format_, len(data), len(gzip.compress(data)),
+                _time(lambda p: encode(p, format_), payload, rounds),
+                _time(lambda e: decode(e, format_), encoded, rounds)))
+
+
+if __name__ == "__main__":
+    main()
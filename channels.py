@@ -0,0 +1,273 @@
+""" push delivery channels and the registry deliver_message looks them up in """
+import logging
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from json import dumps as json_encode
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+
+from flask import current_app
+
+from shared import db
+from models import Gcm, MQTT
+from models.mqtt import MQTT_MODE_SERVICE
+from models.subscription import IN_BATCH_SIZE
+from utils import queue_zmq_message
+from gateway import gateway
+from config import Config
+
+cfg = Config.get_global_instance()
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+CHANNEL_THREADS = 16  # network sends running at once, over all messages being delivered
+
+# devices[i] is reached at addresses[i]
+Batch = namedtuple('Batch', ['devices', 'addresses'])
+# what became of a batch: the deliver result, None if it failed or timed out, and why
+Outcome = namedtuple('Outcome', ['channel', 'batch', 'result', 'seconds', 'timed_out', 'error'])
+
+
+class Channel:
+    """
+    a push delivery backend. deliver_message runs every enabled channel for
+    a message in three steps: prepare looks up the addresses of the
+    subscribed devices, deliver sends the batch over the network in a
+    thread of its own and must not touch the session, and report writes
+    the outcome back and returns the devices that got the message. Channels
+    run concurrently, deliver gets timeout seconds before its outcome is
+    given up on, and at most concurrency of its delivers hold a thread at
+    once, so a hung provider can't starve the other channels. failed names
+    the devices worth trying again later, see retry.RetryWorker.
+
+    stage runs in the transaction storing a new message, for channels that
+    announce it atomically with the insert instead of delivering it; those
+    prepare no batch, and deliver reaches no one unless overridden.
+    register and unregister manage a device's address on the channel.
+    """
+    name = None
+    timeout = 30
+    concurrency = 4
+
+    def enabled(self):
+        return True
+
+    def register(self, device, address=None):
+        pass
+
+    def unregister(self, device):
+        pass
+
+    def stage(self, message):
+        pass
+
+    def prepare(self, message, devices):
+        return None
+
+    def deliver(self, batch, data):
+        return False
+
+    def report(self, message, batch, result):
+        return []
+
+    def failed(self, batch, result):
+        return batch.devices if result is None else []
+
+
+class GcmChannel(Channel):
+    name = 'gcm'
+    timeout = 30
+    # one quick retry inline, longer outages are waited out by retry.RetryWorker
+    retries = 1
+
+    def enabled(self):
+        return bool(cfg.google_api_key) or current_app.config['TESTING'] is True
+
+    def register(self, device, address=None):
+        Gcm.query.filter_by(uuid=device).delete(synchronize_session=False)
+        db.session.add(Gcm(device, address))
+
+    def unregister(self, device):
+        Gcm.query.filter_by(uuid=device).delete(synchronize_session=False)
+
+    def prepare(self, message, devices):
+        rows = []
+        for start in range(0, len(devices), IN_BATCH_SIZE):
+            rows += db.session.query(Gcm.uuid, Gcm.gcmid) \
+                .filter(Gcm.uuid.in_(devices[start:start + IN_BATCH_SIZE])).all()
+        if not rows:
+            return None
+        return Batch([r.uuid for r in rows], [r.gcmid for r in rows])
+
+    def deliver(self, batch, data):
+        return Gcm.gcm_send(batch.addresses, data, retries=self.retries)
+
+    def report(self, message, batch, result):
+        if result is None:
+            return []
+        delivered, dead, canonical = result
+        Gcm.prune(dead, canonical)
+        # only devices that actually got the push count as having read it
+        return [d for d, regid in zip(batch.devices, batch.addresses) if regid in delivered]
+
+    def failed(self, batch, result):
+        if result is None:
+            return batch.devices
+        delivered, dead, canonical = result
+        # GCM kept answering Unavailable for these
+        return [d for d, regid in zip(batch.devices, batch.addresses) if regid not in delivered and regid not in dead]
+
+
+class MqttChannel(Channel):
+    name = 'mqtt'
+    timeout = 10
+
+    def enabled(self):
+        return bool(cfg.mqtt_broker_address)
+
+    def register(self, device, address=None):
+        MQTT.query.filter_by(uuid=device).delete(synchronize_session=False)
+        db.session.add(MQTT(device))
+
+    def unregister(self, device):
+        MQTT.query.filter_by(uuid=device).delete(synchronize_session=False)
+
+    def prepare(self, message, devices):
+        uuids = []
+        for start in range(0, len(devices), IN_BATCH_SIZE):
+            uuids += [u for u, in db.session.query(MQTT.uuid)
+                      .filter(MQTT.uuid.in_(devices[start:start + IN_BATCH_SIZE]))]
+        if not uuids:
+            return None
+        if cfg.mqtt_delivery_mode == MQTT_MODE_SERVICE and not message.tags:
+            # publish once, the broker fans out to everyone on the topic. Tagged
+            # messages go to the uuid topics of the devices having the tags
+            return Batch(uuids, [MQTT.service_topic(message.service)])
+        return Batch(uuids, uuids)
+
+    def deliver(self, batch, data):
+        MQTT.mqtt_send(batch.addresses, data)
+        return True
+
+    def report(self, message, batch, result):
+        if batch.addresses != batch.devices:
+            # published to the service topic: the broker doesn't tell which devices were on it,
+            # so the message stays unread for GET /message
+            return []
+        return batch.devices if result else []
+
+
+class ZmqChannel(Channel):
+    """ announces messages to the pushfish connectors through the relay outbox, see relay.RelayPump """
+    name = 'zmq'
+
+    def enabled(self):
+        return bool(cfg.zeromq_relay_uri)
+
+    def stage(self, message):
+        # as_dict needs the timestamps the insert fills in
+        db.session.flush()
+        queue_zmq_message(json_encode({"message": message.as_dict()}))
+
+    def prepare(self, message, devices):
+        # announced by stage along with the insert, there is no batch to deliver
+        return None
+
+
+class WebSocketChannel(Channel):
+    """ pushes to the devices connected to this process's gateway, see gateway.Gateway """
+    name = 'websocket'
+    timeout = 10
+
+    def enabled(self):
+        return gateway.running()
+
+    def prepare(self, message, devices):
+        connected = gateway.connected(devices)
+        if not connected:
+            return None
+        return Batch(connected, connected)
+
+    def deliver(self, batch, data):
+        return gateway.send(batch.addresses, data)
+
+    def report(self, message, batch, result):
+        return result or []
+
+
+class ChannelRegistry:
+    def __init__(self):
+        self._channels = OrderedDict()
+
+    def register(self, channel):
+        self._channels[channel.name] = channel
+
+    def unregister(self, name):
+        self._channels.pop(name, None)
+
+    def get(self, name):
+        return self._channels.get(name)
+
+    def enabled(self):
+        return [c for c in self._channels.values() if c.enabled()]
+
+
+registry = ChannelRegistry()
+registry.register(GcmChannel())
+registry.register(MqttChannel())
+registry.register(ZmqChannel())
+registry.register(WebSocketChannel())
+
+_executor = ThreadPoolExecutor(max_workers=CHANNEL_THREADS, thread_name_prefix='channel')
+_slots = {}
+_slots_lock = Lock()
+
+
+def _channel_slots(channel):
+    """ the semaphore bounding the executor threads held by channel's delivers """
+    with _slots_lock:
+        slots = _slots.get(channel.name)
+        if slots is None:
+            slots = _slots[channel.name] = BoundedSemaphore(channel.concurrency)
+        return slots
+
+
+def _deliver(app, channel, batch, data, slots):
+    start = monotonic()
+    try:
+        with app.app_context():
+            return channel.deliver(batch, data), monotonic() - start
+    finally:
+        slots.release()
+
+
+def deliver_batches(batches, data):
+    """ runs deliver of every (channel, batch) at once, returns their Outcomes once all are in or timed out """
+    app = current_app._get_current_object()
+    start = monotonic()
+    pending = []
+    for channel, batch in batches:
+        slots = _channel_slots(channel)
+        # None if all of its threads are stuck in earlier delivers
+        future = _executor.submit(_deliver, app, channel, batch, data, slots) \
+            if slots.acquire(blocking=False) else None
+        pending.append((channel, batch, slots, future))
+    outcomes = []
+    for channel, batch, slots, future in pending:
+        if future is None:
+            _LOGGER.warning("%s has %d deliveries in flight, not delivering", channel.name, channel.concurrency)
+            outcomes.append(Outcome(channel, batch, None, 0.0, False, 'Busy'))
+            continue
+        try:
+            result, seconds = future.result(timeout=max(0, start + channel.timeout - monotonic()))
+            outcomes.append(Outcome(channel, batch, result, seconds, False, None))
+        except TimeoutError:
+            _LOGGER.warning("%s delivery timed out after %ds", channel.name, channel.timeout)
+            if future.cancel():
+                # still queued behind other delivers, _deliver won't run to free the slot
+                slots.release()
+            outcomes.append(Outcome(channel, batch, None, monotonic() - start, True, 'Timeout'))
+        except Exception as err:
+            _LOGGER.exception("%s delivery failed", channel.name)
+            outcomes.append(Outcome(channel, batch, None, monotonic() - start, False, type(err).__name__))
+    return outcomes
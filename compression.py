@@ -0,0 +1,126 @@
+""" response compression and compact storage of large message bodies """
+import gzip
+import zlib
+from functools import wraps
+
+from flask import request, make_response
+
+from config import Config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+cfg = Config.get_global_instance()
+
+# in order of preference when the client accepts several equally
+ENCODINGS = ('br', 'gzip', 'deflate') if brotli is not None else ('gzip', 'deflate')
+
+_compressors = {
+    'gzip': lambda data: gzip.compress(data, 6),
+    'deflate': lambda data: zlib.compress(data, 6),
+}
+if brotli is not None:
+    _compressors['br'] = lambda data: brotli.compress(data, quality=5)
+
+_stream_compressors = {
+    'gzip': lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    'deflate': lambda: zlib.compressobj(6),
+}
+if brotli is not None:
+    _stream_compressors['br'] = lambda: _BrotliStream()
+
+
+class _BrotliStream:
+    """ the compressobj interface over a brotli compressor """
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=5)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def negotiate_encoding():
+    """ the best content coding the client accepts, or None """
+    accepted = request.accept_encodings
+    best, quality = None, 0
+    for encoding in ENCODINGS:
+        q = accepted[encoding]
+        if q > quality:
+            best, quality = encoding, q
+    return best
+
+
+def _compress_stream(chunks, encoding):
+    compressor = _stream_compressors[encoding]()
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # lets the wrapped generator run its cleanup when the client goes away
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _set_encoding(response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        # every coding is a different representation with its own strong tag
+        response.set_etag('{}-{}'.format(etag, encoding), weak)
+
+
+def compress_response(response):
+    threshold = cfg.response_compression_threshold
+    if not threshold or response.status_code != 200 or response.direct_passthrough \
+            or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if response.is_streamed:
+        # the size is unknown up front, streams are only used for large bodies
+        if encoding is not None:
+            response.response = _compress_stream(response.response, encoding)
+            _set_encoding(response, encoding)
+        return response
+
+    data = response.get_data()
+    if encoding is None or len(data) < threshold:
+        return response
+
+    response.set_data(_compressors[encoding](data))
+    _set_encoding(response, encoding)
+    return response
+
+
+def compressed(f):
+    @wraps(f)
+    def df(*args, **kwargs):
+        return compress_response(make_response(f(*args, **kwargs)))
+
+    return df
+
+
+def pack_text(text):
+    """ zlib compressed utf-8 of text if it is large enough to be worth it, otherwise None """
+    threshold = cfg.text_compression_threshold
+    if not threshold:
+        return None
+    data = text.encode('utf-8')
+    if len(data) < threshold:
+        return None
+    packed = zlib.compress(data, 9)
+    return packed if len(packed) < len(data) else None
+
+
+def unpack_text(packed):
+    return zlib.decompress(packed).decode('utf-8')
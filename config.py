@@ -25,17 +25,112 @@ def construct_default_db_uri() -> str:
 
 db_uri_comment = """#for mysql, use something like:
 #uri = 'mysql+pymysql://pushfish@localhost/pushfish_api?charset=utf8mb4'"""
+db_replica_comment = """#comma separated URIs of read replicas for the polling endpoints. A device
+#reads from the primary for replica_sticky_seconds after its own writes """
+db_shard_comment = """#comma separated URIs of further shards. Services, with their messages and
+#subscriptions, are spread over uri and these. Use rebalance.py to move them """
+db_text_compression_comment = """#message texts of at least this many bytes are stored zlib compressed,
+#0 stores them as they are """
+db_backlog_comment = """#default cap of every service's stored messages, by count and by age in
+#seconds, 0 for no cap. Subscribers are told how many messages they missed.
+#PATCH /service only lets a service lower its own caps below these """
+db_subscription_expiry_comment = """#subscriptions of devices that neither polled nor received a push for
+#this many days are deleted, 0 keeps them forever """
+db_housekeeping_comment = """#seconds between the background runs applying the backlog caps and
+#deleting expired subscriptions """
+db_purge_comment = """#deleted services are purged in the background, purge_batch_size rows per
+#transaction, and looked for every purge_interval seconds """
 dispatch_zmq_comment = """#point zeromq_relay_uri at the zeromq pubsub socket for
 #the pushfish connectors """
+dispatch_mqtt_mode_comment = """#device publishes every message to each subscribed device's uuid topic,
+#service publishes it once to the service topic and lets the broker fan out,
+#leaving it unread for GET /message as the broker doesn't report who got it.
+#Messages sent with tags still go to the uuid topics of the devices having them """
+dispatch_payload_comment = """#wire format of MQTT and ZMQ relay payloads, json or msgpack.
+#msgpack needs the msgpack package and carries the same fields as json """
+dispatch_workers_comment = """#number of background delivery threads, messages are then delivered
+#by level priority instead of inline. 0 delivers inline in the request """
+dispatch_schedule_comment = """#messages sent with deliver_at or delay are loaded schedule_window seconds
+#before they are due, and at most schedule_rate due messages are released per second """
+dispatch_coalesce_comment = """#default seconds over which a service's bursts are pushed as one notification
+#carrying the number of messages and the latest one, 0 pushes every message.
+#PATCH /service only lets a service widen its own window """
+dispatch_quota_comment = """#default messages and device notifications per minute a service may send.
+#Above that its deliveries are queued, then coalesced over throttle_coalesce_window
+#seconds, and from twice the quota its messages are rejected. 0 for no quota.
+#PATCH /service only lets a service lower its own quotas below these """
+dispatch_idempotency_comment = """#seconds and number of keys per service for which a retried
+#POST /message with the same Idempotency-Key is answered without resending """
+dispatch_retry_comment = """#devices a channel failed to reach are retried every retry_interval seconds
+#or so, after retry_backoff * 2^attempts seconds, and parked after retry_max_attempts
+#until replayed with POST /service/replay or replay.py """
 server_debug_comment = """#set debug to 0 for production mode """
+server_compression_comment = """#inbox and subscription responses of at least this many bytes are
+#gzip/deflate (or brotli, if installed) compressed, 0 disables compression """
+server_trace_comment = """#fraction of requests traced, 0 disables tracing. The spans of traced
+#requests are appended to trace_file as JSON lines, in the json format or
+#as OpenTelemetry OTLP/JSON with trace_format = otlp """
+server_websocket_comment = """#port of the WebSocket gateway devices connect to at ws://host:port/?uuid=<uuid>
+#to get their messages pushed, 0 disables it. Needs the websockets package """
+server_health_comment = """#seconds /healthz and /readyz reuse their last report before checking again """
+server_stats_comment = """#secret operators pass as ?secret= to read /stats/*, which name the busiest
+#services. The endpoints are refused while it is empty """
 
 DEFAULT_VALUES = {
-    "database": {"uri": ConfigOption(construct_default_db_uri, str, True, "PUSHFISH_DB", db_uri_comment)},
+    "database": {"uri": ConfigOption(construct_default_db_uri, str, True, "PUSHFISH_DB", db_uri_comment),
+                 "replica_uris": ConfigOption("", str, False, "PUSHFISH_DB_REPLICAS", db_replica_comment),
+                 "replica_sticky_seconds": ConfigOption(10, int, False, "PUSHFISH_DB_REPLICA_STICKY", None),
+                 "shard_uris": ConfigOption("", str, False, "PUSHFISH_DB_SHARDS", db_shard_comment),
+                 "text_compression_threshold": ConfigOption(0, int, False, "PUSHFISH_TEXT_COMPRESSION_THRESHOLD",
+                                                            db_text_compression_comment),
+                 "backlog_max_messages": ConfigOption(0, int, False, "PUSHFISH_BACKLOG_MAX_MESSAGES",
+                                                      db_backlog_comment),
+                 "backlog_max_age": ConfigOption(0, int, False, "PUSHFISH_BACKLOG_MAX_AGE", None),
+                 "subscription_expiry_days": ConfigOption(0, int, False, "PUSHFISH_SUBSCRIPTION_EXPIRY_DAYS",
+                                                          db_subscription_expiry_comment),
+                 "housekeeping_interval": ConfigOption(300, int, False, "PUSHFISH_HOUSEKEEPING_INTERVAL",
+                                                       db_housekeeping_comment),
+                 "purge_batch_size": ConfigOption(500, int, False, "PUSHFISH_PURGE_BATCH_SIZE", db_purge_comment),
+                 "purge_interval": ConfigOption(60, int, False, "PUSHFISH_PURGE_INTERVAL", None)},
     "dispatch": {"mqtt_broker_address": ConfigOption("", str, False, "MQTT_ADDRESS", None),
+                 "mqtt_delivery_mode": ConfigOption("device", str, False, "PUSHFISH_MQTT_DELIVERY_MODE",
+                                                    dispatch_mqtt_mode_comment),
                  "google_api_key": ConfigOption("", str, False, "PUSHFISH_GOOGLE_API_KEY", None),
                  "google_gcm_sender_id": ConfigOption(123456789012, bool, True, "PUSHFISH_GCM_SENDER_ID", None),
-                 "zeromq_relay_uri": ConfigOption("", str, False, "PUSHFISH_ZMQ_RELAY_URI", dispatch_zmq_comment)},
-    "server": {"debug": ConfigOption(0, bool, False, "PUSHFISH_DEBUG", server_debug_comment)}}
+                 "zeromq_relay_uri": ConfigOption("", str, False, "PUSHFISH_ZMQ_RELAY_URI", dispatch_zmq_comment),
+                 "mqtt_payload_format": ConfigOption("json", str, False, "PUSHFISH_MQTT_PAYLOAD_FORMAT",
+                                                     dispatch_payload_comment),
+                 "zeromq_payload_format": ConfigOption("json", str, False, "PUSHFISH_ZMQ_PAYLOAD_FORMAT", None),
+                 "workers": ConfigOption(0, int, False, "PUSHFISH_DISPATCH_WORKERS", dispatch_workers_comment),
+                 "idempotency_ttl": ConfigOption(86400, int, False, "PUSHFISH_IDEMPOTENCY_TTL",
+                                                 dispatch_idempotency_comment),
+                 "idempotency_max_keys": ConfigOption(1000, int, False, "PUSHFISH_IDEMPOTENCY_MAX_KEYS", None),
+                 "schedule_window": ConfigOption(60, int, False, "PUSHFISH_SCHEDULE_WINDOW",
+                                                 dispatch_schedule_comment),
+                 "schedule_rate": ConfigOption(100, int, False, "PUSHFISH_SCHEDULE_RATE", None),
+                 "coalesce_window": ConfigOption(0, int, False, "PUSHFISH_COALESCE_WINDOW",
+                                                 dispatch_coalesce_comment),
+                 "quota_messages": ConfigOption(0, int, False, "PUSHFISH_QUOTA_MESSAGES", dispatch_quota_comment),
+                 "quota_notifications": ConfigOption(0, int, False, "PUSHFISH_QUOTA_NOTIFICATIONS", None),
+                 "throttle_coalesce_window": ConfigOption(10, int, False, "PUSHFISH_THROTTLE_COALESCE_WINDOW",
+                                                          None),
+                 "retry_interval": ConfigOption(30, int, False, "PUSHFISH_RETRY_INTERVAL", dispatch_retry_comment),
+                 "retry_backoff": ConfigOption(30, int, False, "PUSHFISH_RETRY_BACKOFF", None),
+                 "retry_max_attempts": ConfigOption(8, int, False, "PUSHFISH_RETRY_MAX_ATTEMPTS", None)},
+    "server": {"debug": ConfigOption(0, bool, False, "PUSHFISH_DEBUG", server_debug_comment),
+               "response_compression_threshold": ConfigOption(1024, int, False,
+                                                              "PUSHFISH_RESPONSE_COMPRESSION_THRESHOLD",
+                                                              server_compression_comment),
+               "trace_sample_rate": ConfigOption(0.0, float, False, "PUSHFISH_TRACE_SAMPLE_RATE",
+                                                 server_trace_comment),
+               "trace_file": ConfigOption("", str, False, "PUSHFISH_TRACE_FILE", None),
+               "trace_format": ConfigOption("json", str, False, "PUSHFISH_TRACE_FORMAT", None),
+               "health_cache_seconds": ConfigOption(5, int, False, "PUSHFISH_HEALTH_CACHE_SECONDS",
+                                                    server_health_comment),
+               "stats_secret": ConfigOption("", str, False, "PUSHFISH_STATS_SECRET", server_stats_comment),
+               "websocket_port": ConfigOption(0, int, False, "PUSHFISH_WEBSOCKET_PORT", server_websocket_comment),
+               "websocket_host": ConfigOption("", str, False, "PUSHFISH_WEBSOCKET_HOST", None),
+               "websocket_ping_interval": ConfigOption(60, int, False, "PUSHFISH_WEBSOCKET_PING_INTERVAL", None)}}
 
 
 def call_if_callable(v, *args, **kwargs):
@@ -235,11 +330,68 @@ class Config:
                     fatal_error_exit_or_backtrace(err, errstr, _LOGGER)
         return val
 
+    @property
+    def database_replica_uris(self) -> list:
+        """ returns the read replica URIs, empty if there are none"""
+        val = self._safe_get_cfg_value("database", "replica_uris")
+        return [uri.strip() for uri in val.split(",") if uri.strip()]
+
+    @property
+    def database_replica_sticky_seconds(self) -> int:
+        """ returns for how long a device reads from the primary after writing"""
+        return self._safe_get_cfg_value("database", "replica_sticky_seconds")
+
+    @property
+    def database_shard_uris(self) -> list:
+        """ returns the URIs of the shards besides the main database, empty if there are none"""
+        val = self._safe_get_cfg_value("database", "shard_uris")
+        return [uri.strip() for uri in val.split(",") if uri.strip()]
+
+    @property
+    def text_compression_threshold(self) -> int:
+        """ returns the size from which message texts are stored compressed, 0 if never"""
+        return self._safe_get_cfg_value("database", "text_compression_threshold")
+
+    @property
+    def backlog_max_messages(self) -> int:
+        """ returns how many messages a service keeps by default, 0 if unlimited"""
+        return self._safe_get_cfg_value("database", "backlog_max_messages")
+
+    @property
+    def backlog_max_age(self) -> int:
+        """ returns how long a service keeps messages by default in seconds, 0 if forever"""
+        return self._safe_get_cfg_value("database", "backlog_max_age")
+
+    @property
+    def subscription_expiry_days(self) -> int:
+        """ returns after how many days without activity subscriptions expire, 0 if never"""
+        return self._safe_get_cfg_value("database", "subscription_expiry_days")
+
+    @property
+    def housekeeping_interval(self) -> int:
+        """ returns the seconds between applying backlog caps and subscription expiry"""
+        return self._safe_get_cfg_value("database", "housekeeping_interval")
+
+    @property
+    def purge_batch_size(self) -> int:
+        """ returns the rows deleted per transaction when purging a deleted service"""
+        return self._safe_get_cfg_value("database", "purge_batch_size")
+
+    @property
+    def purge_interval(self) -> int:
+        """ returns the seconds between checks for deleted services left to purge"""
+        return self._safe_get_cfg_value("database", "purge_interval")
+
     @property
     def mqtt_broker_address(self) -> str:
         """ returns MQTT server address"""
         return self._safe_get_cfg_value("dispatch", "mqtt_broker_address")
 
+    @property
+    def mqtt_delivery_mode(self) -> str:
+        """ returns MQTT delivery mode, either "device" or "service" """
+        return self._safe_get_cfg_value("dispatch", "mqtt_delivery_mode")
+
     @property
     def google_api_key(self) -> str:
         """ returns google API key for gcm"""
@@ -255,6 +407,76 @@ class Config:
         """ returns relay URI for zeromq dispatcher"""
         return self._safe_get_cfg_value("dispatch", "zeromq_relay_uri")
 
+    @property
+    def mqtt_payload_format(self) -> str:
+        """ returns the format of MQTT payloads, either "json" or "msgpack" """
+        return self._safe_get_cfg_value("dispatch", "mqtt_payload_format")
+
+    @property
+    def zeromq_payload_format(self) -> str:
+        """ returns the format of ZMQ relay payloads, either "json" or "msgpack" """
+        return self._safe_get_cfg_value("dispatch", "zeromq_payload_format")
+
+    @property
+    def dispatch_workers(self) -> int:
+        """ returns the number of background delivery threads"""
+        return self._safe_get_cfg_value("dispatch", "workers")
+
+    @property
+    def idempotency_ttl(self) -> int:
+        """ returns how long idempotency keys are remembered, in seconds"""
+        return self._safe_get_cfg_value("dispatch", "idempotency_ttl")
+
+    @property
+    def idempotency_max_keys(self) -> int:
+        """ returns how many idempotency keys are remembered per service"""
+        return self._safe_get_cfg_value("dispatch", "idempotency_max_keys")
+
+    @property
+    def schedule_window(self) -> int:
+        """ returns how far ahead scheduled messages are loaded, in seconds"""
+        return self._safe_get_cfg_value("dispatch", "schedule_window")
+
+    @property
+    def schedule_rate(self) -> int:
+        """ returns how many due scheduled messages are released per second at most"""
+        return self._safe_get_cfg_value("dispatch", "schedule_rate")
+
+    @property
+    def coalesce_window(self) -> int:
+        """ returns the default seconds over which bursts are pushed as one, 0 if never"""
+        return self._safe_get_cfg_value("dispatch", "coalesce_window")
+
+    @property
+    def quota_messages(self) -> int:
+        """ returns the default messages per minute a service may send unthrottled, 0 if unlimited"""
+        return self._safe_get_cfg_value("dispatch", "quota_messages")
+
+    @property
+    def quota_notifications(self) -> int:
+        """ returns the default device notifications per minute a service may send unthrottled, 0 if unlimited"""
+        return self._safe_get_cfg_value("dispatch", "quota_notifications")
+
+    @property
+    def throttle_coalesce_window(self) -> int:
+        """ returns the seconds over which throttled services are coalesced"""
+        return self._safe_get_cfg_value("dispatch", "throttle_coalesce_window")
+
+    @property
+    def retry_interval(self) -> int:
+        """ returns the seconds between looks for failed deliveries due for a retry"""
+        return self._safe_get_cfg_value("dispatch", "retry_interval")
+
+    @property
+    def retry_backoff(self) -> int:
+        """ returns the seconds before the first retry of a failed delivery, doubling after each"""
+        return self._safe_get_cfg_value("dispatch", "retry_backoff")
+
+    @property
+    def retry_max_attempts(self) -> int:
+        """ returns how often a failed delivery is retried before it is parked"""
+        return self._safe_get_cfg_value("dispatch", "retry_max_attempts")
+
     @property
     def debug(self) -> bool:
         """ returns desired debug state of application.
@@ -263,6 +485,51 @@ class Config:
             return True
         return self._safe_get_cfg_value("server", "debug")
 
+    @property
+    def response_compression_threshold(self) -> int:
+        """ returns the size from which responses are compressed, 0 if never"""
+        return self._safe_get_cfg_value("server", "response_compression_threshold")
+
+    @property
+    def trace_sample_rate(self) -> float:
+        """ returns the fraction of requests that are traced"""
+        return self._safe_get_cfg_value("server", "trace_sample_rate")
+
+    @property
+    def trace_file(self) -> str:
+        """ returns the path spans of traced requests are appended to"""
+        return self._safe_get_cfg_value("server", "trace_file")
+
+    @property
+    def trace_format(self) -> str:
+        """ returns the trace file format, either "json" or "otlp" """
+        return self._safe_get_cfg_value("server", "trace_format")
+
+    @property
+    def health_cache_seconds(self) -> int:
+        """ returns the seconds a health report is reused"""
+        return self._safe_get_cfg_value("server", "health_cache_seconds")
+
+    @property
+    def stats_secret(self) -> str:
+        """ returns the secret guarding /stats/*, empty if they are refused"""
+        return self._safe_get_cfg_value("server", "stats_secret")
+
+    @property
+    def websocket_port(self) -> int:
+        """ returns the port of the WebSocket gateway, 0 if disabled"""
+        return self._safe_get_cfg_value("server", "websocket_port")
+
+    @property
+    def websocket_host(self) -> str:
+        """ returns the address the WebSocket gateway listens on, every interface if empty"""
+        return self._safe_get_cfg_value("server", "websocket_host")
+
+    @property
+    def websocket_ping_interval(self) -> int:
+        """ returns the seconds between pings of idle WebSocket connections"""
+        return self._safe_get_cfg_value("server", "websocket_ping_interval")
+
 
 def fatal_error_exit_or_backtrace(err: Exception,
                                   msg: str,
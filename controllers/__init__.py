@@ -3,3 +3,5 @@ from .message import message
 from .service import service
 from .gcm import gcm
 from .mqtt import mqtt
+from .stats import stats
+from .health import health
@@ -1,6 +1,6 @@
 from flask import Blueprint, request, jsonify
 from utils import has_uuid, Error
-from models import Gcm
+from channels import registry
 from shared import db
 from config import Config
 
@@ -16,11 +16,7 @@ def gcm_register(client):
 
     if not registration:
         return Error.ARGUMENT_MISSING('regid')
-    regs = Gcm.query.filter_by(uuid=client).all()
-    for u in regs:
-        db.session.delete(u)
-    reg = Gcm(client, registration)
-    db.session.add(reg)
+    registry.get('gcm').register(client, registration)
     db.session.commit()
     return Error.NONE
 
@@ -28,9 +24,7 @@ def gcm_register(client):
 @gcm.route("/gcm", methods=["DELETE"])
 @has_uuid
 def gcm_unregister(client):
-    regs = Gcm.query.filter_by(uuid=client).all()
-    for u in regs:
-        db.session.delete(u)
+    registry.get('gcm').unregister(client)
     db.session.commit()
     return Error.NONE
 
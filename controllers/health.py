@@ -0,0 +1,24 @@
+from flask import Blueprint, jsonify
+from health import monitor
+
+health = Blueprint('health', __name__)
+
+
+@health.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    the state of the database, relays and dispatch, answers 200 as long as
+    the process serves requests
+    """
+    _, report = monitor.report()
+    return jsonify(report)
+
+
+@health.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    the same report, with 503 while a database shard or an enabled relay
+    is down, so load balancers stop sending traffic
+    """
+    ready, report = monitor.report()
+    return jsonify(report), 200 if ready else 503
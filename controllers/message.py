@@ -1,18 +1,30 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from json import dumps as json_encode
 
-from flask import Blueprint, jsonify, request
-from flask import current_app
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from sqlalchemy import distinct, exists, func, or_
+from sqlalchemy.exc import IntegrityError
 
-from utils import Error, has_uuid, has_secret, queue_zmq_message
+from utils import Error, has_uuid, has_secret, make_etag, is_not_modified, not_modified, \
+    replica_reads
 from shared import db
-from models import Subscription, Message, Gcm, MQTT
+from compression import compressed
+from dispatch import coalescer, insert_message
+from scheduler import scheduler
+from throttle import throttle, THROTTLE_REJECT
+from routing import each_shard
+from tracing import tracer
+from wire import FORMAT_MSGPACK, MIMETYPES, negotiate_format, respond, pack_document
+from models import Service, Subscription, Message, IdempotencyKey, ScheduledMessage, SubscriptionTag
+from models.tag import parse_tags, join_tags, like_tag
 from config import Config
 
 cfg = Config.get_global_instance()
 
 message = Blueprint('message', __name__)
 
+INBOX_BATCH_SIZE = 200  # messages fetched from the cursor at a time while streaming an inbox
+
 
 @message.route('/message', methods=['POST'])
 @has_secret
@@ -21,7 +33,23 @@ def message_send(service):
     if not text:
         return Error.ARGUMENT_MISSING('message')
 
-    subscribers = Subscription.query.filter_by(service=service).count()
+    idempotency_key = request.headers.get('Idempotency-Key', '').strip() or request.form.get('dedup_id', '').strip()
+    if idempotency_key and IdempotencyKey.seen(service, idempotency_key, cfg.idempotency_ttl):
+        # A retry of a submission that has already been fanned out
+        return Error.NONE
+
+    tags = parse_tags(request.form.get('tags'))
+    if tags is None:
+        return Error.ARGUMENT_INVALID('tags')
+
+    with tracer.span('subscribers'):
+        if tags:
+            # only the targeted devices are counted, and notified
+            subscribers = db.session.query(func.count(distinct(SubscriptionTag.device))) \
+                .filter(SubscriptionTag.service_id == service.id) \
+                .filter(SubscriptionTag.tag.in_(tags)).scalar()
+        else:
+            subscribers = Subscription.query.filter_by(service=service).count()
     if subscribers == 0:
         # Pretend we did something even though we didn't
         # Nobody is listening so it doesn't really matter
@@ -31,58 +59,242 @@ def message_send(service):
     level = int(level) if level in "12345" else 3
     title = request.form.get('title', '').strip()[:255]
     link = request.form.get('link', '').strip()
-    msg = Message(service, text, title, level, link)
-    db.session.add(msg)
-    db.session.commit()
 
-    if cfg.google_api_key or current_app.config['TESTING']:
-        Gcm.send_message(msg)
+    deliver_at = _deliver_at()
+    if deliver_at is False:
+        return Error.ARGUMENT_INVALID('deliver_at' if request.form.get('deliver_at') else 'delay')
 
-    if cfg.mqtt_broker_address:
-        MQTT.send_message(msg)
+    # only what is actually sent counts against the quota
+    throttled = throttle.admit(service, subscribers)
+    if throttled == THROTTLE_REJECT:
+        return Error.RATE_TOOFAST
 
-    if cfg.zeromq_relay_uri:
-        queue_zmq_message(json_encode({"message": msg.as_dict()}))
+    if deliver_at is not None and deliver_at > datetime.utcnow():
+        scheduled = ScheduledMessage(service, text, title, level, link, deliver_at, join_tags(tags))
+        db.session.add(scheduled)
+        if idempotency_key:
+            db.session.add(IdempotencyKey(service, idempotency_key, None))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            throttle.refund(service, subscribers)
+            return Error.NONE
+        scheduler.add(scheduled)
+        return Error.NONE
+
+    msg = Message(service, text, title, level, link, join_tags(tags))
+    with tracer.span('insert'):
+        insert_message(msg)
+        if idempotency_key:
+            db.session.flush()
+            db.session.add(IdempotencyKey(service, idempotency_key, msg))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # A concurrent retry with the same key got there first
+            db.session.rollback()
+            throttle.refund(service, subscribers)
+            return Error.NONE
 
-    service.cleanup()
+    with tracer.span('dispatch', level=level):
+        coalescer.submit(msg, throttled)
+
+    if idempotency_key:
+        IdempotencyKey.evict(service, cfg.idempotency_ttl, cfg.idempotency_max_keys)
     db.session.commit()
     return Error.NONE
 
 
+def _deliver_at():
+    """ the UTC time the message was scheduled for with deliver_at (unix time) or
+    delay (seconds), None to send it right away and False if either is malformed """
+    deliver_at = request.form.get('deliver_at', '').strip()
+    delay = request.form.get('delay', '').strip()
+    try:
+        if deliver_at:
+            return datetime.utcfromtimestamp(float(deliver_at))
+        if delay:
+            return datetime.utcnow() + timedelta(seconds=float(delay))
+    except (ValueError, OverflowError, OSError):
+        return False
+    return None
+
+
 @message.route('/message', methods=['GET'])
+@compressed
 @has_uuid
+@replica_reads
 def message_recv(client):
-    subscriptions = Subscription.query.filter_by(device=client).all()
-    if not subscriptions:
+    versions = []
+    dropped = {}
+    for shard in each_shard():
+        rows = db.session.query(Subscription.id, Subscription.last_read, Subscription.unread,
+                                Subscription.dropped, Service.public) \
+            .join(Subscription.service) \
+            .filter(Subscription.device == client) \
+            .filter(Service.deleted_at.is_(None)) \
+            .order_by(Subscription.id).all()
+        versions += [(shard,) + tuple(v[:4]) for v in rows]
+        # messages evicted by the backlog cap before the device got to them
+        dropped.update({v.public: v.dropped for v in rows if v.dropped})
+    if not versions:
         return jsonify({'messages': []})
 
-    msg = []
-    for l in subscriptions:
-        msg += l.messages().all()
+    # unread counters and last_read change whenever something new arrives or
+    # is read, so a matching tag means the inbox is still empty
+    format_ = negotiate_format()
+    etag = make_etag('message', format_, versions)
+    if is_not_modified(etag):
+        for _ in each_shard():
+            Subscription.query.filter_by(device=client) \
+                .update({Subscription.timestamp_checked: datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        return not_modified(etag)
 
-    last_read = max([0] + [m.id for m in msg])
-    for l in subscriptions:
-        l.timestamp_checked = datetime.utcnow()
-        l.last_read = max(l.last_read, last_read)
-        l.service.cleanup()
+    has_messages = False
+    for _ in each_shard():
+        has_messages = has_messages or db.session.query(_unread_messages(client).exists()).scalar()
+    if not has_messages:
+        for _ in each_shard():
+            _mark_read(client, _services_of(client), 0)
+        db.session.commit()
+        inbox = {'messages': []}
+        if dropped:
+            inbox['dropped'] = dropped
+        ret = respond(inbox, format_)
+        ret.set_etag(etag)
+        return ret
 
-    ret = jsonify({'messages': [m.as_dict() for m in msg]})
-    db.session.commit()
+    if format_ == FORMAT_MSGPACK:
+        # the array length goes first, counted in the transaction the messages are then read in
+        upto, count = {}, 0
+        for shard in each_shard():
+            shard_count, upto[shard] = _unread_messages(client).order_by(None) \
+                .with_entities(func.count(Message.id), func.max(Message.id)).one()
+            count += shard_count
+        ret = Response(stream_with_context(_pack_inbox(client, dropped, count, upto)), mimetype=MIMETYPES[format_])
+    else:
+        ret = Response(stream_with_context(_stream_inbox(client, dropped)), mimetype=MIMETYPES[format_])
+    ret.vary.add('Accept')
+    ret.set_etag(etag)
     return ret
 
 
+def _unread_messages(client):
+    """ the messages of the current shard the client has not read yet, oldest first.
+    Messages sent with tags are left out for subscriptions without any of them """
+    tagged = exists() \
+        .where(SubscriptionTag.subscription_id == Subscription.id) \
+        .where(Message.tags.like(like_tag(SubscriptionTag.tag), escape='\\'))
+    return Message.query \
+        .join(Subscription, Subscription.service_id == Message.service_id) \
+        .join(Subscription.service) \
+        .filter(Subscription.device == client) \
+        .filter(Service.deleted_at.is_(None)) \
+        .filter(Message.id > func.coalesce(Subscription.last_read, 0)) \
+        .filter(or_(Message.tags.is_(None), tagged)) \
+        .order_by(Message.id)
+
+
+def _services_of(client):
+    return Service.query.join(Subscription, Subscription.service_id == Service.id) \
+        .filter(Subscription.device == client).all()
+
+
+def _mark_read(client, services, last_read):
+    """
+    marks the current shard's messages up to the id last_read read for
+    client. The messages may have come off a lagging replica, so the rows
+    are updated in place on the primary: last_read never moves back, and
+    unread is recounted there instead of cleared
+    """
+    subscriptions = Subscription.query.filter_by(device=client)
+    subscriptions.update({Subscription.timestamp_checked: datetime.utcnow(), Subscription.dropped: 0},
+                         synchronize_session=False)
+    subscriptions.filter(func.coalesce(Subscription.last_read, 0) <= last_read) \
+        .update({Subscription.last_read: last_read, Subscription.unread: Subscription.unread_after(last_read)},
+                synchronize_session=False)
+    for service in services:
+        service.cleanup()
+
+
+def _inbox(client, upto=None):
+    """
+    yields the unread messages of client straight off a server side cursor,
+    so only INBOX_BATCH_SIZE of them are held at a time. A shard's messages
+    are marked read once all of them have been generated. upto bounds the
+    message ids per shard, e.g. to those counted beforehand.
+    """
+    for shard in each_shard():
+        services = _services_of(client)
+        # message ids are only comparable within a shard
+        last_read = 0
+        rows = _unread_messages(client)
+        if upto is not None:
+            rows = rows.filter(Message.id <= (upto[shard] or 0))
+        rows = rows.execution_options(stream_results=True).yield_per(INBOX_BATCH_SIZE)
+        for m in rows:
+            yield m.as_dict()
+            last_read = m.id
+        _mark_read(client, services, last_read)
+
+
+def _pack_inbox(client, dropped, count, upto):
+    """ yields the inbox in MessagePack, the count messages up to the ids upto packed as _inbox generates them """
+    for chunk in pack_document('messages', count, _inbox(client, upto), {'dropped': dropped} if dropped else None):
+        yield chunk
+    db.session.commit()
+
+
+def _stream_inbox(client, dropped):
+    """ yields the inbox as JSON fragments, as _inbox generates the messages """
+    separator = '{"messages": ['
+    for m in _inbox(client):
+        yield separator + json_encode(m)
+        separator = ', '
+    if separator != ', ':
+        # the messages were evicted or read in the meantime
+        yield separator
+    yield '], "dropped": {}}}'.format(json_encode(dropped)) if dropped else ']}'
+    db.session.commit()
+
+
 @message.route('/message', methods=['DELETE'])
 @has_uuid
 def message_read(client):
-    subscriptions = Subscription.query.filter_by(device=client).all()
-    if subscriptions:
-        last_message = Message.query.order_by(Message.id.desc()).first()
-        for l in subscriptions:
-            l.timestamp_checked = datetime.utcnow()
-            l.last_read = last_message.id if last_message else 0
-
-        for l in subscriptions:
-            l.service.cleanup()
-        db.session.commit()
+    for _ in each_shard():
+        subscriptions = Subscription.query.filter_by(device=client).all()
+        if subscriptions:
+            last_message = Message.query.order_by(Message.id.desc()).first()
+            for l in subscriptions:
+                l.timestamp_checked = datetime.utcnow()
+                l.last_read = last_message.id if last_message else 0
+                l.unread = 0
+
+            for l in subscriptions:
+                l.service.cleanup()
+            db.session.commit()
 
     return Error.NONE
+
+
+@message.route('/message/unread', methods=['GET'])
+@has_uuid
+@replica_reads
+def message_unread(client):
+    """
+    badge count for a device, read from the per-subscription counters
+    maintained by message_send and the read paths. No message rows are touched.
+    :param client: client uuid
+    """
+    services = {}
+    for _ in each_shard():
+        counters = db.session.query(Service.public, Subscription.unread) \
+            .join(Subscription.service) \
+            .filter(Subscription.device == client) \
+            .filter(Service.deleted_at.is_(None)) \
+            .all()
+        services.update({public: unread for public, unread in counters})
+
+    return jsonify({'unread': sum(services.values()), 'services': services})
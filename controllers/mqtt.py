@@ -1,6 +1,7 @@
-from flask import Blueprint, jsonify
-from utils import has_uuid, Error
+from flask import Blueprint, jsonify, request
+from utils import has_uuid, is_uuid, Error
 from models import MQTT
+from channels import registry
 from shared import db
 from config import Config
 
@@ -16,13 +17,9 @@ def mqtt_register(client):
     register by uuid to a service
     :param client: client uuid
     """
-    regs = MQTT.query.filter_by(uuid=client).all()
-    for u in regs:
-        db.session.delete(u)
-    reg = MQTT(client)
-    db.session.add(reg)
+    registry.get('mqtt').register(client)
     db.session.commit()
-    return Error.NONE
+    return jsonify({'status': 'ok', 'topics': MQTT.topics_for(client)})
 
 
 @mqtt.route("/mqtt", methods=["DELETE"])
@@ -32,14 +29,21 @@ def mqtt_unregister(client):
     unregister by uuid to a service
     :param client: client uuid
     """
-    regs = MQTT.query.filter_by(uuid=client).all()
-    for u in regs:
-        db.session.delete(u)
+    registry.get('mqtt').unregister(client)
     db.session.commit()
     return Error.NONE
 
 
 @mqtt.route("/mqtt", methods=["GET"])
 def mqtt_broker_address():
-    data = dict(broker_address=cfg.mqtt_broker_address)
+    """
+    broker address and delivery mode, plus the topics to subscribe to
+    when a client uuid is passed
+    """
+    data = dict(broker_address=cfg.mqtt_broker_address, delivery_mode=cfg.mqtt_delivery_mode)
+    client = request.args.get('uuid', '')
+    if client:
+        if not is_uuid(client):
+            return Error.INVALID_CLIENT
+        data['topics'] = MQTT.topics_for(client)
     return jsonify(data)
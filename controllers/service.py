@@ -1,10 +1,13 @@
-from json import dumps as json_encode
+from datetime import datetime
 
 from flask import Blueprint, jsonify, request
-from utils import Error, is_service, is_secret, has_secret, queue_zmq_message
+from utils import Error, is_service, is_secret, has_secret, make_etag, is_not_modified, \
+    replica_reads, not_modified
 
-from models import Service, Message
+from models import Service, ShardDirectory, DeadLetter
 from shared import db
+from routing import use_shard
+from purge import purger
 from config import Config
 
 cfg = Config.get_global_instance()
@@ -19,12 +22,24 @@ def service_create():
     if not name:
         return Error.ARGUMENT_MISSING('name')
     srv = Service(name, icon)
+    use_shard(ShardDirectory.shard_for(srv.public))
     db.session.add(srv)
     db.session.commit()
     return jsonify({"service": srv.as_dict(True)})
 
 
+def _service_info_response(srv):
+    etag = make_etag('service', srv.id, srv.timestamp_updated)
+    if is_not_modified(etag):
+        return not_modified(etag)
+
+    ret = jsonify({"service": srv.as_dict()})
+    ret.set_etag(etag)
+    return ret
+
+
 @service.route('/service', methods=['GET'])
+@replica_reads
 def service_info():
     secret = request.form.get('secret', '') or request.args.get('secret', '')
     service_ = request.form.get('service', '') or request.args.get('service', '')
@@ -33,19 +48,21 @@ def service_info():
         if not is_service(service_):
             return Error.INVALID_SERVICE
 
-        srv = Service.query.filter_by(public=service_).first()
+        use_shard(ShardDirectory.shard_for(service_))
+        srv = Service.active().filter_by(public=service_).first()
         if not srv:
             return Error.SERVICE_NOTFOUND
-        return jsonify({"service": srv.as_dict()})
+        return _service_info_response(srv)
 
     if secret:
         if not is_secret(secret):
             return Error.INVALID_SECRET
 
-        srv = Service.query.filter_by(secret=secret).first()
+        use_shard(ShardDirectory.shard_for(Service.public_for(secret)))
+        srv = Service.active().filter_by(secret=secret).first()
         if not srv:
             return Error.SERVICE_NOTFOUND
-        return jsonify({"service": srv.as_dict()})
+        return _service_info_response(srv)
 
     return Error.ARGUMENT_MISSING('service')
 
@@ -53,27 +70,31 @@ def service_info():
 @service.route('/service', methods=['DELETE'])
 @has_secret
 def service_delete(service):
-    subscriptions = service.subscribed().all()
-    messages = Message.query.filter_by(service=service).all()
+    # lookups fail from here on, the subscriptions (announced to the relay as
+    # they go) and messages are purged in batches in the background
+    service.deleted_at = datetime.utcnow()
+    db.session.commit()
+    purger.wake()
 
-    # In case we need to send this at a later point
-    # when the subscriptions have been deleted.
-    send_later = []
-    if cfg.zeromq_relay_uri:
-        for l in subscriptions:
-            send_later.append(json_encode({'subscription': l.as_dict()}))
+    return Error.NONE
 
-    map(db.session.delete, subscriptions)  # Delete all subscriptions
-    map(db.session.delete, messages)  # Delete all messages
-    db.session.delete(service)
 
+@service.route('/service/replay', methods=['POST'])
+@has_secret
+def service_replay(service):
+    """ retries the service's failed deliveries right away, optionally only those failed since/until (unix times) """
+    bounds = {}
+    for field in ['since', 'until']:
+        data = request.form.get(field, '').strip()
+        if data != '':
+            try:
+                bounds[field] = datetime.utcfromtimestamp(float(data))
+            except (ValueError, OverflowError, OSError):
+                return Error.ARGUMENT_INVALID(field)
+    replayed = DeadLetter.replay(service, **bounds)
     db.session.commit()
 
-    # Notify that the subscriptions have been deleted
-    if cfg.zeromq_relay_uri:
-        map(queue_zmq_message, send_later)
-
-    return Error.NONE
+    return jsonify({'replayed': replayed})
 
 
 @service.route('/service', methods=['PATCH'])
@@ -88,6 +109,24 @@ def service_patch(service):
             setattr(service, field, data)
             updated = True
 
+    # backlog caps, quotas and the coalescing window are the operator's, a service can only
+    # tighten the configured ones: lower a cap, 0 in the config being none, or widen the window
+    for field in ['backlog_max_messages', 'backlog_max_age', 'quota_messages', 'quota_notifications',
+                  'coalesce_window']:
+        data = request.form.get(field, '').strip()
+        if data != '':
+            if not data.isdigit():
+                return Error.ARGUMENT_INVALID(field)
+            value, default = int(data), getattr(cfg, field)
+            if field == 'coalesce_window':
+                looser = value < default
+            else:
+                looser = value == 0 or (default and value > default)
+            if looser:
+                return Error.ARGUMENT_INVALID(field)
+            setattr(service, field, value)
+            updated = True
+
     if updated:
         db.session.commit()
         return Error.NONE
@@ -0,0 +1,66 @@
+from hmac import compare_digest
+
+from flask import Blueprint, jsonify, request
+from dispatch import dispatcher
+from scheduler import scheduler
+from throttle import throttle
+from purge import purger
+from retry import retry_worker
+from models import DeadLetter
+from routing import each_shard
+from utils import Error
+from config import Config
+
+cfg = Config.get_global_instance()
+
+stats = Blueprint('stats', __name__)
+
+
+@stats.before_request
+def _operator_only():
+    """ the stats name the services sending, so they are for operators holding the configured stats_secret """
+    secret = request.args.get('secret', '')
+    if not cfg.stats_secret or not compare_digest(secret, cfg.stats_secret):
+        return Error.FORBIDDEN
+
+
+@stats.route('/stats/dispatch', methods=['GET'])
+def stats_dispatch():
+    """
+    dispatch backlog and queue wait per message level, and the scheduled
+    messages due soon
+    """
+    return jsonify({'levels': dispatcher.stats(), 'scheduled': scheduler.stats()})
+
+
+@stats.route('/stats/senders', methods=['GET'])
+def stats_senders():
+    """
+    the services with the highest fan-out cost, in device notifications
+    over the last minute, and how they are throttled
+    """
+    limit = request.args.get('limit', '10')
+    limit = int(limit) if limit.isdigit() else 10
+    return jsonify({'senders': throttle.top(limit)})
+
+
+@stats.route('/stats/purge', methods=['GET'])
+def stats_purge():
+    """
+    the deleted services being purged, with the rows deleted so far and in
+    total, and the number purged since the process started
+    """
+    return jsonify(purger.stats())
+
+
+@stats.route('/stats/retries', methods=['GET'])
+def stats_retries():
+    """
+    the failed deliveries waiting for a retry and those parked after using
+    up their attempts, and the retries made since the process started
+    """
+    waiting = parked = 0
+    for _ in each_shard():
+        waiting += DeadLetter.query.filter(DeadLetter.next_retry.isnot(None)).count()
+        parked += DeadLetter.query.filter(DeadLetter.next_retry.is_(None)).count()
+    return jsonify(dict(retry_worker.stats(), waiting=waiting, parked=parked))
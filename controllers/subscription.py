@@ -1,7 +1,15 @@
-from flask import Blueprint, jsonify
-from utils import Error, has_service, has_uuid, queue_zmq_message
+from datetime import datetime
+
+from flask import Blueprint, jsonify, request
+from utils import Error, has_service, has_uuid, queue_zmq_message, make_etag, is_not_modified, not_modified, \
+    replica_reads
 from shared import db
-from models import Subscription
+from compression import compressed
+from models import Service, Subscription, MQTT
+from models.mqtt import MQTT_MODE_SERVICE
+from models.tag import parse_tags
+from routing import each_shard
+from wire import negotiate_format, respond
 from json import dumps as json_encode
 from config import Config
 
@@ -14,25 +22,66 @@ subscription = Blueprint('subscription', __name__)
 @has_uuid
 @has_service
 def subscription_post(client, service):
-    exists = Subscription.query.filter_by(device=client).filter_by(service=service).first() is not None
-    if exists:
-        return Error.DUPLICATE_LISTEN
+    tags = parse_tags(request.form.get('tags'))
+    if tags is None:
+        return Error.ARGUMENT_INVALID('tags')
+
+    existing = Subscription.query.filter_by(device=client).filter_by(service=service).first()
+    if existing is not None:
+        if 'tags' not in request.form:
+            return Error.DUPLICATE_LISTEN
+        # subscribing again with tags retags the subscription
+        existing.set_tags(tags)
+        existing.timestamp_checked = datetime.utcnow()
+        db.session.commit()
+        return _subscribed(service)
 
     subscription_new = Subscription(client, service)
     db.session.add(subscription_new)
-    db.session.commit()
-
+    subscription_new.set_tags(tags)
     if cfg.zeromq_relay_uri:
+        db.session.flush()
         queue_zmq_message(json_encode({'subscription': subscription_new.as_dict()}))
+    db.session.commit()
+
+    return _subscribed(service)
 
-    return jsonify({'service': service.as_dict()})
+
+def _subscribed(service):
+    data = {'service': service.as_dict()}
+    if cfg.mqtt_broker_address and cfg.mqtt_delivery_mode == MQTT_MODE_SERVICE:
+        # the broker only fans out the service's messages to devices on its topic
+        data['topic'] = MQTT.service_topic(service)
+    return jsonify(data)
 
 
 @subscription.route('/subscription', methods=['GET'])
+@compressed
 @has_uuid
+@replica_reads
 def subscription_get(client):
-    subscriptions = Subscription.query.filter_by(device=client).all()
-    return jsonify({'subscriptions': [_.as_dict() for _ in subscriptions]})
+    versions = []
+    for shard in each_shard():
+        versions += [(shard,) + tuple(v) for v in
+                     db.session.query(Subscription.id, Subscription.timestamp_checked,
+                                      Service.id, Service.timestamp_updated)
+                     .join(Subscription.service)
+                     .filter(Subscription.device == client)
+                     .filter(Service.deleted_at.is_(None))
+                     .order_by(Subscription.id)]
+    format_ = negotiate_format()
+    etag = make_etag('subscription', format_, versions)
+    if is_not_modified(etag):
+        return not_modified(etag)
+
+    subscriptions = []
+    for _ in each_shard():
+        subscriptions += [_.as_dict() for _ in Subscription.query.join(Subscription.service)
+                          .filter(Subscription.device == client)
+                          .filter(Service.deleted_at.is_(None)).all()]
+    ret = respond({'subscriptions': subscriptions}, format_)
+    ret.set_etag(etag)
+    return ret
 
 
 @subscription.route('/subscription', methods=['DELETE'])
@@ -2,6 +2,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from shared import db
+from routing import shard_binds, is_sharded
 from config import Config
 
 cfg = Config.get_global_instance()
@@ -21,3 +22,11 @@ def init_db():
     import models
     db.create_all()
     Base.metadata.create_all(bind=engine)
+    init_shards(db.get_app())
+
+
+def init_shards(app):
+    """ creates the per service tables on shards 1..n """
+    tables = [t for t in db.Model.metadata.sorted_tables if is_sharded(t)]
+    for bind in shard_binds(app):
+        db.Model.metadata.create_all(bind=db.get_engine(app, bind=bind), tables=tables)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+""" streams the pushfish tables from one database to another, e.g. from the
+default SQLite file to MySQL
+
+usage: python dbtransfer.py <source uri> <target uri> [--chunk-size 5000]
+
+Rows are read in id order through a server side cursor and written with
+one multi-row insert per chunk, each chunk committed on its own, so memory
+use does not depend on the table size. Ids are copied as they are, which
+keeps Subscription.last_read pointing at the right messages. Running the
+same command again after an interruption resumes every table after the
+highest primary key already present in the target.
+"""
+import argparse
+import sys
+from time import monotonic
+
+from sqlalchemy import create_engine, func, select
+
+from config import Config
+
+# every table, in foreign key order. The outbox and relay checkpoints carry
+# the relay events not yet sent, the directory the services moved between shards
+TABLES = ['service', 'message', 'subscription', 'subscription_tag', 'gcm', 'MQTT', 'scheduled_message',
+          'dead_letter', 'idempotency_key', 'outbox', 'relay_checkpoint', 'shard_directory']
+
+
+def transfer_table(source, target, table, chunk_size, report=None):
+    """ copies the rows of table with a primary key above the highest one in target.
+    returns (rows, seconds) """
+    key, = table.primary_key.columns
+    with target.connect() as conn:
+        last_key = conn.execute(select([func.max(key)])).scalar()
+
+    start = monotonic()
+    rows = 0
+    with source.connect() as src:
+        query = select([table]).order_by(key)
+        if last_key is not None:
+            query = query.where(key > last_key)
+        result = src.execution_options(stream_results=True).execute(query)
+        while True:
+            chunk = result.fetchmany(chunk_size)
+            if not chunk:
+                break
+            with target.begin() as conn:
+                conn.execute(table.insert(), [dict(row) for row in chunk])
+            rows += len(chunk)
+            if report is not None:
+                report(table.name, rows, monotonic() - start)
+    return rows, monotonic() - start
+
+
+def _progress(name, rows, seconds):
+    print("\r{:<14} {:>10} rows {:>10.0f} rows/s".format(name, rows, rows / seconds if seconds else 0),
+          end="", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="streams the pushfish tables between databases")
+    parser.add_argument("source", help="SQLAlchemy URI to read from")
+    parser.add_argument("target", help="SQLAlchemy URI to write to, tables are created if missing")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    Config(create=True)
+    from shared import db
+    import models  # registers the tables on the metadata
+
+    source = create_engine(args.source)
+    target = create_engine(args.target)
+    tables = [db.Model.metadata.tables[name] for name in TABLES]
+    db.Model.metadata.create_all(bind=target, tables=tables)
+
+    total_rows, total_seconds = 0, 0.0
+    for table in tables:
+        rows, seconds = transfer_table(source, target, table, args.chunk_size, _progress)
+        print("\r{:<14} {:>10} rows {:>10.0f} rows/s".format(table.name, rows, rows / seconds if seconds else 0))
+        total_rows += rows
+        total_seconds += seconds
+    print("{:<14} {:>10} rows {:>10.0f} rows/s".format(
+        "total", total_rows, total_rows / total_seconds if total_seconds else 0))
+
+
+if __name__ == "__main__":
+    main()
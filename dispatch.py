@@ -0,0 +1,320 @@
+""" delivery of stored messages to the push channels, scheduled by level """
+import logging
+import heapq
+import threading
+from collections import deque
+from time import monotonic
+
+from shared import db
+from channels import registry, deliver_batches
+from routing import current_shard, use_shard
+from tracing import tracer
+from retry import retry_worker
+from wire import message_payload
+from throttle import THROTTLE_NONE, THROTTLE_QUEUE, THROTTLE_COALESCE
+from models import Message, Subscription, SubscriptionTag, DeadLetter
+from config import Config
+
+cfg = Config.get_global_instance()
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+DEFAULT_LEVEL = 3
+# share of the dispatch workers a level gets while every lane has a backlog
+LEVEL_WEIGHTS = {1: 1, 2: 2, 3: 4, 4: 8, 5: 16}
+
+
+def insert_message(message):
+    """ adds a new message to the session along with the writes that must commit with it """
+    db.session.add(message)
+    subscriptions = Subscription.query.filter_by(service_id=message.service.id)
+    if message.tags:
+        subscriptions = subscriptions.filter(Subscription.id.in_(
+            db.session.query(SubscriptionTag.subscription_id)
+            .filter(SubscriptionTag.service_id == message.service.id)
+            .filter(SubscriptionTag.tag.in_(message.tag_list()))))
+    subscriptions.update({Subscription.unread: Subscription.unread + 1}, synchronize_session=False)
+    for channel in registry.enabled():
+        channel.stage(message)
+
+
+def deliver_message(message, count=1):
+    """
+    pushes a stored message over every enabled channel at once and marks it
+    read for the devices that got it, see channels.Channel. With a count
+    above 1 it is the latest of count coalesced messages: the push carries
+    the count and nothing is marked read, the device fetches the rest with
+    GET /message; the pushes after it don't mark them read either, see
+    Subscription.mark_read. Devices a channel failed to reach are left to
+    retry.RetryWorker as a DeadLetter.
+    """
+    devices = Subscription.devices_of(message.service, message.tag_list())
+    with tracer.span('prepare'):
+        batches = [(channel, channel.prepare(message, devices)) for channel in registry.enabled()]
+    data = message_payload(message, count)
+    with tracer.span('deliver'):
+        outcomes = deliver_batches([(c, b) for c, b in batches if b], data)
+
+    delivered = set()
+    for outcome in outcomes:
+        with tracer.span(outcome.channel.name) as span:
+            reached = outcome.channel.report(message, outcome.batch, outcome.result)
+            if span is not None:
+                span.attributes.update({'devices': len(outcome.batch.devices), 'delivered': len(reached),
+                                        'network_ms': outcome.seconds * 1000, 'timed_out': outcome.timed_out})
+        delivered.update(reached)
+        failed = outcome.channel.failed(outcome.batch, outcome.result)
+        if failed:
+            db.session.add(DeadLetter(message, outcome.channel.name, failed, outcome.error or 'Unavailable', count,
+                                      retry_worker.next_retry(0)))
+    if delivered and count == 1:
+        Subscription.mark_read(message.service, sorted(delivered), message.id)
+
+    with tracer.span('cleanup'):
+        message.service.cleanup()
+        db.session.commit()
+
+
+class _Lane:
+    __slots__ = ('weight', 'queue', 'pass_', 'dispatched', 'wait_total', 'wait_max')
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.queue = deque()
+        self.pass_ = 0.0
+        self.dispatched = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class Dispatcher:
+    """
+    queues deliveries in one lane per message level and serves the lanes
+    by stride scheduling: every lane advances its pass by 1/weight when it
+    is served and the lane with the lowest pass goes next. An urgent message
+    therefore overtakes a backlog of bulk messages, while the low levels
+    still get their weighted share and never starve.
+
+    Without workers, submit delivers inline in the request as before.
+    Queued deliveries live in memory only; a message whose delivery is
+    lost with the process can still be fetched with GET /message.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.workers = []
+        self._deferred_worker = None
+        self._lanes = {level: _Lane(weight) for level, weight in LEVEL_WEIGHTS.items()}
+        self._vtime = 0.0
+        self._cond = threading.Condition()
+
+    def init_app(self, app, workers=0):
+        self.app = app
+        for i in range(workers):
+            self.workers.append(self._start_worker("pushfish-dispatch-{}".format(i)))
+
+    def _start_worker(self, name):
+        worker = threading.Thread(target=self._work, name=name, daemon=True)
+        worker.start()
+        return worker
+
+    def submit(self, message, count=1, defer=False):
+        """
+        delivers message, inline without workers. Deferred deliveries, of
+        throttled services, always go through the queue in the lowest lane
+        whatever their level; without workers a single one is started to
+        drain them, other messages keep being delivered inline.
+        """
+        if not self.workers and not defer:
+            deliver_message(message, count)
+            with self._cond:
+                self._record(self._lane(message.level), 0.0)
+            return
+
+        with self._cond:
+            if not self.workers and self._deferred_worker is None:
+                self._deferred_worker = self._start_worker("pushfish-dispatch-deferred")
+            self._enqueue((current_shard(), message.id, count), min(LEVEL_WEIGHTS) if defer else message.level)
+            self._cond.notify()
+
+    def stats(self):
+        """ backlog and queue wait in seconds per level """
+        now = monotonic()
+        with self._cond:
+            return {str(level): {
+                "queued": len(lane.queue),
+                "dispatched": lane.dispatched,
+                "wait_avg": lane.wait_total / lane.dispatched if lane.dispatched else 0.0,
+                "wait_max": lane.wait_max,
+                "oldest": now - lane.queue[0][0] if lane.queue else 0.0,
+            } for level, lane in self._lanes.items()}
+
+    def backlog(self):
+        with self._cond:
+            return sum(len(lane.queue) for lane in self._lanes.values())
+
+    def _lane(self, level):
+        return self._lanes.get(level, self._lanes[DEFAULT_LEVEL])
+
+    def _enqueue(self, item, level):
+        lane = self._lane(level)
+        if not lane.queue:
+            # a lane coming back from idle doesn't get credit for the time it was idle
+            lane.pass_ = max(lane.pass_, self._vtime)
+        lane.queue.append((monotonic(), item))
+
+    def _next(self):
+        busy = [lane for lane in self._lanes.values() if lane.queue]
+        if not busy:
+            return None
+        lane = min(busy, key=lambda l: (l.pass_, -l.weight))
+        self._vtime = lane.pass_
+        lane.pass_ += 1.0 / lane.weight
+        queued_at, item = lane.queue.popleft()
+        self._record(lane, monotonic() - queued_at)
+        return item
+
+    @staticmethod
+    def _record(lane, wait):
+        lane.dispatched += 1
+        lane.wait_total += wait
+        lane.wait_max = max(lane.wait_max, wait)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                item = self._next()
+                while item is None:
+                    self._cond.wait()
+                    item = self._next()
+            shard, message_id, count = item
+            try:
+                with self.app.app_context():
+                    use_shard(shard)
+                    message = Message.query.get(message_id)
+                    # gone with its service, or about to be
+                    if message is not None and message.service.deleted_at is None:
+                        deliver_message(message, count)
+            except Exception:
+                _LOGGER.exception("delivery of message %s on shard %s failed", message_id, shard)
+
+
+dispatcher = Dispatcher()
+
+
+class _Burst:
+    __slots__ = ('until', 'window', 'pending', 'latest')
+
+    def __init__(self, until, window):
+        self.until = until
+        self.window = window
+        self.pending = 0
+        self.latest = None
+
+
+class Coalescer:
+    """
+    collapses bursts of a service's messages into one push per coalescing
+    window. The first message of a burst is dispatched right away and opens
+    the window; the messages arriving while it is open are stored as usual
+    but held back, and when it closes the latest of them is dispatched once
+    with the number held back. A window that held messages back is opened
+    again, so a sustained burst costs one push per window. Services without
+    a window go straight to the dispatcher.
+
+    Windows are kept per process, like the dispatch lanes: with several API
+    processes each pushes at most once per window, and a push lost with the
+    process leaves the messages to GET /message.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.thread = None
+        self._bursts = {}
+        self._heap = []
+        self._cond = threading.Condition()
+
+    def init_app(self, app):
+        self.app = app
+
+    def submit(self, message, throttled=THROTTLE_NONE):
+        window = message.service.coalescing_window()
+        if throttled >= THROTTLE_COALESCE:
+            window = max(window, cfg.throttle_coalesce_window)
+        defer = throttled >= THROTTLE_QUEUE
+        if not window:
+            dispatcher.submit(message, defer=defer)
+            return
+
+        # messages for different audiences are not pushed as one
+        key = (current_shard(), message.service.id, message.tags)
+        now = monotonic()
+        with self._cond:
+            burst = self._bursts.get(key)
+            if burst is not None and burst.until > now:
+                burst.pending += 1
+                burst.latest = message.id
+                return
+            self._open(key, now, window)
+        dispatcher.submit(message, defer=defer)
+
+    def run_once(self, now=None):
+        """ closes the windows that have ended by now, returns the number of pushes made """
+        now = monotonic() if now is None else now
+        pushes = 0
+        while True:
+            with self._cond:
+                if not self._heap or self._heap[0][0] > now:
+                    return pushes
+                key, burst = self._close(now)
+            if burst is not None:
+                pushes += self._flush(key, burst)
+
+    def _open(self, key, now, window):
+        burst = _Burst(now + window, window)
+        self._bursts[key] = burst
+        heapq.heappush(self._heap, (burst.until, key))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="pushfish-coalescer", daemon=True)
+            self.thread.start()
+        self._cond.notify()
+
+    def _close(self, now):
+        """ pops the earliest window, returns it if it held messages back and reopens it """
+        until, key = heapq.heappop(self._heap)
+        burst = self._bursts.get(key)
+        if burst is None or burst.until != until:
+            return key, None
+        del self._bursts[key]
+        if not burst.pending:
+            return key, None
+        self._open(key, now, burst.window)
+        return key, burst
+
+    def _flush(self, key, burst):
+        shard = key[0]
+        with self.app.app_context():
+            use_shard(shard)
+            message = Message.query.get(burst.latest)
+            if message is None:
+                # evicted or deleted with its service in the meantime
+                return 0
+            dispatcher.submit(message, burst.pending)
+            return 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                wait = self._heap[0][0] - monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+            try:
+                self.run_once()
+            except Exception:
+                _LOGGER.exception("pushing coalesced messages failed")
+
+
+coalescer = Coalescer()
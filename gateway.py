@@ -0,0 +1,154 @@
+""" WebSocket gateway pushing messages to the devices connected to this process """
+import asyncio
+import logging
+import threading
+from http import HTTPStatus
+from json import dumps as json_encode
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from websockets.asyncio.server import serve, broadcast
+    from websockets.exceptions import ConnectionClosed
+except ImportError:
+    serve = broadcast = None
+
+from utils import is_uuid
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+SEND_TIMEOUT = 10  # seconds a send may wait for the gateway loop
+MAX_CLIENT_FRAME = 1024  # devices only ever send pings and close frames
+
+
+class Gateway:
+    """
+    accepts WebSocket connections on ws://host:port/?uuid=<device> and
+    pushes every message delivered to a connected device down its sockets,
+    as the same JSON the other channels send. The server runs on an asyncio
+    loop in a thread of its own; channels.WebSocketChannel hands it the
+    devices of each delivery from the dispatch threads.
+
+    The only state per connection is the socket in the device's tuple of
+    sockets. Permessage-deflate is off and frames from devices are capped,
+    so an idle connection costs little more than its socket buffers and a
+    single process holds tens of thousands of them.
+
+    A device only gets the pushes of the process it is connected to: with
+    several API processes, run the gateway in one of them, or let devices
+    fall back to GET /message.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.port = None
+        self._server = None
+        self._devices = {}
+
+    def running(self):
+        return self.loop is not None
+
+    def start(self, host, port, ping_interval=60):
+        """ starts serving, port 0 picks a free one. returns whether the gateway runs """
+        if serve is None:
+            _LOGGER.warning("WebSocket gateway disabled, please install websockets")
+            return False
+        started = threading.Event()
+        loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            try:
+                self._server = loop.run_until_complete(self._serve(host, port, ping_interval))
+                self.port = self._server.sockets[0].getsockname()[1]
+                self.loop = loop
+            except OSError:
+                _LOGGER.exception("WebSocket gateway failed to listen on %s:%s", host, port)
+                return
+            finally:
+                started.set()
+            loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="pushfish-gateway", daemon=True)
+        self.thread.start()
+        started.wait()
+        return self.running()
+
+    def stop(self):
+        loop, self.loop = self.loop, None
+        if loop is None:
+            return
+
+        async def close():
+            self._server.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), loop).result(SEND_TIMEOUT)
+        loop.call_soon_threadsafe(loop.stop)
+        self.thread.join(SEND_TIMEOUT)
+        self._devices = {}
+
+    async def _serve(self, host, port, ping_interval):
+        return await serve(self._handle, host or None, port,
+                           process_request=self._authenticate,
+                           compression=None,
+                           max_size=MAX_CLIENT_FRAME,
+                           max_queue=1,
+                           ping_interval=ping_interval or None,
+                           ping_timeout=ping_interval or None,
+                           server_header=None)
+
+    @staticmethod
+    def _device(path):
+        return parse_qs(urlsplit(path).query).get('uuid', [''])[0]
+
+    def _authenticate(self, connection, request):
+        if not is_uuid(self._device(request.path)):
+            return connection.respond(HTTPStatus.BAD_REQUEST, "Invalid client uuid\n")
+        return None
+
+    async def _handle(self, connection):
+        device = self._device(connection.request.path)
+        self._devices[device] = self._devices.get(device, ()) + (connection,)
+        try:
+            async for _ in connection:
+                pass
+        except ConnectionClosed:
+            # dropped without a closing handshake, or its pings timed out
+            pass
+        finally:
+            sockets = tuple(s for s in self._devices.get(device, ()) if s is not connection)
+            if sockets:
+                self._devices[device] = sockets
+            else:
+                self._devices.pop(device, None)
+
+    def connected(self, devices):
+        """ the devices among devices with an open connection """
+        return [d for d in devices if d in self._devices]
+
+    def stats(self):
+        devices = list(self._devices.values())
+        return {'devices': len(devices), 'connections': sum(len(s) for s in devices)}
+
+    def send(self, devices, data):
+        """ pushes data to the connected devices among devices, from any thread. returns those devices """
+        loop = self.loop
+        if loop is None:
+            return []
+        return asyncio.run_coroutine_threadsafe(self._send(devices, json_encode(data)), loop).result(SEND_TIMEOUT)
+
+    async def _send(self, devices, payload):
+        sent, sockets = [], []
+        for device in devices:
+            connections = self._devices.get(device)
+            if connections:
+                sent.append(device)
+                sockets += connections
+        # writes to every socket without waiting for any; what a slow reader
+        # doesn't take piles up in its buffer until its pings time out
+        broadcast(sockets, payload)
+        return sent
+
+
+gateway = Gateway()
@@ -0,0 +1,166 @@
+""" liveness and readiness reports, cached so frequent probes cost nothing """
+import logging
+import os
+import socket
+import threading
+from time import monotonic
+
+from sqlalchemy import text
+
+from shared import db, zmq_relay_socket
+from dispatch import dispatcher
+from scheduler import scheduler
+from gateway import gateway
+from routing import each_shard, shard_binds
+from models import Outbox, Service
+from config import Config
+
+cfg = Config.get_global_instance()
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+PROBE_TIMEOUT = 1.0  # seconds a broker connection attempt may take
+
+
+def resolve_version(root=None):
+    """ the abbreviated commit of the checkout, PUSHFISH_VERSION outside of one """
+    root = root or os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.path.join(root, '.git', 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head[:7]
+        ref = head[5:]
+        ref_path = os.path.join(root, '.git', ref)
+        if os.path.exists(ref_path):
+            with open(ref_path) as f:
+                return f.read().strip()[:7]
+        with open(os.path.join(root, '.git', 'packed-refs')) as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return line[:7]
+    except OSError:
+        pass
+    return os.getenv('PUSHFISH_VERSION', 'unknown')
+
+
+def _pool_stats(engine):
+    pool = engine.pool
+    stats = {'class': type(pool).__name__}
+    # only QueuePool keeps these, SQLite's pools don't
+    for name in ('size', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    max_overflow = getattr(pool, '_max_overflow', None)
+    if 'size' in stats and max_overflow is not None and max_overflow >= 0:
+        stats['saturated'] = stats['checkedout'] >= stats['size'] + max_overflow
+    return stats
+
+
+class Health:
+    """
+    collects the state of the database shards and their pools, the ZMQ
+    relay, the MQTT broker, the WebSocket gateway and dispatch. The report is built at most once
+    every ttl seconds; probes arriving in between, or while it is being
+    built, get the last one.
+
+    The process is ready when every database shard answers and has the
+    schema. The relays, the broker and the gateway are reported but don't
+    make it unready: they are shared or degrade to GET /message and the
+    dead letters, and draining every instance would not bring them back.
+    Neither do pool saturation and backlogs, shedding traffic would not
+    drain them.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.ttl = 5
+        self.relay_pump = None
+        self.version = resolve_version()
+        self.started = monotonic()
+        self._report = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def init_app(self, app, ttl=5, relay_pump=None):
+        self.app = app
+        self.ttl = ttl
+        self.relay_pump = relay_pump
+
+    def report(self):
+        """ (ready, report), at most ttl seconds old """
+        if self._report is None or monotonic() >= self._expires:
+            # a single probe refreshes, the others keep getting the previous report
+            if self._lock.acquire(blocking=self._report is None):
+                try:
+                    if self._report is None or monotonic() >= self._expires:
+                        self._report = self.check()
+                        self._expires = monotonic() + self.ttl
+                finally:
+                    self._lock.release()
+        return self._report
+
+    def check(self):
+        checks = {'database': self._database(), 'zmq': self._zmq(), 'mqtt': self._mqtt(),
+                  'websocket': self._websocket(), 'dispatch': self._dispatch()}
+        ready = checks['database']['ok']
+        return ready, dict(checks, ready=ready, version=self.version, uptime=int(monotonic() - self.started))
+
+    def _database(self):
+        shards = []
+        for shard, bind in enumerate([None] + shard_binds(self.app)):
+            engine = db.get_engine(self.app, bind=bind)
+            state = {'shard': shard}
+            try:
+                with engine.connect() as conn:
+                    conn.execute(text('SELECT 1'))
+                    state['ok'] = engine.dialect.has_table(conn, Service.__tablename__)
+                if not state['ok']:
+                    state['error'] = 'schema missing'
+            except Exception as err:
+                state.update(ok=False, error=str(err).splitlines()[0])
+            state['pool'] = _pool_stats(engine)
+            shards.append(state)
+        return {'ok': all(s['ok'] for s in shards), 'shards': shards}
+
+    def _zmq(self):
+        if not cfg.zeromq_relay_uri:
+            return {'enabled': False}
+        state = {'enabled': True,
+                 'socket': zmq_relay_socket is not None and not zmq_relay_socket.closed,
+                 'pump': self.relay_pump is not None and self.relay_pump.is_alive()}
+        try:
+            # entries not yet handed to the socket
+            state['pending'] = sum(Outbox.query.count() for _ in each_shard())
+        except Exception:
+            db.session.rollback()
+            state['pending'] = None
+        state['ok'] = state['socket'] and state['pump']
+        return state
+
+    def _mqtt(self):
+        address = cfg.mqtt_broker_address
+        if not address:
+            return {'enabled': False}
+        host, _, port = address.partition(':')
+        try:
+            # deliveries connect per message, so reachable is as connected as it gets
+            socket.create_connection((host, int(port or 1883)), PROBE_TIMEOUT).close()
+            return {'enabled': True, 'ok': True}
+        except (OSError, ValueError) as err:
+            return {'enabled': True, 'ok': False, 'error': str(err)}
+
+    @staticmethod
+    def _websocket():
+        if not cfg.websocket_port:
+            return {'enabled': False}
+        return dict(gateway.stats(), enabled=True, ok=gateway.running())
+
+    @staticmethod
+    def _dispatch():
+        return {'backlog': dispatcher.backlog(),
+                'workers': sum(w.is_alive() for w in dispatcher.workers),
+                'scheduled': scheduler.stats()['loaded']}
+
+
+monitor = Health()
@@ -0,0 +1,87 @@
+""" background upkeep of the active services: backlog caps and subscription expiry """
+import logging
+import threading
+from time import sleep
+
+from sqlalchemy import or_
+
+from shared import db
+from routing import each_shard
+from models import Service
+from purge import delete_subscriptions
+from config import Config
+
+cfg = Config.get_global_instance()
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+
+class Housekeeper:
+    """
+    applies the backlog cap of every service with one (Service.evict) and
+    deletes the subscriptions inactive for subscription_expiry_days,
+    announcing them to the ZMQ relay like DELETE /subscription does. This
+    runs every interval seconds instead of on every poll and delivery, so
+    neither pays for the extra queries. Every service, and every batch_size
+    expired subscriptions, commits on its own. Any process may run it, two
+    evicting the same service compute the same cutoff.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.interval = 300
+        self.batch_size = 500
+        self.thread = None
+
+    def init_app(self, app, interval=300, batch_size=500):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.thread = threading.Thread(target=self._run, name="pushfish-housekeeping", daemon=True)
+        self.thread.start()
+
+    def run_once(self):
+        """ goes over every active service once, returns (services evicted from, subscriptions expired) """
+        evicted = expired = 0
+        with self.app.app_context():
+            for _ in each_shard():
+                services = Service.active().order_by(Service.id)
+                if not (cfg.backlog_max_messages or cfg.backlog_max_age or cfg.subscription_expiry_days):
+                    # only services with caps of their own need anything
+                    services = services.filter(or_(Service.backlog_max_messages > 0, Service.backlog_max_age > 0))
+                last_id = 0
+                while True:
+                    batch = services.filter(Service.id > last_id).limit(self.batch_size).all()
+                    if not batch:
+                        break
+                    for service in batch:
+                        evicted += 1 if service.evict() else 0
+                        db.session.commit()
+                        expired += self.expire(service)
+                    last_id = batch[-1].id
+        return evicted, expired
+
+    def expire(self, service):
+        """ deletes the expired subscriptions of service, returns their number """
+        days = cfg.subscription_expiry_days
+        if not days:
+            return 0
+        expired = 0
+        while True:
+            subscriptions = service.expired_subscriptions(days).limit(self.batch_size).all()
+            if not subscriptions:
+                return expired
+            delete_subscriptions(subscriptions)
+            db.session.commit()
+            expired += len(subscriptions)
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                _LOGGER.exception("applying backlog caps and subscription expiry failed")
+
+
+housekeeper = Housekeeper()
@@ -1,5 +1,11 @@
 from .service import Service
 from .message import Message
 from .subscription import Subscription
+from .tag import SubscriptionTag
 from .gcm import Gcm
 from .mqtt import MQTT
+from .outbox import Outbox, RelayCheckpoint
+from .idempotency import IdempotencyKey
+from .shard import ShardDirectory
+from .scheduled import ScheduledMessage
+from .deadletter import DeadLetter
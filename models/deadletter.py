@@ -0,0 +1,68 @@
+from shared import db
+from datetime import datetime
+from json import dumps as json_encode, loads as json_decode
+from sqlalchemy import Integer
+
+
+class DeadLetter(db.Model):
+    """
+    a delivery of a message over a channel that failed for some devices,
+    waiting for retry.RetryWorker to try those devices again at next_retry.
+    A letter that used up its attempts is parked with next_retry None until
+    it is replayed
+    """
+    __table_args__ = {'info': {'sharded': True}}
+
+    id = db.Column(Integer, primary_key=True)
+    service_id = db.Column(Integer, db.ForeignKey('service.id'), nullable=False, index=True)
+    # not a foreign key, like Subscription.last_read: the message may be evicted meanwhile
+    message_id = db.Column(Integer, nullable=False)
+    count = db.Column(Integer, nullable=False, default=1)
+    channel = db.Column(db.VARCHAR(20), nullable=False)
+    devices = db.Column(db.TEXT, nullable=False)
+    error = db.Column(db.VARCHAR(100), nullable=False)
+    attempts = db.Column(Integer, nullable=False, default=0)
+    next_retry = db.Column(db.TIMESTAMP, nullable=True, index=True)
+    timestamp_created = db.Column(db.TIMESTAMP, default=datetime.utcnow)
+
+    def __init__(self, message, channel, devices, error, count=1, next_retry=None):
+        self.service_id = message.service.id
+        self.message_id = message.id
+        self.count = count
+        self.channel = channel
+        self.device_list = devices
+        self.error = error[:100]
+        self.attempts = 0
+        self.next_retry = next_retry
+
+    def __repr__(self):
+        return '<DeadLetter {} {}>'.format(self.channel, self.message_id)
+
+    @property
+    def device_list(self):
+        return json_decode(self.devices)
+
+    @device_list.setter
+    def device_list(self, devices):
+        self.devices = json_encode(sorted(devices))
+
+    def failed_again(self, devices, error, next_retry):
+        """ counts a retry that still missed devices, next_retry None parks the letter """
+        self.device_list = devices
+        self.error = error[:100]
+        self.attempts += 1
+        self.next_retry = next_retry
+
+    @staticmethod
+    def replay(service=None, since=None, until=None):
+        """ schedules the letters of service, or of all services, created between since and until
+        for an immediate retry with their attempts reset. returns their number """
+        letters = DeadLetter.query
+        if service is not None:
+            letters = letters.filter(DeadLetter.service_id == service.id)
+        if since is not None:
+            letters = letters.filter(DeadLetter.timestamp_created >= since)
+        if until is not None:
+            letters = letters.filter(DeadLetter.timestamp_created < until)
+        return letters.update({DeadLetter.attempts: 0, DeadLetter.next_retry: datetime.utcnow()},
+                              synchronize_session=False)
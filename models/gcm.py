@@ -3,13 +3,23 @@ from shared import db
 from sqlalchemy import Integer
 from datetime import datetime
 from config import Config
-from models import Subscription, Message
+from time import sleep
+import logging
 import requests
 
 cfg = Config.get_global_instance()
 
+_LOGGER = logging.getLogger(name="pushfish_API")
+
 gcm_url = 'https://android.googleapis.com/gcm/send'
 
+GCM_BATCH_SIZE = 1000  # registration ids per multicast request
+GCM_TIMEOUT = 10
+GCM_RETRIES = 3
+GCM_BACKOFF = 1  # seconds before the first retry, doubled for every further one
+GCM_DEAD_ERRORS = ('NotRegistered', 'InvalidRegistration', 'MissingRegistration')
+GCM_RETRY_ERRORS = ('Unavailable', 'InternalServerError')
+
 
 class Gcm(db.Model):
     id = db.Column(Integer, primary_key=True)
@@ -33,38 +43,89 @@ class Gcm(db.Model):
         return data
 
     @staticmethod
-    def send_message(message):
+    def gcm_send(ids, data, retries=GCM_RETRIES, backoff=GCM_BACKOFF):
         """
+        sends data to the registration ids, in multicast batches of at most
+        GCM_BATCH_SIZE. Unavailable errors are retried with exponential backoff.
 
-        :type message: Message
+        :return: (delivered, dead, canonical): the ids that got the message,
+        the ids GCM no longer knows and a dict of ids GCM wants replaced
         """
-        subscriptions = Subscription.query.filter_by(service=message.service).all()
-        if len(subscriptions) == 0:
-            return 0
-        gcm_devices = Gcm.query.filter(Gcm.uuid.in_([l.device for l in subscriptions])).all()
-
-        if len(gcm_devices) > 0:
-            data = dict(message=message.as_dict(), encrypted=False)
-            Gcm.gcm_send([r.gcmid for r in gcm_devices], data)
-
-        if len(gcm_devices) > 0:
-            uuids = [g.uuid for g in gcm_devices]
-            gcm_subscriptions = Subscription.query.filter_by(service=message.service).filter(
-                Subscription.device.in_(uuids)).all()
-            last_message = Message.query.order_by(Message.id.desc()).first()
-            for l in gcm_subscriptions:
-                l.timestamp_checked = datetime.utcnow()
-                l.last_read = last_message.id if last_message else 0
-            db.session.commit()
-        return len(gcm_devices)
+        delivered, dead, canonical = set(), set(), {}
+        for start in range(0, len(ids), GCM_BATCH_SIZE):
+            pending = ids[start:start + GCM_BATCH_SIZE]
+            for attempt in range(retries + 1):
+                if attempt:
+                    sleep(backoff * 2 ** (attempt - 1))
+                response = Gcm._post(pending, data)
+                if response is None:
+                    # the whole request failed, try the batch again
+                    continue
+                ok, gone, replaced, pending = Gcm.parse_response(pending, response)
+                delivered.update(ok)
+                dead.update(gone)
+                canonical.update(replaced)
+                if not pending:
+                    break
+            if pending:
+                _LOGGER.warning("GCM unavailable for %d registrations after %d retries", len(pending), retries)
+        return delivered, dead, canonical
 
     @staticmethod
-    def gcm_send(ids, data):
-        url = 'https://android.googleapis.com/gcm/send'
+    def _post(ids, data):
+        """ one multicast request, returns the decoded response or None if it should be retried """
         headers = dict(Authorization='key={}'.format(cfg.google_api_key))
         data = dict(registration_ids=ids, data=data)
 
         if current_app.config['TESTING'] is True:
             current_app.config['TESTING_GCM'].append(data)
-        else:
-            requests.post(url, json=data, headers=headers)
+            responses = current_app.config.get('TESTING_GCM_RESPONSES')
+            if responses:
+                return responses.pop(0)
+            return dict(results=[dict(message_id=str(i)) for i in range(len(ids))])
+
+        try:
+            rv = requests.post(gcm_url, json=data, headers=headers, timeout=GCM_TIMEOUT)
+        except requests.RequestException as err:
+            _LOGGER.warning("GCM request failed: %s", err)
+            return None
+        if rv.status_code >= 500:
+            return None
+        if rv.status_code != 200:
+            # bad key or malformed request, retrying won't help
+            _LOGGER.error("GCM rejected request with status %d", rv.status_code)
+            return dict(results=[])
+        return rv.json()
+
+    @staticmethod
+    def parse_response(ids, response):
+        """
+        maps the per-registration results of a multicast response back to ids
+        :return: (delivered, dead, canonical, retry)
+        """
+        delivered, dead, canonical, retry = [], [], {}, []
+        for regid, result in zip(ids, response.get('results', [])):
+            error = result.get('error')
+            if error is None:
+                delivered.append(regid)
+                if result.get('registration_id'):
+                    canonical[regid] = result['registration_id']
+            elif error in GCM_DEAD_ERRORS:
+                dead.append(regid)
+            elif error in GCM_RETRY_ERRORS:
+                retry.append(regid)
+            else:
+                _LOGGER.warning("GCM error %s for a registration", error)
+        return delivered, dead, canonical, retry
+
+    @staticmethod
+    def prune(dead, canonical):
+        """ deletes registrations GCM reported dead and rewrites canonical ids, in bulk """
+        if dead:
+            Gcm.query.filter(Gcm.gcmid.in_(list(dead))).delete(synchronize_session=False)
+        for old, new in canonical.items():
+            if Gcm.query.filter_by(gcmid=new).first() is not None:
+                # the device already registered its canonical id
+                Gcm.query.filter_by(gcmid=old).delete(synchronize_session=False)
+            else:
+                Gcm.query.filter_by(gcmid=old).update({Gcm.gcmid: new}, synchronize_session=False)
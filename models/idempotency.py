@@ -0,0 +1,48 @@
+from shared import db
+from datetime import datetime, timedelta
+from hashlib import sha1
+from sqlalchemy import Integer
+
+
+class IdempotencyKey(db.Model):
+    """ keys of recent message submissions, so retries are not fanned out twice """
+    __table_args__ = (db.UniqueConstraint('service_id', 'digest'), {'info': {'sharded': True}})
+
+    id = db.Column(Integer, primary_key=True)
+    service_id = db.Column(Integer, db.ForeignKey('service.id'), nullable=False)
+    digest = db.Column(db.VARCHAR(40), nullable=False)
+    message_id = db.Column(Integer)
+    timestamp_created = db.Column(db.TIMESTAMP, default=datetime.utcnow)
+
+    def __init__(self, service, key, message=None):
+        self.service_id = service.id
+        self.digest = IdempotencyKey.digest_of(key)
+        self.message_id = message.id if message else None
+
+    def __repr__(self):
+        return '<IdempotencyKey {}>'.format(self.digest)
+
+    @staticmethod
+    def digest_of(key):
+        # fixed width regardless of what the sender uses as a key
+        return sha1(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def seen(service, key, ttl):
+        """ whether the service used key within the last ttl seconds. An older use of it
+        is dropped, the unique constraint would turn the new send into a no-op otherwise """
+        keys = IdempotencyKey.query.filter_by(service_id=service.id, digest=IdempotencyKey.digest_of(key))
+        expiry = datetime.utcnow() - timedelta(seconds=ttl)
+        keys.filter(IdempotencyKey.timestamp_created < expiry).delete(synchronize_session=False)
+        return keys.filter(IdempotencyKey.timestamp_created >= expiry).first() is not None
+
+    @staticmethod
+    def evict(service, ttl, max_keys):
+        """ drops keys older than ttl seconds and all but the newest max_keys of the service """
+        keys = IdempotencyKey.query.filter_by(service_id=service.id)
+        keys.filter(IdempotencyKey.timestamp_created < datetime.utcnow() - timedelta(seconds=ttl)) \
+            .delete(synchronize_session=False)
+
+        cutoff = keys.order_by(IdempotencyKey.id.desc()).offset(max_keys).first()
+        if cutoff is not None:
+            keys.filter(IdempotencyKey.id <= cutoff.id).delete(synchronize_session=False)
@@ -1,27 +1,49 @@
 from shared import db
 from datetime import datetime
 from sqlalchemy import Integer, Unicode
+from compression import pack_text, unpack_text
 
 
 class Message(db.Model):
+    __table_args__ = {'info': {'sharded': True}}
+
     id = db.Column(Integer, primary_key=True)
     service_id = db.Column(Integer, db.ForeignKey('service.id'),
                            nullable=False)
     service = db.relationship('Service', backref=db.backref('message',
                                                             lazy='dynamic',
                                                             cascade="delete"))
-    text = db.Column(db.TEXT, nullable=False)
+    _text = db.Column('text', db.TEXT, nullable=False)
+    # set instead of text for large bodies when text_compression_threshold is configured
+    text_packed = db.Column(db.LargeBinary)
     title = db.Column(Unicode(length=255))
     level = db.Column(Integer, nullable=False, default=0)
     link = db.Column(db.TEXT, nullable=False, default='')
+    # ',tag,...,' of the subscriptions the message targets, None for all of them
+    tags = db.Column(db.TEXT, nullable=True)
     timestamp_created = db.Column(db.TIMESTAMP, default=datetime.utcnow)
 
-    def __init__(self, service, text, title=None, level=0, link=''):
+    def __init__(self, service, text, title=None, level=0, link='', tags=None):
         self.service = service
         self.text = text
         self.title = title
         self.level = level
         self.link = link
+        self.tags = tags
+
+    @property
+    def text(self):
+        if self.text_packed is not None:
+            return unpack_text(self.text_packed)
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self.text_packed = pack_text(text)
+        self._text = text if self.text_packed is None else ''
+
+    def tag_list(self):
+        return self.tags.strip(',').split(',') if self.tags else []
 
     def __repr__(self):
         return '<Message {}>'.format(self.id)
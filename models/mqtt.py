@@ -2,12 +2,17 @@ from shared import db
 from sqlalchemy import Integer
 from datetime import datetime
 from config import Config
-from models import Subscription, Message
+from models import Subscription
+from routing import each_shard
+from wire import encode, payload_format
 import paho.mqtt.client as mqtt_api
 
 
 cfg = Config.get_global_instance()
 
+MQTT_MODE_DEVICE = 'device'
+MQTT_MODE_SERVICE = 'service'
+
 
 class MQTT(db.Model):
     id = db.Column(Integer, primary_key=True)
@@ -28,36 +33,26 @@ class MQTT(db.Model):
         return data
 
     @staticmethod
-    def send_message(message):
-        """
-
-        :type message: Message to send to mqtt subscribers
-        """
-        subscriptions = Subscription.query.filter_by(service=message.service).all()
-        if len(subscriptions) == 0:
-            return 0
-        mqtt_devices = MQTT.query.filter(MQTT.uuid.in_([l.device for l in subscriptions])).all()
+    def service_topic(service):
+        return 'service/{}'.format(service.public)
 
-        if len(mqtt_devices) > 0:
-            data = dict(message=message.as_dict(), encrypted=False)
-            MQTT.mqtt_send([r.uuid for r in mqtt_devices], data)
-
-        if len(mqtt_devices) > 0:
-            uuids = [g.uuid for g in mqtt_devices]
-            mqtt_subscriptions = Subscription.query.filter_by(service=message.service).filter(
-                Subscription.device.in_(uuids)).all()
-            last_message = Message.query.order_by(Message.id.desc()).first()
-            for l in mqtt_subscriptions:
-                l.timestamp_checked = datetime.utcnow()
-                l.last_read = last_message.id if last_message else 0
-            db.session.commit()
-        return len(mqtt_devices)
+    @staticmethod
+    def topics_for(device):
+        """ the topics a device should subscribe to in the configured delivery mode, its own
+        uuid topic always being one for messages sent with tags """
+        if cfg.mqtt_delivery_mode != MQTT_MODE_SERVICE:
+            return [device]
+        topics = [device]
+        for _ in each_shard():
+            subscriptions = Subscription.query.filter_by(device=device).all()
+            topics += [MQTT.service_topic(l.service) for l in subscriptions if l.service.deleted_at is None]
+        return topics
 
     @staticmethod
-    def mqtt_send(uuids, data):
+    def mqtt_send(topics, data):
         url = cfg.mqtt_broker_address
         if ":" in url:
-            port = url.split(":")[1]
+            port = int(url.split(":")[1])
             url = url .split(":")[0]
         else:
             # default port
@@ -65,7 +60,14 @@ class MQTT(db.Model):
 
         client = mqtt_api.Client()
         client.connect(url, port, 60)
+        client.loop_start()
 
-        for uuid in uuids:
-            client.publish(uuid, str(data))
+        payload = encode(data, payload_format(cfg.mqtt_payload_format))
+        info = None
+        for topic in topics:
+            info = client.publish(topic, payload)
+        # publish only queues, flush before disconnecting
+        if info is not None:
+            info.wait_for_publish()
         client.disconnect()
+        client.loop_stop()
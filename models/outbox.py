@@ -0,0 +1,37 @@
+from shared import db
+from datetime import datetime
+from sqlalchemy import Integer
+
+
+class Outbox(db.Model):
+    """ relay events, written in the same transaction as the change they announce """
+    __table_args__ = {'info': {'sharded': True}}
+
+    id = db.Column(Integer, primary_key=True)
+    payload = db.Column(db.TEXT, nullable=False)
+    timestamp_created = db.Column(db.TIMESTAMP, default=datetime.utcnow)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __repr__(self):
+        return '<Outbox {}>'.format(self.id)
+
+
+class RelayCheckpoint(db.Model):
+    """ progress of a relay pump, doubling as the lease that keeps
+    several API workers from draining the outbox at the same time """
+    name = db.Column(db.VARCHAR(40), primary_key=True)
+    owner = db.Column(db.VARCHAR(40))
+    lease_expires = db.Column(db.TIMESTAMP)
+    last_id = db.Column(Integer, nullable=False, default=0)
+    relayed = db.Column(Integer, nullable=False, default=0)
+    timestamp_checked = db.Column(db.TIMESTAMP)
+
+    def __init__(self, name):
+        self.name = name
+        self.last_id = 0
+        self.relayed = 0
+
+    def __repr__(self):
+        return '<RelayCheckpoint {}: {}>'.format(self.name, self.last_id)
@@ -0,0 +1,38 @@
+from shared import db
+from datetime import datetime
+from sqlalchemy import Integer, Unicode
+from .message import Message
+
+
+class ScheduledMessage(db.Model):
+    """ a message waiting for its deliver_at, see scheduler.Scheduler. It only
+    becomes a Message when it is due, so it gets an id in delivery order """
+    __table_args__ = {'info': {'sharded': True}}
+
+    id = db.Column(Integer, primary_key=True)
+    service_id = db.Column(Integer, db.ForeignKey('service.id'), nullable=False)
+    service = db.relationship('Service', backref=db.backref('scheduled',
+                                                            lazy='dynamic',
+                                                            cascade="delete"))
+    text = db.Column(db.TEXT, nullable=False)
+    title = db.Column(Unicode(length=255))
+    level = db.Column(Integer, nullable=False, default=0)
+    link = db.Column(db.TEXT, nullable=False, default='')
+    tags = db.Column(db.TEXT, nullable=True)
+    deliver_at = db.Column(db.TIMESTAMP, nullable=False, index=True)
+    timestamp_created = db.Column(db.TIMESTAMP, default=datetime.utcnow)
+
+    def __init__(self, service, text, title=None, level=0, link='', deliver_at=None, tags=None):
+        self.service = service
+        self.text = text
+        self.title = title
+        self.level = level
+        self.link = link
+        self.deliver_at = deliver_at
+        self.tags = tags
+
+    def __repr__(self):
+        return '<ScheduledMessage {}>'.format(self.id)
+
+    def to_message(self):
+        return Message(self.service, self.text, self.title, self.level, self.link, self.tags)
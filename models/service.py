@@ -1,46 +1,132 @@
 from shared import db
-from datetime import datetime
-from sqlalchemy import Integer
+from datetime import datetime, timedelta
+from sqlalchemy import Integer, case, func
+from config import Config
 import hashlib
 from os import urandom
 from .subscription import Subscription
 from .message import Message
 
+cfg = Config.get_global_instance()
+
 
 class Service(db.Model):
+    __table_args__ = {'info': {'sharded': True}}
+
     id = db.Column(Integer, primary_key=True)
     secret = db.Column(db.VARCHAR(32), nullable=False)
     public = db.Column(db.VARCHAR(40), nullable=False)
     name = db.Column(db.Unicode(length=255), nullable=False)
     icon = db.Column(db.TEXT, nullable=False, default='')
     timestamp_created = db.Column(db.TIMESTAMP, default=datetime.utcnow)
+    timestamp_updated = db.Column(db.TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # backlog caps overriding the configured defaults, 0 for no cap
+    backlog_max_messages = db.Column(Integer, nullable=True)
+    backlog_max_age = db.Column(Integer, nullable=True)
+    # seconds over which bursts of messages are pushed as one, overriding the configured default
+    coalesce_window = db.Column(Integer, nullable=True)
+    # messages and device notifications per minute before throttling, overriding the configured defaults
+    quota_messages = db.Column(Integer, nullable=True)
+    quota_notifications = db.Column(Integer, nullable=True)
+    # set by DELETE /service, the rows are then removed by purge.Purger
+    deleted_at = db.Column(db.TIMESTAMP, nullable=True, index=True)
 
     def __init__(self, name, icon=''):
         self.secret = hashlib.sha1(urandom(100)).hexdigest()[:32]
         self.name = name
         self.icon = icon
-        pub = list(hashlib.new('ripemd160', self.secret.encode("UTF-8")).hexdigest())[:40]
+        self.public = Service.public_for(self.secret)
+
+    @staticmethod
+    def public_for(secret):
+        pub = list(hashlib.new('ripemd160', secret.encode("UTF-8")).hexdigest())[:40]
         sep = [4, 11, 24, 30]
         for s in sep:
             pub[s] = '-'
-        self.public = ''.join(pub)
+        return ''.join(pub)
 
     def __repr__(self):
         return '<Service {}: {}>'.format(self.id, self.name)
 
+    @staticmethod
+    def active():
+        """ the services that have not been deleted """
+        return Service.query.filter(Service.deleted_at.is_(None))
+
     def cleanup(self):
-        threshold = self.subscribed().order_by(Subscription.last_read.asc()).first().last_read
+        """ deletes the messages every subscriber has read, the backlog cap is applied by
+        housekeeping.Housekeeper """
+        threshold = db.session.query(func.min(func.coalesce(Subscription.last_read, 0))) \
+            .filter(Subscription.service_id == self.id).scalar()
 
         # Nothing to do
         if not threshold:
             return
 
-        messages = Message.query \
-            .filter_by(service=self) \
-            .filter(threshold > Message.id) \
-            .all()
+        Message.query \
+            .filter_by(service_id=self.id) \
+            .filter(Message.id < threshold) \
+            .delete(synchronize_session=False)
+
+    def backlog_limits(self):
+        """ (messages, seconds) the backlog is capped at, 0 for no cap """
+        max_messages = self.backlog_max_messages
+        max_age = self.backlog_max_age
+        return (cfg.backlog_max_messages if max_messages is None else max_messages,
+                cfg.backlog_max_age if max_age is None else max_age)
+
+    def coalescing_window(self):
+        """ seconds over which bursts are pushed as one notification, 0 if every message is pushed """
+        return cfg.coalesce_window if self.coalesce_window is None else self.coalesce_window
+
+    def quotas(self):
+        """ (messages, notifications) per minute the service may send unthrottled, 0 for no quota """
+        return (cfg.quota_messages if self.quota_messages is None else self.quota_messages,
+                cfg.quota_notifications if self.quota_notifications is None else self.quota_notifications)
+
+    def evict(self):
+        """
+        deletes the messages beyond the backlog cap, oldest first. Subscribers
+        that had not read them yet, and would have seen them going by their
+        tags, get them counted in Subscription.dropped.
+        returns the id of the newest evicted message, or 0
+        """
+        max_messages, max_age = self.backlog_limits()
+        cutoff = 0
+        if max_messages:
+            cutoff = db.session.query(Message.id).filter_by(service_id=self.id) \
+                .order_by(Message.id.desc()).offset(max_messages).limit(1).scalar() or 0
+        if max_age:
+            expired = db.session.query(func.max(Message.id)).filter_by(service_id=self.id) \
+                .filter(Message.timestamp_created < datetime.utcnow() - timedelta(seconds=max_age)).scalar()
+            cutoff = max(cutoff, expired or 0)
+        if not cutoff:
+            return 0
+
+        missed = db.session.query(func.count(Message.id)) \
+            .filter(Message.service_id == self.id, Message.id <= cutoff,
+                    Message.id > func.coalesce(Subscription.last_read, 0),
+                    Subscription.sees_message()) \
+            .correlate(Subscription).as_scalar()
+        Subscription.query \
+            .filter_by(service_id=self.id) \
+            .filter(func.coalesce(Subscription.last_read, 0) < cutoff) \
+            .update({Subscription.dropped: Subscription.dropped + missed,
+                     Subscription.unread: case([(Subscription.unread > missed, Subscription.unread - missed)],
+                                               else_=0)},
+                    synchronize_session=False)
+        Message.query \
+            .filter_by(service_id=self.id) \
+            .filter(Message.id <= cutoff) \
+            .delete(synchronize_session=False)
+        return cutoff
 
-        map(db.session.delete, messages)
+    def expired_subscriptions(self, days):
+        """ the subscriptions that have been inactive for days """
+        return Subscription.query \
+            .filter_by(service_id=self.id) \
+            .filter(Subscription.timestamp_checked < datetime.utcnow() - timedelta(days=days)) \
+            .order_by(Subscription.id)
 
     def subscribed(self):
         return Subscription.query.filter_by(service=self)
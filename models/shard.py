@@ -0,0 +1,29 @@
+from shared import db
+from zlib import crc32
+from flask import current_app
+from routing import shard_count
+
+
+class ShardDirectory(db.Model):
+    """ services living on another shard than the one their public id hashes
+    to, i.e. those moved by rebalance.py. Kept on the primary """
+    public = db.Column(db.VARCHAR(40), primary_key=True)
+    shard = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, public, shard):
+        self.public = public
+        self.shard = shard
+
+    def __repr__(self):
+        return '<ShardDirectory {}: {}>'.format(self.public, self.shard)
+
+    @staticmethod
+    def shard_for(public):
+        """ the shard holding a service and its messages and subscriptions """
+        count = shard_count(current_app)
+        if count == 1:
+            return 0
+        moved = ShardDirectory.query.get(public)
+        if moved is not None:
+            return moved.shard
+        return crc32(public.encode('utf-8')) % count
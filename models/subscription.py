@@ -1,17 +1,26 @@
 from shared import db
-from sqlalchemy import Integer
+from sqlalchemy import Integer, exists, func, or_, select
 from datetime import datetime
 from .message import Message
+from .tag import SubscriptionTag, like_tag
+
+IN_BATCH_SIZE = 500  # values per IN (...) list, SQLite allows 999 bound variables
 
 
 class Subscription(db.Model):
+    __table_args__ = {'info': {'sharded': True}}
+
     id = db.Column(Integer, primary_key=True)
     device = db.Column(db.VARCHAR(40), nullable=False)
     service_id = db.Column(Integer, db.ForeignKey('service.id'), nullable=False)
     service = db.relationship('Service', backref=db.backref('subscription',
                                                             lazy='dynamic',
                                                             cascade="delete"))
-    last_read = db.Column(Integer, db.ForeignKey('message.id'), nullable=True)
+    # the id of the newest message read, not a foreign key: it may point at
+    # another service's message, and messages are deleted underneath it
+    last_read = db.Column(Integer, nullable=True)
+    unread = db.Column(Integer, nullable=False, default=0)
+    dropped = db.Column(Integer, nullable=False, default=0)
     timestamp_created = db.Column(db.TIMESTAMP, default=datetime.utcnow)
     timestamp_checked = db.Column(db.TIMESTAMP)
 
@@ -21,7 +30,9 @@ class Subscription(db.Model):
         self.device = device
         self.service = service
         self.timestamp_checked = datetime.utcnow()
-        self.last_read = last_message.id if last_message else None
+        self.last_read = last_message.id if last_message else 0
+        self.unread = 0
+        self.dropped = 0
 
     def __repr__(self):
         return '<Subscription {}>'.format(self.id)
@@ -29,12 +40,69 @@ class Subscription(db.Model):
     def messages(self):
         return Message.query \
             .filter_by(service_id=self.service_id) \
-            .filter(Message.id > self.last_read)
+            .filter(Message.id > (self.last_read or 0))
+
+    def set_tags(self, tags):
+        """ replaces the tags of the subscription """
+        self.tags.delete(synchronize_session=False)
+        for tag in tags:
+            db.session.add(SubscriptionTag(self, tag))
+
+    @staticmethod
+    def devices_of(service, tags=None):
+        """ the uuids of every device subscribed to service, or of those with any of tags """
+        if tags:
+            return SubscriptionTag.devices_tagged(service, tags)
+        return [device for device, in db.session.query(Subscription.device).filter_by(service_id=service.id)]
+
+    @staticmethod
+    def sees_message():
+        """ the condition for a message to be one of the subscription row's, in a query correlated
+        to both: messages sent with tags only go to subscriptions having one of them """
+        tagged = exists() \
+            .where(SubscriptionTag.subscription_id == Subscription.id) \
+            .where(Message.tags.like(like_tag(SubscriptionTag.tag), escape='\\')) \
+            .correlate_except(SubscriptionTag)
+        return or_(Message.tags.is_(None), tagged)
+
+    @staticmethod
+    def unread_after(upto):
+        """ the number of messages after the id upto for the subscription row being updated, as a
+        correlated subquery counted by the database doing the update """
+        return select([func.count(Message.id)]) \
+            .where(Message.service_id == Subscription.service_id) \
+            .where(Message.id > upto) \
+            .where(Subscription.sees_message()) \
+            .correlate_except(Message) \
+            .as_scalar()
+
+    @staticmethod
+    def mark_read(service, devices, upto):
+        """ marks the message upto of service read for the devices' subscriptions it was pushed to, in bulk.
+        Later messages the subscription gets, e.g. sent while upto was being pushed, stay unread, and
+        subscriptions with earlier messages still unread, e.g. held back by dispatch.Coalescer or pushed
+        out of order, are left as they are: last_read only moves over messages the device got """
+        skipped = exists() \
+            .where(Message.service_id == Subscription.service_id) \
+            .where(Message.id > func.coalesce(Subscription.last_read, 0)) \
+            .where(Message.id < upto) \
+            .where(Subscription.sees_message()) \
+            .correlate_except(Message)
+        values = {Subscription.timestamp_checked: datetime.utcnow(),
+                  Subscription.last_read: upto,
+                  Subscription.unread: Subscription.unread_after(upto)}
+        for start in range(0, len(devices), IN_BATCH_SIZE):
+            Subscription.query.filter_by(service_id=service.id) \
+                .filter(Subscription.device.in_(devices[start:start + IN_BATCH_SIZE])) \
+                .filter(func.coalesce(Subscription.last_read, 0) < upto) \
+                .filter(~skipped) \
+                .update(values, synchronize_session=False)
 
     def as_dict(self):
         data = {
             "uuid": self.device,
             "service": self.service.as_dict(),
+            "tags": sorted(t.tag for t in self.tags),
             "timestamp": int((self.timestamp_created - datetime.utcfromtimestamp(0)).total_seconds()),
             "timestamp_checked": int((self.timestamp_checked - datetime.utcfromtimestamp(0)).total_seconds())
         }
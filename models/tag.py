@@ -0,0 +1,59 @@
+from shared import db
+from sqlalchemy import Integer, func
+
+TAG_MAX_LENGTH = 64
+MAX_TAGS = 20  # per subscription, and per targeted message
+
+
+def parse_tags(value):
+    """ the distinct tags of a comma separated list, sorted.
+    None if there are too many, or one is too long or holds a % or backslash """
+    tags = sorted({t.strip() for t in (value or '').split(',') if t.strip()})
+    if len(tags) > MAX_TAGS or any(len(t) > TAG_MAX_LENGTH or '%' in t or '\\' in t for t in tags):
+        return None
+    return tags
+
+
+def join_tags(tags):
+    """ tags as stored on a message, matched with like_tag """
+    return ',{},'.format(','.join(tags)) if tags else None
+
+
+def like_tag(tag):
+    """ a LIKE pattern matching a stored list of tags containing the tag column or value """
+    return '%,' + func.replace(tag, '_', '\\_') + ',%'
+
+
+class SubscriptionTag(db.Model):
+    """
+    a tag of a subscription, that messages sent with tags are targeted at.
+    service_id and device are copied from the subscription so the devices
+    a message targets come out of the (service_id, tag, device) index alone
+    """
+    __table_args__ = (db.Index('ix_subscription_tag_lookup', 'service_id', 'tag', 'device'),
+                      {'info': {'sharded': True}})
+
+    id = db.Column(Integer, primary_key=True)
+    subscription_id = db.Column(Integer, db.ForeignKey('subscription.id'), nullable=False, index=True)
+    subscription = db.relationship('Subscription', backref=db.backref('tags',
+                                                                      lazy='dynamic',
+                                                                      cascade="delete"))
+    service_id = db.Column(Integer, nullable=False)
+    device = db.Column(db.VARCHAR(40), nullable=False)
+    tag = db.Column(db.Unicode(length=TAG_MAX_LENGTH), nullable=False)
+
+    def __init__(self, subscription, tag):
+        self.subscription = subscription
+        self.service_id = subscription.service.id
+        self.device = subscription.device
+        self.tag = tag
+
+    def __repr__(self):
+        return '<SubscriptionTag {}>'.format(self.tag)
+
+    @staticmethod
+    def devices_tagged(service, tags):
+        """ the uuids of the devices subscribed to service with any of tags """
+        return [device for device, in db.session.query(SubscriptionTag.device).distinct()
+                .filter(SubscriptionTag.service_id == service.id)
+                .filter(SubscriptionTag.tag.in_(tags))]
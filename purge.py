@@ -0,0 +1,150 @@
+""" background purge of the services deleted with DELETE /service """
+import logging
+import threading
+from json import dumps as json_encode
+
+from shared import db
+from routing import each_shard
+from models import Service, Message, Subscription, SubscriptionTag, ScheduledMessage, IdempotencyKey, \
+    DeadLetter
+from models.subscription import IN_BATCH_SIZE
+from utils import queue_zmq_message
+from config import Config
+
+cfg = Config.get_global_instance()
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+
+def _delete_ids(model, ids):
+    for start in range(0, len(ids), IN_BATCH_SIZE):
+        model.query.filter(model.id.in_(ids[start:start + IN_BATCH_SIZE])).delete(synchronize_session=False)
+
+
+def delete_subscriptions(subscriptions):
+    """ deletes the subscriptions with their tags, announcing each one to the ZMQ relay. Two processes
+    deleting the same subscriptions announce them twice, which relay consumers handle as delivery is
+    at-least-once """
+    if cfg.zeromq_relay_uri:
+        for subscription in subscriptions:
+            queue_zmq_message(json_encode({'subscription': subscription.as_dict()}))
+    ids = [s.id for s in subscriptions]
+    for start in range(0, len(ids), IN_BATCH_SIZE):
+        SubscriptionTag.query.filter(SubscriptionTag.subscription_id.in_(ids[start:start + IN_BATCH_SIZE])) \
+            .delete(synchronize_session=False)
+    _delete_ids(Subscription, ids)
+
+
+class Purger:
+    """
+    deletes what belongs to the services marked deleted: first their
+    subscriptions with their tags, announcing each one to the ZMQ relay,
+    then their messages, scheduled messages, idempotency keys and dead
+    letters, and last the service row itself. Every batch of batch_size
+    rows commits on its own, so a large service never holds much memory or
+    long locks, and a purge cut short by a restart carries on where it
+    stopped. Any process may purge, two purging the same service delete
+    the same rows.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.batch_size = 500
+        self.interval = 60
+        self.thread = None
+        self.purged = 0
+        self._progress = {}
+        self._wake = False
+        self._cond = threading.Condition()
+
+    def init_app(self, app, batch_size=500, interval=60):
+        self.app = app
+        self.batch_size = batch_size
+        self.interval = interval
+        self.thread = threading.Thread(target=self._run, name="pushfish-purge", daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        """ starts purging right away instead of at the next interval """
+        with self._cond:
+            self._wake = True
+            self._cond.notify()
+
+    def stats(self):
+        """ the rows deleted so far and in total of each service being purged """
+        with self._cond:
+            return {'purging': [dict(progress, service=public) for public, progress in self._progress.items()],
+                    'purged': self.purged}
+
+    def run_once(self):
+        """ purges every deleted service completely, returns the number of services purged """
+        purged = 0
+        with self.app.app_context():
+            for _ in each_shard():
+                deleted = Service.query.filter(Service.deleted_at.isnot(None)).all()
+                for service in deleted:
+                    while self.purge_batch(service):
+                        pass
+                    purged += 1
+        return purged
+
+    def purge_batch(self, service):
+        """ deletes one batch of the service's rows, returns False once the service itself is gone """
+        public = service.public
+        progress = self._start(service)
+        subscriptions = Subscription.query.filter_by(service_id=service.id) \
+            .order_by(Subscription.id).limit(self.batch_size).all()
+        if subscriptions:
+            delete_subscriptions(subscriptions)
+            db.session.commit()
+            self._advance(progress, 'subscriptions', len(subscriptions))
+            return True
+
+        for name, model in (('messages', Message), ('scheduled', ScheduledMessage), ('keys', IdempotencyKey),
+                            ('dead letters', DeadLetter)):
+            ids = [i for i, in db.session.query(model.id).filter_by(service_id=service.id)
+                   .order_by(model.id).limit(self.batch_size)]
+            if ids:
+                _delete_ids(model, ids)
+                db.session.commit()
+                self._advance(progress, name, len(ids))
+                return True
+
+        Service.query.filter_by(id=service.id).delete(synchronize_session=False)
+        db.session.commit()
+        with self._cond:
+            self._progress.pop(public, None)
+            self.purged += 1
+        _LOGGER.info("purged service %s: %s", public, progress)
+        return False
+
+    def _start(self, service):
+        with self._cond:
+            progress = self._progress.get(service.public)
+        if progress is None:
+            # totals as of the start, for telling how far along a purge is
+            progress = {'subscriptions': [0, service.subscribed().count()],
+                        'messages': [0, Message.query.filter_by(service_id=service.id).count()],
+                        'scheduled': [0, 0], 'keys': [0, 0], 'dead letters': [0, 0]}
+            with self._cond:
+                self._progress[service.public] = progress
+        return progress
+
+    def _advance(self, progress, name, rows):
+        with self._cond:
+            done, total = progress[name]
+            progress[name] = [done + rows, max(total, done + rows)]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._wake:
+                    self._cond.wait(self.interval)
+                self._wake = False
+            try:
+                self.run_once()
+            except Exception:
+                _LOGGER.exception("purging deleted services failed")
+
+
+purger = Purger()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+""" moves services between database shards
+
+usage:
+    python rebalance.py stats
+    python rebalance.py move <service public id> <target shard>
+
+A service is copied to the target shard with its messages, subscriptions
+and their tags, idempotency keys, scheduled messages and dead letters, and
+the directory on the primary is pointed at the target. Rows written to the
+source meanwhile, by requests routed there before the directory changed,
+are then copied over as well, in rounds until one finds nothing new, and
+only then are the rows removed from the source shard. Changes to rows
+already copied, e.g. messages marked read during the move, are not.
+"""
+import argparse
+import sys
+from bisect import bisect_right
+
+from sqlalchemy import func, select
+
+from application import app
+from shared import db
+from models import Service, Message, Subscription, SubscriptionTag, IdempotencyKey, ShardDirectory, \
+    ScheduledMessage, DeadLetter
+from routing import use_shard, shard_count
+
+
+def _rows(model, *where):
+    table = model.__table__
+    stmt = select([table]).where(*where).order_by(table.c.id)
+    return [dict(row) for row in db.session.execute(stmt, mapper=model.__mapper__)]
+
+
+def _insert(model, row):
+    """ inserts a row under a new id, returns that id """
+    row = {k: v for k, v in row.items() if k != 'id'}
+    return db.session.execute(model.__table__.insert().values(**row), mapper=model.__mapper__).inserted_primary_key[0]
+
+
+# the rows moved along with their service, parents first
+MOVED = [Message, Subscription, SubscriptionTag, IdempotencyKey, ScheduledMessage, DeadLetter]
+
+
+def _new_rows(service_id, copied):
+    """ the rows of the service on the current shard that have not been copied yet, per model """
+    rows = {model: [row for row in _rows(model, model.__table__.c.service_id == service_id)
+                    if row['id'] not in copied[model]]
+            for model in MOVED}
+    db.session.rollback()
+    return rows
+
+
+def _copy(rows, service_id, copied, base):
+    """ inserts rows read by _new_rows on the current shard, returns the number inserted """
+    message_ids, subscription_ids = copied[Message], copied[Subscription]
+    inserted = 0
+    for row in rows[Message]:
+        row['service_id'] = service_id
+        message_ids[row['id']] = _insert(Message, row)
+        inserted += 1
+    old_ids = sorted(message_ids)
+    for row in rows[Subscription]:
+        read = bisect_right(old_ids, row['last_read']) if row['last_read'] is not None else 0
+        row['service_id'] = service_id
+        row['last_read'] = message_ids[old_ids[read - 1]] if read else base
+        subscription_ids[row['id']] = _insert(Subscription, row)
+        inserted += 1
+    for row in rows[SubscriptionTag]:
+        if row['subscription_id'] not in subscription_ids:
+            # its subscription turns up in the next round
+            continue
+        row['service_id'] = service_id
+        row['subscription_id'] = subscription_ids[row['subscription_id']]
+        copied[SubscriptionTag][row['id']] = _insert(SubscriptionTag, row)
+        inserted += 1
+    for row in rows[IdempotencyKey]:
+        row['service_id'] = service_id
+        row['message_id'] = message_ids.get(row['message_id'])
+        copied[IdempotencyKey][row['id']] = _insert(IdempotencyKey, row)
+        inserted += 1
+    for row in rows[ScheduledMessage]:
+        row['service_id'] = service_id
+        copied[ScheduledMessage][row['id']] = _insert(ScheduledMessage, row)
+        inserted += 1
+    for row in rows[DeadLetter]:
+        if row['message_id'] not in message_ids:
+            continue
+        row['service_id'] = service_id
+        row['message_id'] = message_ids[row['message_id']]
+        copied[DeadLetter][row['id']] = _insert(DeadLetter, row)
+        inserted += 1
+    db.session.commit()
+    return inserted
+
+
+def _point_directory(public, shard):
+    # the directory lives on the primary, whatever the current shard
+    entry = ShardDirectory.query.get(public)
+    if entry is None:
+        db.session.add(ShardDirectory(public, shard))
+    else:
+        entry.shard = shard
+    db.session.commit()
+
+
+def move_service(public, target):
+    """ moves a service to the target shard, returns the number of messages moved """
+    source = ShardDirectory.shard_for(public)
+    if source == target:
+        return 0
+    if not 0 <= target < shard_count(db.get_app()):
+        raise ValueError("no shard {}".format(target))
+
+    use_shard(source)
+    service = Service.query.filter_by(public=public).first()
+    if service is None:
+        raise ValueError("service {} not found on shard {}".format(public, source))
+    service_id = service.id
+    service_row = _rows(Service, Service.__table__.c.id == service_id)[0]
+    copied = {model: {} for model in MOVED}
+    rows = _new_rows(service_id, copied)
+
+    use_shard(target)
+    # subscriptions that have read everything copied point below the copied ids
+    base = db.session.query(func.max(Message.id)).scalar() or 0
+    new_service_id = _insert(Service, service_row)
+    _copy(rows, new_service_id, copied, base)
+    _point_directory(public, target)
+
+    while True:
+        use_shard(source)
+        rows = _new_rows(service_id, copied)
+        use_shard(target)
+        if not _copy(rows, new_service_id, copied, base):
+            break
+
+    use_shard(source)
+    DeadLetter.query.filter_by(service_id=service_id).delete(synchronize_session=False)
+    IdempotencyKey.query.filter_by(service_id=service_id).delete(synchronize_session=False)
+    ScheduledMessage.query.filter_by(service_id=service_id).delete(synchronize_session=False)
+    SubscriptionTag.query.filter_by(service_id=service_id).delete(synchronize_session=False)
+    Subscription.query.filter_by(service_id=service_id).delete(synchronize_session=False)
+    Message.query.filter_by(service_id=service_id).delete(synchronize_session=False)
+    Service.query.filter_by(id=service_id).delete(synchronize_session=False)
+    db.session.commit()
+    return len(copied[Message])
+
+
+def shard_stats():
+    """ services, subscriptions and messages per shard """
+    stats = []
+    for shard in range(shard_count(db.get_app())):
+        use_shard(shard)
+        stats.append((shard, Service.query.count(), Subscription.query.count(), Message.query.count()))
+        db.session.rollback()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="moves services between database shards")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("stats", help="show how services are spread over the shards")
+    move = commands.add_parser("move", help="move a service to another shard")
+    move.add_argument("service", help="public id of the service")
+    move.add_argument("shard", type=int, help="target shard, 0 is the main database")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.command == "move":
+            try:
+                moved = move_service(args.service, args.shard)
+            except ValueError as err:
+                print(err, file=sys.stderr)
+                sys.exit(1)
+            print("moved {} with {} messages to shard {}".format(args.service, moved, args.shard))
+        else:
+            print("{:>5} {:>10} {:>14} {:>10}".format("shard", "services", "subscriptions", "messages"))
+            for row in shard_stats():
+                print("{:>5} {:>10} {:>14} {:>10}".format(*row))
+
+
+if __name__ == "__main__":
+    main()
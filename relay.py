@@ -0,0 +1,112 @@
+""" background pump relaying the outbox to the ZMQ connectors """
+import logging
+import threading
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from shared import db
+from routing import shard_count, current_shard, use_shard
+from models import Outbox, RelayCheckpoint
+from wire import FORMAT_JSON, encode, decode
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+RELAY_CHECKPOINT_NAME = "zmq"
+
+
+class RelayPump(threading.Thread):
+    """ drains the outbox in id order and in batches.
+
+    Every process may run a pump; only the holder of the checkpoint lease
+    relays, the others keep probing and take over once the lease expires.
+    Entries are deleted only after they have been handed to the socket, so
+    delivery is at-least-once: a pump dying mid-batch resends that batch.
+    """
+
+    def __init__(self, app, socket, batch_size=100, interval=1.0, lease=30, format_=FORMAT_JSON):
+        super().__init__(name="pushfish-relay-pump", daemon=True)
+        self.app = app
+        self.socket = socket
+        # the outbox holds JSON, other formats are encoded on the way out
+        self.format = format_
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease = timedelta(seconds=lease)
+        self.owner = str(uuid4())
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            backlog = False
+            for shard in range(shard_count(self.app)):
+                try:
+                    with self.app.app_context():
+                        use_shard(shard)
+                        backlog |= self.pump_once() == self.batch_size
+                except Exception:
+                    _LOGGER.exception("relay pump failed on shard %s, retrying in %s seconds", shard, self.interval)
+            # keep going without pausing while there is a backlog
+            if not backlog:
+                self._stop_event.wait(self.interval)
+
+    @staticmethod
+    def checkpoint_name():
+        # every shard has its own outbox, and so its own progress and lease
+        shard = current_shard()
+        return RELAY_CHECKPOINT_NAME if not shard else '{}-{}'.format(RELAY_CHECKPOINT_NAME, shard)
+
+    def acquire_lease(self):
+        """ claims or extends the lease, returns whether this pump holds it """
+        name = self.checkpoint_name()
+        if RelayCheckpoint.query.get(name) is None:
+            try:
+                db.session.add(RelayCheckpoint(name))
+                db.session.commit()
+            except IntegrityError:
+                # another worker created it first
+                db.session.rollback()
+
+        now = datetime.utcnow()
+        claimed = RelayCheckpoint.query \
+            .filter(RelayCheckpoint.name == name) \
+            .filter(or_(RelayCheckpoint.owner == self.owner,
+                        RelayCheckpoint.owner.is_(None),
+                        RelayCheckpoint.lease_expires < now)) \
+            .update({RelayCheckpoint.owner: self.owner,
+                     RelayCheckpoint.lease_expires: now + self.lease}, synchronize_session=False)
+        db.session.commit()
+        return claimed == 1
+
+    def pump_once(self):
+        """ relays one batch of the current shard's outbox if this pump holds
+        the lease. Must be called inside an app context. Returns the number
+        of entries relayed """
+        if not self.acquire_lease():
+            return 0
+
+        # rows are picked up by what is left in the table rather than by
+        # id > last_id, so an id allocated by a transaction that committed
+        # late is not skipped
+        batch = Outbox.query.order_by(Outbox.id.asc()).limit(self.batch_size).all()
+        if not batch:
+            return 0
+
+        for entry in batch:
+            if self.format == FORMAT_JSON:
+                self.socket.send_string(entry.payload)
+            else:
+                self.socket.send(encode(decode(entry.payload), self.format))
+
+        checkpoint = RelayCheckpoint.query.get(self.checkpoint_name())
+        checkpoint.last_id = max(checkpoint.last_id, batch[-1].id)
+        checkpoint.relayed += len(batch)
+        checkpoint.timestamp_checked = datetime.utcnow()
+        Outbox.query.filter(Outbox.id.in_([e.id for e in batch])).delete(synchronize_session=False)
+        db.session.commit()
+        return len(batch)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+""" lists and replays the failed deliveries kept as dead letters
+
+usage:
+    python replay.py stats
+    python replay.py replay [--service <service public id>] [--since <unix time>] [--until <unix time>]
+
+replay schedules the dead letters of a service, or of every service,
+created within the time range for an immediate retry with their attempts
+reset, parked ones included. The running API processes pick them up at
+their next retry round, see retry.RetryWorker.
+"""
+import argparse
+import sys
+from datetime import datetime
+
+from sqlalchemy import func
+
+from application import app
+from shared import db
+from models import Service, DeadLetter, ShardDirectory
+from routing import use_shard, each_shard
+
+
+def replay(public=None, since=None, until=None):
+    """ schedules the matching dead letters of every shard for a retry, returns their number """
+    if public is not None:
+        use_shard(ShardDirectory.shard_for(public))
+        service = Service.query.filter_by(public=public).first()
+        if service is None:
+            raise ValueError("service {} not found".format(public))
+        replayed = DeadLetter.replay(service, since, until)
+        db.session.commit()
+        return replayed
+    replayed = 0
+    for _ in each_shard():
+        replayed += DeadLetter.replay(None, since, until)
+        db.session.commit()
+    return replayed
+
+
+def letter_stats():
+    """ waiting and parked dead letters per channel and error """
+    stats = {}
+    for _ in each_shard():
+        rows = db.session.query(DeadLetter.channel, DeadLetter.error, DeadLetter.next_retry.is_(None),
+                                func.count(DeadLetter.id)) \
+            .group_by(DeadLetter.channel, DeadLetter.error, DeadLetter.next_retry.is_(None)).all()
+        for channel, error, parked, count in rows:
+            waiting_parked = stats.setdefault((channel, error), [0, 0])
+            waiting_parked[1 if parked else 0] += count
+        db.session.rollback()
+    return sorted((channel, error, waiting, parked) for (channel, error), (waiting, parked) in stats.items())
+
+
+def _unix_time(value):
+    return datetime.utcfromtimestamp(float(value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="lists and replays the failed deliveries kept as dead letters")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("stats", help="show the dead letters per channel and error")
+    replay_ = commands.add_parser("replay", help="retry dead letters right away")
+    replay_.add_argument("--service", help="public id of the service, all services if left out")
+    replay_.add_argument("--since", type=_unix_time, help="only letters created from this unix time on")
+    replay_.add_argument("--until", type=_unix_time, help="only letters created before this unix time")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.command == "replay":
+            try:
+                replayed = replay(args.service, args.since, args.until)
+            except ValueError as err:
+                print(err, file=sys.stderr)
+                sys.exit(1)
+            print("replaying {} dead letters".format(replayed))
+        else:
+            print("{:<10} {:<24} {:>8} {:>8}".format("channel", "error", "waiting", "parked"))
+            for row in letter_stats():
+                print("{:<10} {:<24} {:>8} {:>8}".format(*row))
+
+
+if __name__ == "__main__":
+    main()
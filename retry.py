@@ -0,0 +1,123 @@
+""" background retries of the deliveries channels failed, see models.DeadLetter """
+import logging
+import threading
+from datetime import datetime, timedelta
+from time import sleep
+
+from shared import db
+from channels import registry, deliver_batches
+from routing import each_shard
+from wire import message_payload
+from models import Message, Subscription, DeadLetter
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+RETRY_LOAD_LIMIT = 100  # due letters retried per shard and round
+
+
+class RetryWorker:
+    """
+    retries the dead letters whose next_retry has come: the devices of a
+    letter the channel still reaches are prepared, delivered and reported
+    like in deliver_message, and the letter is deleted once none are left
+    over. Otherwise the next retry is backoff * 2^attempts seconds later,
+    and after max_attempts the letter is parked until it is replayed.
+
+    A letter is claimed by moving its next_retry past the channel's timeout
+    in a conditional update, so with several API processes each retry runs
+    once. A process dying mid retry just leaves the letter due again after
+    that lease.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.interval = 30
+        self.backoff = 30
+        self.max_attempts = 8
+        self.thread = None
+        self.retried = 0
+        self.recovered = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app, interval=30, backoff=30, max_attempts=8):
+        self.app = app
+        self.interval = interval
+        self.backoff = backoff
+        self.max_attempts = max_attempts
+        self.thread = threading.Thread(target=self._run, name="pushfish-retry", daemon=True)
+        self.thread.start()
+
+    def next_retry(self, attempts, now=None):
+        """ when a letter with attempts retries behind it is due, None once it is to be parked """
+        if attempts >= self.max_attempts:
+            return None
+        return (now or datetime.utcnow()) + timedelta(seconds=self.backoff * 2 ** attempts)
+
+    def stats(self):
+        with self._lock:
+            return {'retried': self.retried, 'recovered': self.recovered}
+
+    def run_once(self, now=None):
+        """ retries every letter due at now, returns the number of letters retried """
+        now = now or datetime.utcnow()
+        retried = 0
+        with self.app.app_context():
+            for _ in each_shard():
+                letters = DeadLetter.query.filter(DeadLetter.next_retry <= now) \
+                    .order_by(DeadLetter.next_retry).limit(RETRY_LOAD_LIMIT).all()
+                for letter in letters:
+                    retried += self.retry(letter, now)
+        return retried
+
+    def retry(self, letter, now):
+        """ delivers a due letter of the current shard once more, returns 1 if this call did """
+        channel = registry.get(letter.channel)
+        message = Message.query.get(letter.message_id)
+        if channel is None or message is None or message.service.deleted_at is not None:
+            # nothing left to deliver
+            DeadLetter.query.filter_by(id=letter.id).delete(synchronize_session=False)
+            db.session.commit()
+            return 0
+        lease = now + timedelta(seconds=channel.timeout * 2)
+        claimed = DeadLetter.query.filter_by(id=letter.id, next_retry=letter.next_retry) \
+            .update({DeadLetter.next_retry: lease}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return 0
+        if not channel.enabled():
+            letter.next_retry = self.next_retry(letter.attempts, now) or lease
+            db.session.commit()
+            return 0
+
+        batch = channel.prepare(message, letter.device_list)
+        failed, error = [], None
+        if batch:
+            outcome, = deliver_batches([(channel, batch)], message_payload(message, letter.count))
+            reached = channel.report(message, batch, outcome.result)
+            if reached and letter.count == 1:
+                Subscription.mark_read(message.service, sorted(reached), message.id)
+            failed = channel.failed(batch, outcome.result)
+            error = outcome.error or 'Unavailable'
+        if failed:
+            letter.failed_again(failed, error, self.next_retry(letter.attempts + 1, now))
+            if letter.next_retry is None:
+                _LOGGER.warning("parking %s after %d retries: %s", letter, letter.attempts, error)
+        else:
+            # delivered, or the devices have unsubscribed meanwhile
+            db.session.delete(letter)
+        db.session.commit()
+        with self._lock:
+            self.retried += 1
+            self.recovered += 0 if failed else 1
+        return 1
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                _LOGGER.exception("retrying failed deliveries failed")
+
+
+retry_worker = RetryWorker()
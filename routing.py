@@ -0,0 +1,160 @@
+""" session routing between the primary database, its read replicas and the shards """
+import random
+from threading import Lock
+from time import monotonic
+
+from flask import g, has_request_context, has_app_context, current_app
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.sql import Select
+
+REPLICA_BIND_PREFIX = "replica"
+SHARD_BIND_PREFIX = "shard"
+STICKY_MAX_DEVICES = 100000
+
+
+class _StickyDevices:
+    """ devices that wrote recently and must read their own writes from the primary """
+
+    def __init__(self):
+        self.seconds = 0
+        self._until = {}
+        self._lock = Lock()
+
+    def stick(self, device):
+        if not self.seconds:
+            return
+        now = monotonic()
+        with self._lock:
+            if len(self._until) >= STICKY_MAX_DEVICES:
+                self._until = {d: t for d, t in self._until.items() if t > now}
+            self._until[device] = now + self.seconds
+
+    def is_sticky(self, device):
+        until = self._until.get(device)
+        return until is not None and until > monotonic()
+
+
+sticky_devices = _StickyDevices()
+
+
+def replica_binds(app):
+    return sorted(k for k in app.config.get('SQLALCHEMY_BINDS') or {} if k.startswith(REPLICA_BIND_PREFIX))
+
+
+def configure_replicas(app, uris, sticky_seconds):
+    """ registers the replica URIs as binds on the app """
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for i, uri in enumerate(uris):
+        binds['{}{}'.format(REPLICA_BIND_PREFIX, i)] = uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+    sticky_devices.seconds = sticky_seconds
+
+
+def configure_shards(app, uris):
+    """ registers the URIs of shards 1..n as binds on the app, shard 0 is the primary """
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for i, uri in enumerate(uris, 1):
+        binds['{}{}'.format(SHARD_BIND_PREFIX, i)] = uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+
+def shard_binds(app):
+    """ bind names of shards 1..n """
+    binds = app.config.get('SQLALCHEMY_BINDS') or {}
+    shards = []
+    while '{}{}'.format(SHARD_BIND_PREFIX, len(shards) + 1) in binds:
+        shards.append('{}{}'.format(SHARD_BIND_PREFIX, len(shards) + 1))
+    return shards
+
+
+def shard_count(app):
+    return len(shard_binds(app)) + 1
+
+
+def is_sharded(table):
+    """ tables holding per service rows, marked with info={'sharded': True} """
+    return table is not None and table.info.get('sharded', False)
+
+
+def use_shard(shard):
+    """ routes the sharded tables of the current app context to a shard """
+    g.shard = shard
+
+
+def current_shard():
+    return g.get('shard', 0) if has_app_context() else 0
+
+
+def each_shard():
+    """
+    runs the loop body once per shard with the session routed to it. The
+    session is committed and cleared between shards, since ids are only
+    unique within a shard: serialize what you need inside the loop.
+    Without shards the body runs once, untouched.
+    """
+    count = shard_count(current_app)
+    if count == 1:
+        yield 0
+        return
+
+    session = current_app.extensions['sqlalchemy'].db.session
+    previous = current_shard()
+    try:
+        for shard in range(count):
+            use_shard(shard)
+            yield shard
+            session.commit()
+            session.expunge_all()
+    finally:
+        use_shard(previous)
+
+
+def _use_replica(session, clause):
+    if session._flushing or session.info.get('wrote') or not isinstance(clause, Select):
+        return False
+    if not has_request_context() or not g.get('replica_reads'):
+        return False
+    device = g.get('device')
+    return device is None or not sticky_devices.is_sticky(device)
+
+
+class RoutingSession(SignallingSession):
+    """
+    sends the sharded tables to the shard selected with use_shard, and
+    the SELECTs of handlers marked with utils.replica_reads to a replica
+    of the primary. Everything else goes to the primary: flushes and bulk
+    writes, reads after the request has written something, and all reads
+    of a device for a while after it wrote, so it always sees its own writes.
+    Replicas only stand in for the primary, i.e. shard 0.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        table = mapper.persist_selectable if mapper is not None else None
+        if is_sharded(table) and current_shard():
+            return self.db.get_engine(self.app, bind='{}{}'.format(SHARD_BIND_PREFIX, current_shard()))
+        if _use_replica(self, clause):
+            binds = replica_binds(self.app)
+            if binds:
+                return self.db.get_engine(self.app, bind=random.choice(binds))
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _after_commit(session):
+    if session.info.pop('wrote', False) and has_request_context() and g.get('device'):
+        sticky_devices.stick(g.device)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
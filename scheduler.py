@@ -0,0 +1,146 @@
+""" release of messages sent with deliver_at or delay once they are due """
+import calendar
+import heapq
+import logging
+import threading
+from datetime import datetime
+from time import time, monotonic, sleep
+
+from shared import db
+from dispatch import coalescer, insert_message
+from routing import each_shard, use_shard, current_shard
+from models import ScheduledMessage
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+SCHEDULE_LOAD_LIMIT = 10000  # scheduled messages loaded per shard and refresh
+
+
+def to_timestamp(when):
+    """ unix time of a naive UTC datetime """
+    return calendar.timegm(when.utctimetuple()) + when.microsecond / 1e6
+
+
+class Scheduler:
+    """
+    keeps the scheduled messages due within the next window seconds in a
+    heap and sleeps until the earliest is due. The window is reloaded from
+    the database every window / 2 seconds, so messages scheduled further
+    ahead cost nothing until they come close, and a restart simply picks
+    up the table again.
+
+    A due message is claimed by deleting its ScheduledMessage row in the
+    transaction that inserts the Message, so with several API processes
+    each one is released exactly once. Releases are paced at rate per
+    second, which spreads out everything scheduled for the same instant.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.window = 60
+        self.rate = 100
+        self.thread = None
+        self._heap = []
+        self._loaded = set()
+        self._next_load = 0.0
+        self._cond = threading.Condition()
+
+    def init_app(self, app, window=60, rate=100):
+        self.app = app
+        self.window = window
+        self.rate = rate
+        self.thread = threading.Thread(target=self._run, name="pushfish-scheduler", daemon=True)
+        self.thread.start()
+
+    def add(self, scheduled):
+        """ takes a committed ScheduledMessage of the current shard into account """
+        due = to_timestamp(scheduled.deliver_at)
+        if due > time() + self.window:
+            # picked up by a later reload
+            return
+        with self._cond:
+            self._push(due, current_shard(), scheduled.id)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {'loaded': len(self._heap),
+                    'next_due': max(0.0, self._heap[0][0] - time()) if self._heap else None}
+
+    def run_once(self, now=None):
+        """ reloads the window and releases everything due at now, unpaced. returns the number released """
+        now = time() if now is None else now
+        self.load(now)
+        released = 0
+        while True:
+            with self._cond:
+                if not self._heap or self._heap[0][0] > now:
+                    return released
+                item = self._pop()
+            released += self.release(*item[1:])
+
+    def load(self, now):
+        horizon = datetime.utcfromtimestamp(now + self.window)
+        with self.app.app_context():
+            for shard in each_shard():
+                rows = db.session.query(ScheduledMessage.id, ScheduledMessage.deliver_at) \
+                    .filter(ScheduledMessage.deliver_at <= horizon) \
+                    .order_by(ScheduledMessage.deliver_at) \
+                    .limit(SCHEDULE_LOAD_LIMIT).all()
+                with self._cond:
+                    for scheduled_id, deliver_at in rows:
+                        self._push(to_timestamp(deliver_at), shard, scheduled_id)
+
+    def release(self, shard, scheduled_id):
+        """ turns a due scheduled message into a Message and dispatches it, returns 1 if this call did """
+        with self.app.app_context():
+            use_shard(shard)
+            scheduled = ScheduledMessage.query.get(scheduled_id)
+            if scheduled is None or scheduled.service.deleted_at is not None:
+                # released by another process, or its service is gone
+                return 0
+            claimed = ScheduledMessage.query.filter_by(id=scheduled_id).delete(synchronize_session=False)
+            if not claimed:
+                db.session.rollback()
+                return 0
+            # the backref puts it on service.message right away, it must be in the session before the next autoflush
+            message = scheduled.to_message()
+            insert_message(message)
+            db.session.commit()
+            coalescer.submit(message)
+            return 1
+
+    def _push(self, due, shard, scheduled_id):
+        if (shard, scheduled_id) not in self._loaded:
+            self._loaded.add((shard, scheduled_id))
+            heapq.heappush(self._heap, (due, shard, scheduled_id))
+
+    def _pop(self):
+        item = heapq.heappop(self._heap)
+        self._loaded.discard(item[1:])
+        return item
+
+    def _run(self):
+        while True:
+            try:
+                if monotonic() >= self._next_load:
+                    self._next_load = monotonic() + self.window / 2
+                    self.load(time())
+                with self._cond:
+                    wait = self._next_load - monotonic()
+                    if self._heap:
+                        wait = min(wait, self._heap[0][0] - time())
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    item = self._pop() if self._heap and self._heap[0][0] <= time() else None
+                if item is not None:
+                    self.release(*item[1:])
+                    if self.rate:
+                        sleep(1.0 / self.rate)
+            except Exception:
+                _LOGGER.exception("releasing scheduled messages failed")
+                sleep(1)
+
+
+scheduler = Scheduler()
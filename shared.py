@@ -1,9 +1,9 @@
-from flask_sqlalchemy import SQLAlchemy
 import zmq
 # TODO: a better way of doing this
 from config import Config, fatal_error_exit_or_backtrace
+from routing import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 zmq_relay_socket = None
 zeromq_context = None
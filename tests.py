@@ -7,9 +7,11 @@ import unittest
 import string
 import random
 import json
+import gzip
+import shutil
+import tempfile
 import logging
 from time import sleep
-from ast import literal_eval
 import paho.mqtt.client as mqtt_api
 
 from config import Config
@@ -47,7 +49,7 @@ def _message_callback(client, userdata, message):
     mqtt subscribe callback function
     puts received messages in _messages_received
     """
-    message = {"data": literal_eval(message.payload.decode("utf-8")), "topic": message.topic, "qos": message.qos,
+    message = {"data": json.loads(message.payload.decode("utf-8")), "topic": message.topic, "qos": message.qos,
                "retain": message.retain}
     _messages_received.append(message)
 
@@ -62,6 +64,7 @@ class PushFishTestCase(unittest.TestCase):
 
         app.config['TESTING'] = True
         app.config['TESTING_GCM'] = []
+        app.config['TESTING_GCM_RESPONSES'] = []
         self.gcm_enable = True
         if not cfg.google_api_key:
             _LOGGER.warning("GCM API key is not provided, won't test GCM")
@@ -72,6 +75,9 @@ class PushFishTestCase(unittest.TestCase):
             _LOGGER.warning("MQTT broker address is not provided, won't test MQTT")
             self.mqtt_enable = False
 
+        self.stats_secret = 'operator'
+        cfg._cfg['server']['stats_secret'] = self.stats_secret
+
         self.gcm = app.config['TESTING_GCM']
         self.app = app.test_client()
         self.app_real = app
@@ -126,6 +132,30 @@ class PushFishTestCase(unittest.TestCase):
         assert len(resp['subscriptions']) == 1
         assert resp['subscriptions'][0]['service']['public'] == public
 
+    def test_subscription_list_etag(self):
+        self.test_subscription_new()
+        url = '/subscription?uuid={}'.format(self.uuid)
+        etag = self.app.get(url).headers['ETag']
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+
+        self.test_subscription_new()
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        assert len(_failing_loader(rv.data)['subscriptions']) == 2
+
+    def test_subscription_list_compressed_etag(self):
+        for _ in range(8):
+            self.test_subscription_new()
+        url = '/subscription?uuid={}'.format(self.uuid)
+        rv = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        etag = rv.headers['ETag']
+        assert etag.endswith('-gzip"')
+
+        rv = self.app.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert rv.headers['ETag'] == etag
+
     def test_message_send(self, public='', secret=''):
         if not public or not secret:
             public, secret = self.test_subscription_new()
@@ -139,6 +169,59 @@ class PushFishTestCase(unittest.TestCase):
         _failing_loader(rv.data)
         return public, secret, data
 
+    def test_message_send_idempotent(self):
+        public, secret = self.test_subscription_new()
+        data = {
+            "message": "Test message - {}".format(_random_str(20)),
+            "secret": secret,
+            "dedup_id": _random_str(16, False),
+        }
+        for _ in range(3):
+            _failing_loader(self.app.post('/message', data=data).data)
+        headers = {'Idempotency-Key': data['dedup_id']}
+        _failing_loader(self.app.post('/message', data=data, headers=headers).data)
+
+        # a different key is a different message
+        data['dedup_id'] = _random_str(16, False)
+        _failing_loader(self.app.post('/message', data=data).data)
+
+        rv = self.app.get('/message?uuid={}'.format(self.uuid))
+        assert len(_failing_loader(rv.data)['messages']) == 2
+
+    def test_idempotency_key_eviction(self):
+        from models import Service, IdempotencyKey
+        public, secret = self.test_subscription_new()
+        for _ in range(3):
+            data = {"message": _random_str(20), "secret": secret, "dedup_id": _random_str(16, False)}
+            _failing_loader(self.app.post('/message', data=data).data)
+
+        with self.app_real.app_context():
+            srv = Service.query.filter_by(secret=secret).first()
+            keys = IdempotencyKey.query.filter_by(service_id=srv.id)
+            assert keys.count() == 3
+            IdempotencyKey.evict(srv, 3600, 1)
+            assert keys.count() == 1
+            IdempotencyKey.evict(srv, -1, 10)
+            assert keys.count() == 0
+
+    def test_idempotency_key_expired(self):
+        from datetime import datetime, timedelta
+        from models import IdempotencyKey
+        from shared import db
+        public, secret = self.test_subscription_new()
+        data = {"message": _random_str(20), "secret": secret, "dedup_id": _random_str(16, False)}
+        _failing_loader(self.app.post('/message', data=data).data)
+        with self.app_real.app_context():
+            # older than idempotency_ttl, without an eviction having run since
+            IdempotencyKey.query.filter_by(digest=IdempotencyKey.digest_of(data['dedup_id'])) \
+                .update({IdempotencyKey.timestamp_created: datetime.utcnow() - timedelta(days=30)})
+            db.session.commit()
+        _failing_loader(self.app.post('/message', data=data).data)
+        _failing_loader(self.app.post('/message', data=data).data)
+
+        rv = self.app.get('/message?uuid={}'.format(self.uuid))
+        assert len(_failing_loader(rv.data)['messages']) == 2
+
     def test_message_send_no_subscribers(self):
         # We just want to know if the server "accepts" it
         public, secret, _ = self.test_service_create()
@@ -158,6 +241,482 @@ class PushFishTestCase(unittest.TestCase):
         resp = _failing_loader(rv.data)
         assert len(resp['messages']) is 0
 
+    def test_message_receive_compressed(self):
+        public, secret = self.test_subscription_new()
+        text = _random_str(2000)
+        _failing_loader(self.app.post('/message', data={'secret': secret, 'message': text}).data)
+
+        rv = self.app.get('/message?uuid={}'.format(self.uuid), headers={'Accept-Encoding': 'gzip, deflate'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        resp = _failing_loader(gzip.decompress(rv.data).decode('utf-8'))
+        assert resp['messages'][0]['message'] == text
+
+        # small responses are sent as they are
+        rv = self.app.get('/message?uuid={}'.format(self.uuid), headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in rv.headers
+        assert not _failing_loader(rv.data)['messages']
+
+    def test_message_receive_streamed(self):
+        public, secret = self.test_subscription_new()
+        texts = [_random_str(50) for _ in range(5)]
+        for text in texts:
+            _failing_loader(self.app.post('/message', data={'secret': secret, 'message': text}).data)
+
+        rv = self.app.get('/message?uuid={}'.format(self.uuid))
+        assert 'Content-Length' not in rv.headers
+        assert [m['message'] for m in _failing_loader(rv.data)['messages']] == texts
+
+        rv = self.app.get('/message?uuid={}'.format(self.uuid), headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Length' in rv.headers
+        assert not _failing_loader(rv.data)['messages']
+
+        _failing_loader(self.app.post('/message', data={'secret': secret, 'message': texts[0]}).data)
+        rv = self.app.get('/message?uuid={}'.format(self.uuid), headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert _failing_loader(gzip.decompress(rv.data).decode('utf-8'))['messages'][0]['message'] == texts[0]
+
+    def test_message_receive_msgpack(self):
+        from wire import msgpack
+        if msgpack is None:
+            _LOGGER.warning("msgpack is not installed, not testing message_receive_msgpack")
+            return
+        public, secret = self.test_subscription_new()
+        texts = [_random_str(50) for _ in range(3)]
+        for text in texts:
+            _failing_loader(self.app.post('/message', data={'secret': secret, 'message': text}).data)
+
+        accept = {'Accept': 'application/msgpack, application/json;q=0.5'}
+        rv = self.app.get('/message?uuid={}'.format(self.uuid), headers=accept)
+        assert rv.mimetype == 'application/msgpack'
+        # streamed like the JSON inbox
+        assert 'Content-Length' not in rv.headers
+        inbox = msgpack.unpackb(rv.data, raw=False)
+        assert [m['message'] for m in inbox['messages']] == texts
+        assert inbox['messages'][0]['service']['public'] == public
+
+        # the same document as in JSON, under its own tag
+        rv = self.app.get('/subscription?uuid={}'.format(self.uuid), headers=accept)
+        packed = msgpack.unpackb(rv.data, raw=False)
+        rv = self.app.get('/subscription?uuid={}'.format(self.uuid), headers={'Accept': '*/*'})
+        assert rv.mimetype == 'application/json'
+        assert _failing_loader(rv.data) == packed
+        rv = self.app.get('/subscription?uuid={}'.format(self.uuid), headers=dict(accept, **{
+            'If-None-Match': rv.headers['ETag']}))
+        assert rv.status_code == 200
+
+    def test_message_backlog_cap(self):
+        from housekeeping import housekeeper
+        public, secret = self.test_subscription_new()
+        rv = self.app.patch('/service', data={'secret': secret, 'backlog_max_messages': 'many'})
+        assert rv.status_code == 400
+        # the service can't lift or raise the operator's caps
+        cfg = Config.get_global_instance()
+        database, dispatch = dict(cfg._cfg['database']), dict(cfg._cfg['dispatch'])
+        cfg._cfg['database'].update(backlog_max_messages='5', backlog_max_age='3600')
+        cfg._cfg['dispatch']['coalesce_window'] = '10'
+        try:
+            for field, value in [('backlog_max_messages', '0'), ('backlog_max_messages', '6'),
+                                 ('backlog_max_age', '0'), ('backlog_max_age', '3601'), ('coalesce_window', '9')]:
+                rv = self.app.patch('/service', data={'secret': secret, field: value})
+                assert rv.status_code == 400
+            rv = self.app.patch('/service', data={'secret': secret, 'backlog_max_messages': '3'})
+            _failing_loader(rv.data)
+        finally:
+            cfg._cfg['database'].clear()
+            cfg._cfg['database'].update(database)
+            cfg._cfg['dispatch'].clear()
+            cfg._cfg['dispatch'].update(dispatch)
+        for _ in range(5):
+            self.test_message_send(public, secret)
+        housekeeper.app = self.app_real
+        assert housekeeper.run_once()[0] >= 1
+
+        rv = self.app.get('/message?uuid={}'.format(self.uuid))
+        resp = _failing_loader(rv.data)
+        assert len(resp['messages']) == 3
+        assert resp['dropped'] == {public: 2}
+
+        rv = self.app.get('/message?uuid={}'.format(self.uuid))
+        resp = _failing_loader(rv.data)
+        assert not resp['messages']
+        assert 'dropped' not in resp
+
+    def test_subscription_expiry(self):
+        from datetime import datetime, timedelta
+        from shared import db
+        from models import Subscription, Outbox
+        from housekeeping import housekeeper
+        public, secret = self.test_subscription_new()
+        with self.app_real.app_context():
+            Subscription.query.filter_by(device=self.uuid) \
+                .update({Subscription.timestamp_checked: datetime.utcnow() - timedelta(days=31)})
+            db.session.commit()
+
+        cfg = Config.get_global_instance()
+        days = cfg._cfg['database'].get('subscription_expiry_days', '0')
+        relay = cfg._cfg['dispatch'].get('zeromq_relay_uri', '')
+        cfg._cfg['database']['subscription_expiry_days'] = '30'
+        cfg._cfg['dispatch']['zeromq_relay_uri'] = 'tcp://127.0.0.1:5556'
+        # sends and polls leave expiry to the housekeeper
+        self.test_message_send(public, secret)
+        try:
+            housekeeper.app = self.app_real
+            assert housekeeper.run_once()[1] >= 1
+        finally:
+            cfg._cfg['database']['subscription_expiry_days'] = days
+            cfg._cfg['dispatch']['zeromq_relay_uri'] = relay
+
+        rv = self.app.get('/subscription?uuid={}'.format(self.uuid))
+        assert not _failing_loader(rv.data)['subscriptions']
+        with self.app_real.app_context():
+            # announced to the relay like an unsubscription
+            events = [json.loads(e.payload) for e in Outbox.query.all()]
+            assert any(e.get('subscription', {}).get('uuid') == self.uuid for e in events)
+
+    def _gcm_device(self, device, regid=None):
+        """ registers device with GCM through the model: /gcm only exists with a Google API key,
+        while the channel pushes into TESTING_GCM either way """
+        from models import Gcm
+        from shared import db
+        regid = regid or _random_str(40, False)
+        with self.app_real.app_context():
+            db.session.add(Gcm(device, regid))
+            db.session.commit()
+        return regid
+
+    def test_message_send_traced(self):
+        from tracing import tracer, TRACE_FORMAT_OTLP
+        public, secret = self.test_subscription_new()
+        # channels only show up in a trace when they have devices to push to
+        self._gcm_device(self.uuid)
+        path = os.path.join(tempfile.mkdtemp(), 'trace.jsonl')
+        rate, old_path, format_ = tracer.sample_rate, tracer.path, tracer.format
+        tracer.sample_rate, tracer.path = 1.0, path
+        try:
+            self.test_message_send(public, secret)
+            with open(path) as f:
+                spans = [json.loads(line) for line in f]
+            names = [s['name'] for s in spans]
+            for name in ['POST /message', 'has_secret', 'subscribers', 'insert', 'dispatch', 'gcm', 'cleanup']:
+                assert name in names
+            root = spans[0]
+            assert root['parent_id'] is None and root['attributes']['http.status_code'] == 200
+            by_id = {s['span_id']: s for s in spans}
+            assert by_id[spans[names.index('gcm')]['parent_id']]['name'] == 'dispatch'
+            statements = [s for s in spans if s['name'] == 'db']
+            assert statements and all(s['trace_id'] == root['trace_id'] for s in statements)
+
+            tracer.format = TRACE_FORMAT_OTLP
+            self.test_message_send(public, secret)
+            with open(path) as f:
+                export = json.loads(f.readlines()[-1])
+            otlp_spans = export['resourceSpans'][0]['scopeSpans'][0]['spans']
+            assert otlp_spans[0]['kind'] == 2 and otlp_spans[0]['name'] == 'POST /message'
+        finally:
+            tracer.sample_rate, tracer.path, tracer.format = rate, old_path, format_
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_message_scheduled(self):
+        import warnings
+        from time import time
+        from sqlalchemy.exc import SAWarning
+        from scheduler import scheduler
+        public, secret = self.test_subscription_new()
+        for args in ({'delay': 'soon'}, {'deliver_at': 'tomorrow'}):
+            args.update(secret=secret, message='nope')
+            assert self.app.post('/message', data=args).status_code == 400
+
+        _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'later', 'delay': 3600}).data)
+        _failing_loader(self.app.post('/message', data={
+            'secret': secret, 'message': 'much later', 'deliver_at': int(time()) + 7200}).data)
+        _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'now'}).data)
+
+        rv = self.app.get('/message?uuid={}'.format(self.uuid))
+        assert [m['message'] for m in _failing_loader(rv.data)['messages']] == ['now']
+
+        # due messages become regular messages, in the order they were due
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', SAWarning)
+            assert scheduler.run_once(time() + 3601) == 1
+            assert scheduler.run_once(time() + 7201) == 1
+        assert scheduler.run_once(time() + 7201) == 0
+        rv = self.app.get('/message?uuid={}'.format(self.uuid))
+        assert [m['message'] for m in _failing_loader(rv.data)['messages']] == ['later', 'much later']
+
+    def test_message_coalesced(self):
+        from time import monotonic
+        from dispatch import coalescer
+        public, secret = self.test_subscription_new()
+        self._gcm_device(self.uuid)
+        _failing_loader(self.app.patch('/service', data={'secret': secret, 'coalesce_window': '60'}).data)
+        del self.gcm[:]
+
+        texts = ['burst {}'.format(i) for i in range(5)]
+        for text in texts:
+            _failing_loader(self.app.post('/message', data={'secret': secret, 'message': text}).data)
+        # the first message of a burst goes out right away, the rest is held back
+        assert [p['data']['message']['message'] for p in self.gcm] == texts[:1]
+
+        assert coalescer.run_once(monotonic() + 61) == 1
+        push = self.gcm[-1]['data']
+        assert push['count'] == 4 and push['message']['message'] == texts[-1]
+        # the burst is over, its next window closes without a push
+        assert coalescer.run_once(monotonic() + 200) == 0
+        assert len(self.gcm) == 2
+
+        # pushed on its own once the window has closed, without marking the held back messages read
+        _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'later'}).data)
+        assert self.gcm[-1]['data']['message']['message'] == 'later'
+        rv = self.app.get('/message?uuid={}'.format(self.uuid))
+        assert [m['message'] for m in _failing_loader(rv.data)['messages']] == texts[1:] + ['later']
+
+    def test_message_throttled(self):
+        from models import Service
+        from throttle import throttle, THROTTLE_NONE, THROTTLE_QUEUE, THROTTLE_COALESCE, THROTTLE_REJECT
+        public, secret = self.test_subscription_new()
+        _failing_loader(self.app.patch('/service', data={'secret': secret, 'quota_messages': '2'}).data)
+        # the throttled service can't lift its quota
+        rv = self.app.patch('/service', data={'secret': secret, 'quota_messages': '0'})
+        assert rv.status_code == 400
+        cfg = Config.get_global_instance()
+        quota = cfg._cfg['dispatch'].get('quota_messages', '0')
+        cfg._cfg['dispatch']['quota_messages'] = '10'
+        try:
+            rv = self.app.patch('/service', data={'secret': secret, 'quota_messages': '11'})
+            assert rv.status_code == 400
+        finally:
+            cfg._cfg['dispatch']['quota_messages'] = quota
+
+        with self.app_real.app_context():
+            service = Service.query.filter_by(public=public).first()
+            stages = [throttle.admit(service, 1) for _ in range(5)]
+        assert stages == [THROTTLE_NONE, THROTTLE_NONE, THROTTLE_QUEUE, THROTTLE_COALESCE, THROTTLE_REJECT]
+
+        rv = self.app.post('/message', data={'secret': secret, 'message': 'too much'})
+        assert rv.status_code == 429
+
+        senders = _failing_loader(self.app.get('/stats/senders?limit=100&secret={}'.format(self.stats_secret)).data)['senders']
+        sender = next(s for s in senders if s['service'] == public)
+        assert sender == {'service': public, 'messages': 4, 'notifications': 4, 'throttle': 'reject'}
+
+    def test_message_throttled_after_validation(self):
+        from models import Service
+        from throttle import throttle
+        public, secret = self.test_subscription_new()
+        _failing_loader(self.app.patch('/service', data={'secret': secret, 'quota_messages': '1'}).data)
+        for _ in range(3):
+            rv = self.app.post('/message', data={'secret': secret, 'message': 'x', 'delay': 'soon'})
+            assert rv.status_code == 400
+        with self.app_real.app_context():
+            service = Service.query.filter_by(public=public).first()
+            throttle.admit(service, 1)
+            throttle.refund(service, 1)
+
+        # neither the rejected requests nor the refunded duplicate used up the quota
+        _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'counted'}).data)
+        senders = _failing_loader(self.app.get('/stats/senders?limit=100&secret={}'.format(self.stats_secret)).data)['senders']
+        sender = next(s for s in senders if s['service'] == public)
+        assert sender == {'service': public, 'messages': 1, 'notifications': 1, 'throttle': 'none'}
+
+    def test_message_tagged(self):
+        public, secret, _ = self.test_service_create()
+        team_a, team_b, untagged = str(uuid4()), str(uuid4()), str(uuid4())
+        for device, tags in [(team_a, 'team-a, ops'), (team_b, 'team_b'), (untagged, '')]:
+            _failing_loader(self.app.post('/subscription', data={'uuid': device, 'service': public,
+                                                                 'tags': tags}).data)
+        regid = self._gcm_device(team_a)
+        rv = self.app.get('/subscription?uuid={}'.format(team_a))
+        assert _failing_loader(rv.data)['subscriptions'][0]['tags'] == ['ops', 'team-a']
+        del self.gcm[:]
+
+        _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'for b',
+                                                        'tags': 'team_b,nobody'}).data)
+        assert not self.gcm
+        # the _ of team_b doesn't match any character
+        _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'for a',
+                                                        'tags': 'teamxb,team-a'}).data)
+        assert [p['registration_ids'] for p in self.gcm] == [[regid]]
+        _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'for all'}).data)
+
+        assert _failing_loader(self.app.get('/message/unread?uuid={}'.format(team_b)).data)['unread'] == 2
+        assert _failing_loader(self.app.get('/message/unread?uuid={}'.format(untagged)).data)['unread'] == 1
+        inboxes = {}
+        for device in [team_a, team_b, untagged]:
+            rv = self.app.get('/message?uuid={}'.format(device))
+            inboxes[device] = [m['message'] for m in _failing_loader(rv.data)['messages']]
+        assert inboxes == {team_a: [], team_b: ['for b', 'for all'], untagged: ['for all']}
+
+        rv = self.app.post('/message', data={'secret': secret, 'message': 'x', 'tags': 'x' * 65})
+        assert rv.status_code == 400
+
+    def test_message_tagged_mark_read(self):
+        from models import Service, Subscription, Message
+        from shared import db
+        public, secret, _ = self.test_service_create()
+        for device, tags in [(self.uuid, 'team-a'), (str(uuid4()), 'team-b')]:
+            _failing_loader(self.app.post('/subscription', data={'uuid': device, 'service': public,
+                                                                 'tags': tags}).data)
+        for message, tags in [('first', ''), ('for b', 'team-b'), ('for a', 'team-a')]:
+            _failing_loader(self.app.post('/message', data={'secret': secret, 'message': message,
+                                                            'tags': tags}).data)
+        with self.app_real.app_context():
+            service = Service.query.filter_by(public=public).one()
+            first = Message.query.filter_by(service_id=service.id).order_by(Message.id).first().id
+            # e.g. a retried push of the first message, after the others were sent
+            Subscription.mark_read(service, [self.uuid], first)
+            db.session.commit()
+            assert Subscription.query.filter_by(device=self.uuid).one().unread == 1
+
+    def test_message_tagged_backlog_cap(self):
+        from housekeeping import housekeeper
+        public, secret, _ = self.test_service_create()
+        team_a = str(uuid4())
+        for device, tags in [(self.uuid, ''), (team_a, 'team-a')]:
+            _failing_loader(self.app.post('/subscription', data={'uuid': device, 'service': public,
+                                                                 'tags': tags}).data)
+        _failing_loader(self.app.patch('/service', data={'secret': secret, 'backlog_max_messages': '3'}).data)
+        # over the cap only because of messages the untagged device never sees
+        for message, tags in [('for a', 'team-a')] * 3 + [('for all', '')] * 2:
+            _failing_loader(self.app.post('/message', data={'secret': secret, 'message': message,
+                                                            'tags': tags}).data)
+        housekeeper.app = self.app_real
+        assert housekeeper.run_once()[0] >= 1
+
+        assert _failing_loader(self.app.get('/message/unread?uuid={}'.format(self.uuid)).data)['unread'] == 2
+        resp = _failing_loader(self.app.get('/message?uuid={}'.format(self.uuid)).data)
+        assert [m['message'] for m in resp['messages']] == ['for all', 'for all']
+        assert 'dropped' not in resp
+        resp = _failing_loader(self.app.get('/message?uuid={}'.format(team_a)).data)
+        assert [m['message'] for m in resp['messages']] == ['for a', 'for all', 'for all']
+        assert resp['dropped'] == {public: 2}
+
+    def test_mqtt_service_mode(self):
+        from channels import MqttChannel, registry
+        from shared import db
+        published = []
+
+        class _Mqtt(MqttChannel):
+            def deliver(self, batch, data):
+                published.append(batch.addresses)
+                return True
+
+        public, secret, _ = self.test_service_create()
+        cfg = Config.get_global_instance()
+        dispatch = dict(cfg._cfg['dispatch'])
+        cfg._cfg['dispatch'].update(mqtt_broker_address='127.0.0.1', mqtt_delivery_mode='service')
+        channel = registry.get('mqtt')
+        registry.register(_Mqtt())
+        try:
+            rv = self.app.post('/subscription', data={'uuid': self.uuid, 'service': public})
+            assert _failing_loader(rv.data)['topic'] == 'service/{}'.format(public)
+            with self.app_real.app_context():
+                registry.get('mqtt').register(self.uuid)
+                db.session.commit()
+            _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'fanned out'}).data)
+            assert published == [['service/{}'.format(public)]]
+        finally:
+            registry.register(channel)
+            cfg._cfg['dispatch'].clear()
+            cfg._cfg['dispatch'].update(dispatch)
+
+        # the broker can't tell whether the device was on the topic yet
+        rv = self.app.get('/message?uuid={}'.format(self.uuid))
+        assert [m['message'] for m in _failing_loader(rv.data)['messages']] == ['fanned out']
+
+    def test_message_tagged_mqtt_service_mode(self):
+        from channels import MqttChannel, registry
+        from models import MQTT, Message, Service
+        from models.tag import join_tags
+        from shared import db
+        published = []
+
+        class _Mqtt(MqttChannel):
+            def enabled(self):
+                return True
+
+            def deliver(self, batch, data):
+                published.append(sorted(batch.addresses))
+                return True
+
+        public, secret, _ = self.test_service_create()
+        tagged, untagged = str(uuid4()), str(uuid4())
+        for device, tags in [(tagged, 'team-a'), (untagged, '')]:
+            _failing_loader(self.app.post('/subscription', data={'uuid': device, 'service': public,
+                                                                 'tags': tags}).data)
+        cfg = Config.get_global_instance()
+        mode = cfg._cfg['dispatch'].get('mqtt_delivery_mode', 'device')
+        cfg._cfg['dispatch']['mqtt_delivery_mode'] = 'service'
+        channel = registry.get('mqtt')
+        registry.register(_Mqtt())
+        try:
+            with self.app_real.app_context():
+                for device in [tagged, untagged]:
+                    registry.get('mqtt').register(device)
+                    assert MQTT.topics_for(device) == [device, 'service/{}'.format(public)]
+                db.session.commit()
+            _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'for a',
+                                                            'tags': 'team-a'}).data)
+            _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'for all'}).data)
+            assert published == [[tagged], ['service/{}'.format(public)]]
+
+            # a retry of the tagged message stays off the service topic as well
+            with self.app_real.app_context():
+                service = Service.query.filter_by(public=public).one()
+                message = Message(service, 'for a', tags=join_tags(['team-a']))
+                assert registry.get('mqtt').prepare(message, [tagged]).addresses == [tagged]
+        finally:
+            registry.register(channel)
+            cfg._cfg['dispatch']['mqtt_delivery_mode'] = mode
+
+    def test_message_websocket(self):
+        from gateway import gateway, serve
+        if serve is None:
+            _LOGGER.warning("websockets is not installed, not testing message_websocket")
+            return
+        from websockets.sync.client import connect
+        from websockets.exceptions import InvalidStatus
+        assert gateway.start('127.0.0.1', 0)
+        try:
+            public, secret = self.test_subscription_new()
+            with self.assertRaises(InvalidStatus):
+                connect('ws://127.0.0.1:{}/?uuid=nope'.format(gateway.port)).close()
+
+            with connect('ws://127.0.0.1:{}/?uuid={}'.format(gateway.port, self.uuid)) as ws:
+                for _ in range(100):
+                    if gateway.connected([self.uuid]):
+                        break
+                    sleep(0.01)
+                _failing_loader(self.app.post('/message', data={'secret': secret, 'message': 'live'}).data)
+                push = json.loads(ws.recv(timeout=5))
+            assert push['message']['message'] == 'live'
+            assert push['message']['service']['public'] == public
+
+            # delivered over the socket means read
+            rv = self.app.get('/message?uuid={}'.format(self.uuid))
+            assert _failing_loader(rv.data)['messages'] == []
+        finally:
+            gateway.stop()
+
+    def test_message_text_packed(self):
+        from models import Message
+        cfg = Config.get_global_instance()
+        threshold = cfg._cfg['database'].get('text_compression_threshold', '0')
+        cfg._cfg['database']['text_compression_threshold'] = '256'
+        try:
+            public, secret = self.test_subscription_new()
+            text = 'all work and no play makes jack a dull boy ' * 50
+            _failing_loader(self.app.post('/message', data={'secret': secret, 'message': text}).data)
+        finally:
+            cfg._cfg['database']['text_compression_threshold'] = threshold
+
+        with self.app_real.app_context():
+            msg = Message.query.order_by(Message.id.desc()).first()
+            assert msg._text == ''
+            assert len(msg.text_packed) < len(text)
+
+        rv = self.app.get('/message?uuid={}'.format(self.uuid))
+        assert _failing_loader(rv.data)['messages'][0]['message'] == text
+
     def test_message_receive_no_subs(self):
         self.test_message_send()
         rv = self.app.get('/message?uuid={}'.format(uuid4()))
@@ -190,6 +749,47 @@ class PushFishTestCase(unittest.TestCase):
         resp = _failing_loader(rv.data)
         assert not resp['messages']
 
+    def test_message_unread(self):
+        public, secret = self.test_subscription_new()
+        for _ in range(3):
+            self.test_message_send(public, secret)
+
+        rv = self.app.get('/message/unread?uuid={}'.format(self.uuid))
+        resp = _failing_loader(rv.data)
+        assert resp['unread'] == 3
+        assert resp['services'] == {public: 3}
+
+        # the inbox is streamed, messages are marked read once it was sent
+        self.app.get('/message?uuid={}'.format(self.uuid)).get_data()
+        rv = self.app.get('/message/unread?uuid={}'.format(self.uuid))
+        resp = _failing_loader(rv.data)
+        assert resp['unread'] == 0
+
+        self.test_message_send(public, secret)
+        self.app.delete('/message?uuid={}'.format(self.uuid))
+        rv = self.app.get('/message/unread?uuid={}'.format(self.uuid))
+        assert _failing_loader(rv.data)['unread'] == 0
+
+    def test_message_etag(self):
+        public, secret = self.test_subscription_new()
+        url = '/message?uuid={}'.format(self.uuid)
+        rv = self.app.get(url)
+        etag = rv.headers['ETag']
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+
+        self.test_message_send(public, secret)
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert len(_failing_loader(rv.data)['messages']) == 1
+
+        # the tag of a non-empty inbox never matches again once it is read
+        rv = self.app.get(url, headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 200
+        assert not _failing_loader(rv.data)['messages']
+        rv = self.app.get(url, headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
+
     def test_message_mark_read_multi(self):
         # Stress test it a bit
         for _ in range(3):
@@ -199,6 +799,25 @@ class PushFishTestCase(unittest.TestCase):
 
         self.test_message_mark_read()
 
+    def test_message_mark_read_stale(self):
+        from controllers.message import _mark_read
+        from models import Service, Subscription, Message
+        from shared import db
+        public, secret = self.test_subscription_new()
+        for _ in range(2):
+            self.test_message_send(public, secret)
+        with self.app_real.app_context():
+            service = Service.query.filter_by(public=public).one()
+            first = Message.query.filter_by(service_id=service.id).order_by(Message.id).first().id
+            subscription = Subscription.query.filter_by(device=self.uuid)
+            _mark_read(self.uuid, [], first)
+            db.session.commit()
+            assert (subscription.one().last_read, subscription.one().unread) == (first, 1)
+            # an inbox read off a lagging replica that hasn't got either message yet
+            _mark_read(self.uuid, [], 0)
+            db.session.commit()
+            assert (subscription.one().last_read, subscription.one().unread) == (first, 1)
+
     def test_service_delete(self):
         public, secret = self.test_subscription_new()
         # Send a couple of messages, these should be deleted
@@ -222,6 +841,374 @@ class PushFishTestCase(unittest.TestCase):
         resp = _failing_loader(rv.data)
         assert not resp["messages"]
 
+    def test_service_delete_purged(self):
+        from models import Service, Subscription, SubscriptionTag, Message
+        from purge import purger
+        public, secret, _ = self.test_service_create()
+        for _ in range(5):
+            _failing_loader(self.app.post('/subscription', data={'uuid': str(uuid4()), 'service': public,
+                                                                 'tags': 'a'}).data)
+        for _ in range(5):
+            self.test_message_send(public, secret)
+        with self.app_real.app_context():
+            service_id = Service.query.filter_by(public=public).first().id
+
+        batch_size, purged = purger.batch_size, purger.purged
+        purger.batch_size = 2
+        try:
+            _failing_loader(self.app.delete('/service?secret={}'.format(secret)).data)
+            # marked deleted, so gone for every lookup before it is purged
+            assert self.app.delete('/service?secret={}'.format(secret)).status_code == 404
+            for _ in range(500):
+                with self.app_real.app_context():
+                    if Service.query.get(service_id) is None:
+                        break
+                sleep(0.01)
+        finally:
+            purger.batch_size = batch_size
+
+        with self.app_real.app_context():
+            assert Service.query.get(service_id) is None
+            assert Subscription.query.filter_by(service_id=service_id).count() == 0
+            assert SubscriptionTag.query.filter_by(service_id=service_id).count() == 0
+            assert Message.query.filter_by(service_id=service_id).count() == 0
+        assert purger.purged == purged + 1
+        assert _failing_loader(self.app.get('/stats/purge?secret={}'.format(self.stats_secret)).data)['purging'] == []
+
+    def test_relay_pump(self):
+        import zmq
+        from relay import RelayPump
+        from wire import FORMAT_MSGPACK, decode, payload_format
+        from utils import queue_zmq_message
+        from models import Outbox, RelayCheckpoint
+        from shared import db
+
+        context = zmq.Context.instance()
+        pull = context.socket(zmq.PULL)
+        port = pull.bind_to_random_port('tcp://127.0.0.1')
+        push = context.socket(zmq.PUSH)
+        push.connect('tcp://127.0.0.1:{}'.format(port))
+
+        payloads = [json.dumps({'test': _random_str(10)}) for _ in range(3)]
+        with self.app_real.app_context():
+            Outbox.query.delete()
+            RelayCheckpoint.query.delete()
+            for payload in payloads:
+                queue_zmq_message(payload)
+            db.session.commit()
+
+            pump = RelayPump(self.app_real, push, batch_size=2)
+            other = RelayPump(self.app_real, push)
+            assert pump.pump_once() == 2
+            # the lease keeps a second worker from relaying the same rows
+            assert other.pump_once() == 0
+            assert pump.pump_once() == 1
+            assert pump.pump_once() == 0
+            assert RelayCheckpoint.query.get('zmq').relayed == 3
+
+        assert [pull.recv_string() for _ in payloads] == payloads
+
+        with self.app_real.app_context():
+            queue_zmq_message(payloads[0])
+            db.session.commit()
+            # the pump holding the lease, now encoding MessagePack, or still JSON without msgpack
+            pump.format = payload_format(FORMAT_MSGPACK)
+            assert pump.pump_once() == 1
+        assert decode(pull.recv(), pump.format) == json.loads(payloads[0])
+        push.close()
+        pull.close()
+
+    def test_channel_registry(self):
+        from threading import Event
+        from channels import Channel, Batch, registry, deliver_batches
+        delivered = []
+        released = Event()
+
+        class _Channel(Channel):
+            def __init__(self, name, timeout, stuck=False):
+                self.name, self.timeout, self.stuck = name, timeout, stuck
+                self.concurrency = 1
+
+            def prepare(self, message, devices):
+                return Batch(devices, devices)
+
+            def deliver(self, batch, data):
+                if self.stuck:
+                    released.wait(10)
+                delivered.append(self.name)
+                return True
+
+            def report(self, message, batch, result):
+                return batch.devices if result else []
+
+        public, secret = self.test_subscription_new()
+        channels = [_Channel('slow-a', 5), _Channel('slow-b', 5), _Channel('stuck', 0.1, stuck=True)]
+        batches = [(c, Batch([self.uuid], [self.uuid])) for c in channels]
+        for channel in channels:
+            registry.register(channel)
+        try:
+            with self.app_real.app_context():
+                outcomes = deliver_batches(batches, {})
+                # the stuck channel is given up on, and holds on to its only thread
+                assert [(o.timed_out, o.error) for o in outcomes] == [(False, None), (False, None),
+                                                                      (True, 'Timeout')]
+                outcomes = deliver_batches(batches, {})
+                assert [(o.timed_out, o.error) for o in outcomes] == [(False, None), (False, None),
+                                                                      (False, 'Busy')]
+
+            del delivered[:]
+            self.test_message_send(public, secret)
+            assert sorted(delivered) == ['slow-a', 'slow-b']
+            rv = self.app.get('/message/unread?uuid={}'.format(self.uuid))
+            assert _failing_loader(rv.data)['unread'] == 0
+        finally:
+            released.set()
+            for channel in channels:
+                registry.unregister(channel.name)
+
+    def _flaky_channel(self):
+        from channels import Channel, Batch
+
+        class _Flaky(Channel):
+            name = 'flaky'
+            up = False
+
+            def prepare(self, message, devices):
+                return Batch(devices, devices)
+
+            def deliver(self, batch, data):
+                if not self.up:
+                    raise ConnectionError("provider is down")
+                return True
+
+            def report(self, message, batch, result):
+                return batch.devices if result else []
+
+        return _Flaky()
+
+    def _letters(self, public):
+        from models import Service, DeadLetter
+        return DeadLetter.query.filter_by(service_id=Service.query.filter_by(public=public).one().id)
+
+    def test_dead_letter_retry(self):
+        from datetime import datetime, timedelta
+        from channels import registry
+        from retry import retry_worker
+        public, secret = self.test_subscription_new()
+        channel = self._flaky_channel()
+        registry.register(channel)
+        try:
+            self.test_message_send(public, secret)
+            with self.app_real.app_context():
+                letter = self._letters(public).one()
+                assert letter.channel == 'flaky' and letter.error == 'ConnectionError'
+                assert letter.device_list == [self.uuid] and letter.attempts == 0
+                assert letter.next_retry > datetime.utcnow()
+
+            retry_worker.app = self.app_real
+            later = datetime.utcnow() + timedelta(days=1)
+            # still down: the next retry backs off further
+            assert retry_worker.run_once(later) >= 1
+            with self.app_real.app_context():
+                letter = self._letters(public).one()
+                assert letter.attempts == 1
+                assert letter.next_retry == later + timedelta(seconds=retry_worker.backoff * 2)
+
+            channel.up = True
+            assert retry_worker.run_once(later + timedelta(days=1)) >= 1
+            with self.app_real.app_context():
+                assert self._letters(public).count() == 0
+        finally:
+            registry.unregister(channel.name)
+
+    def test_dead_letter_replay(self):
+        from datetime import datetime
+        from channels import registry
+        from retry import retry_worker
+        from models import DeadLetter
+        from shared import db
+        public, secret = self.test_subscription_new()
+        channel = self._flaky_channel()
+        registry.register(channel)
+        try:
+            self.test_message_send(public, secret)
+            with self.app_real.app_context():
+                # used up its attempts
+                self._letters(public).update({DeadLetter.attempts: retry_worker.max_attempts,
+                                              DeadLetter.next_retry: None}, synchronize_session=False)
+                db.session.commit()
+            rv = self.app.get('/stats/retries?secret={}'.format(self.stats_secret))
+            assert json.loads(rv.data)['parked'] >= 1
+
+            rv = self.app.post('/service/replay', data={'service': public, 'secret': secret,
+                                                        'until': '1'})
+            assert json.loads(rv.data)['replayed'] == 0
+            rv = self.app.post('/service/replay', data={'service': public, 'secret': secret, 'since': 'soon'})
+            assert rv.status_code == 400 and json.loads(rv.data)['error']['id'] == 12
+            rv = self.app.post('/service/replay', data={'service': public, 'secret': secret})
+            assert json.loads(rv.data)['replayed'] == 1
+
+            channel.up = True
+            retry_worker.app = self.app_real
+            assert retry_worker.run_once(datetime.utcnow()) >= 1
+            rv = self.app.get('/message/unread?uuid={}'.format(self.uuid))
+            assert _failing_loader(rv.data)['unread'] == 0
+        finally:
+            registry.unregister(channel.name)
+
+    def test_dispatch_priority(self):
+        from dispatch import Dispatcher
+        dispatcher = Dispatcher()
+        for i in range(20):
+            dispatcher._enqueue(('bulk', i), 1)
+        dispatcher._next()
+        dispatcher._enqueue(('urgent', 0), 5)
+        # the urgent message overtakes the bulk backlog
+        assert dispatcher._next() == ('urgent', 0)
+
+        for i in range(100):
+            dispatcher._enqueue(('urgent', i), 5)
+        served = [dispatcher._next()[0] for _ in range(34)]
+        # but bulk still gets its weighted share while urgent traffic keeps coming
+        assert served.count('bulk') == 2
+        stats = dispatcher.stats()
+        assert stats['1']['dispatched'] == 3
+        assert stats['5']['dispatched'] == 33
+        assert dispatcher.backlog() == 20 - 3 + 101 - 33
+
+    def test_dispatch_stats(self):
+        self.test_message_send()
+        rv = self.app.get('/stats/dispatch?secret={}'.format(self.stats_secret))
+        levels = _failing_loader(rv.data)['levels']
+        assert sorted(levels.keys()) == ['1', '2', '3', '4', '5']
+        assert sum(l['dispatched'] for l in levels.values()) > 0
+
+    def test_stats_operator_only(self):
+        cfg = Config.get_global_instance()
+        for path in ['/stats/dispatch', '/stats/senders', '/stats/purge', '/stats/retries']:
+            assert self.app.get(path).status_code == 403
+            assert self.app.get(path + '?secret=guess').status_code == 403
+        cfg._cfg['server']['stats_secret'] = ''
+        assert self.app.get('/stats/senders?secret=').status_code == 403
+
+    def test_replica_routing(self):
+        from routing import sticky_devices
+        from models import Subscription
+        cfg = Config.get_global_instance()
+        if not cfg.database_uri.startswith('sqlite:///'):
+            _LOGGER.warning("primary isn't SQLite, not testing replica routing")
+            return
+
+        public, secret = self.test_subscription_new()
+        self.test_message_send(public, secret)
+
+        # a copy of the primary stands in for a replica that stopped replicating
+        replica = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        shutil.copy(cfg.database_uri[len('sqlite:///'):], replica)
+        binds = self.app_real.config.get('SQLALCHEMY_BINDS')
+        self.app_real.config['SQLALCHEMY_BINDS'] = {'replica0': 'sqlite:///' + replica}
+        sticky_seconds = sticky_devices.seconds
+        sticky_devices.seconds = 0
+        try:
+            new_public, _, _ = self.test_service_create()
+            rv = self.app.get('/service?service={}'.format(new_public))
+            assert json.loads(rv.data)['error']['id'] == 6
+
+            # the inbox is read from the replica but marked read on the primary
+            rv = self.app.get('/message?uuid={}'.format(self.uuid))
+            assert len(_failing_loader(rv.data)['messages']) == 1
+            with self.app_real.app_context():
+                assert Subscription.query.filter_by(device=self.uuid).first().unread == 0
+
+            # a device reads its own writes
+            sticky_devices.seconds = 60
+            data = dict(uuid=self.uuid, service=new_public)
+            _failing_loader(self.app.post('/subscription', data=data).data)
+            rv = self.app.get('/subscription?uuid={}'.format(self.uuid))
+            assert len(_failing_loader(rv.data)['subscriptions']) == 2
+        finally:
+            sticky_devices.seconds = sticky_seconds
+            self.app_real.config['SQLALCHEMY_BINDS'] = binds
+
+    def test_sharding(self):
+        import database
+        import rebalance
+        from rebalance import move_service
+        from models import ShardDirectory
+        shard_db = os.path.join(tempfile.mkdtemp(), 'shard1.db')
+        binds = self.app_real.config.get('SQLALCHEMY_BINDS')
+        self.app_real.config['SQLALCHEMY_BINDS'] = {'shard1': 'sqlite:///' + shard_db}
+        try:
+            with self.app_real.app_context():
+                database.init_shards(self.app_real)
+
+            # one service on each shard
+            services, created = {}, 0
+            while len(services) < 2:
+                public, secret = self.test_subscription_new()
+                created += 1
+                with self.app_real.app_context():
+                    services.setdefault(ShardDirectory.shard_for(public), (public, secret))
+            for public, secret in services.values():
+                self.test_message_send(public, secret)
+
+            rv = self.app.get('/subscription?uuid={}'.format(self.uuid))
+            assert len(_failing_loader(rv.data)['subscriptions']) == created
+            rv = self.app.get('/message/unread?uuid={}'.format(self.uuid))
+            assert _failing_loader(rv.data)['unread'] == 2
+            rv = self.app.get('/message?uuid={}'.format(self.uuid))
+            assert len(_failing_loader(rv.data)['messages']) == 2
+
+            # move the shard 1 service to the main database, unread messages included
+            public, secret = services[1]
+            self.test_message_send(public, secret)
+            point_directory = rebalance._point_directory
+
+            def _sent_while_copying(*args):
+                # still routed to the source shard
+                self.test_message_send(public, secret)
+                point_directory(*args)
+            rebalance._point_directory = _sent_while_copying
+            try:
+                with self.app_real.app_context():
+                    assert move_service(public, 0) >= 2
+                    assert ShardDirectory.shard_for(public) == 0
+            finally:
+                rebalance._point_directory = point_directory
+            rv = self.app.get('/service?service={}'.format(public))
+            assert _failing_loader(rv.data)['service']['public'] == public
+            rv = self.app.get('/message?uuid={}'.format(self.uuid))
+            assert len(_failing_loader(rv.data)['messages']) == 2
+            self.test_message_send(public, secret)
+            rv = self.app.get('/message?uuid={}'.format(self.uuid))
+            assert len(_failing_loader(rv.data)['messages']) == 1
+        finally:
+            self.app_real.config['SQLALCHEMY_BINDS'] = binds
+
+    def test_dbtransfer(self):
+        from sqlalchemy import create_engine
+        from dbtransfer import TABLES, transfer_table
+        from shared import db
+        cfg = Config.get_global_instance()
+        self.test_message_send()
+
+        source = create_engine(cfg.database_uri)
+        target = create_engine('sqlite:///' + os.path.join(tempfile.mkdtemp(), 'target.db'))
+        # nothing is left behind
+        assert sorted(TABLES) == sorted(db.Model.metadata.tables)
+        tables = [db.Model.metadata.tables[name] for name in TABLES]
+        db.Model.metadata.create_all(bind=target, tables=tables)
+        for table in tables:
+            key, = table.primary_key.columns
+            count = source.execute(table.count()).scalar()
+            rows, _ = transfer_table(source, target, table, 7)
+            assert rows == count
+            assert target.execute(table.count()).scalar() == count
+            assert list(target.execute(table.select().order_by(key))) == \
+                list(source.execute(table.select().order_by(key)))
+            # nothing left to do when resumed
+            assert transfer_table(source, target, table, 7)[0] == 0
+
     def test_service_info(self):
         public, _, name = self.test_service_create()
         rv = self.app.get('/service?service={}'.format(public))
@@ -231,6 +1218,17 @@ class PushFishTestCase(unittest.TestCase):
         assert srv['name'] == name
         assert srv['public'] == public
 
+    def test_service_info_etag(self):
+        public, secret, _ = self.test_service_create()
+        url = '/service?service={}'.format(public)
+        etag = self.app.get(url).headers['ETag']
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+
+        self.app.patch('/service?secret={}'.format(secret), data={'name': _random_str(10)})
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+
     def test_service_info_secret(self):
         public, secret, name = self.test_service_create()
         rv = self.app.get('/service?secret={}'.format(secret))
@@ -311,11 +1309,58 @@ class PushFishTestCase(unittest.TestCase):
         else:
             _LOGGER.warning("GCM is disabled, not testing gcm_send")
 
+    def test_gcm_send_prunes_dead(self):
+        if self.gcm_enable:
+            from models import Gcm
+            reg_id = self.test_gcm_register()
+            self.app_real.config['TESTING_GCM_RESPONSES'].append({'results': [{'error': 'NotRegistered'}]})
+            self.test_message_send()
+
+            with self.app_real.app_context():
+                assert Gcm.query.filter_by(gcmid=reg_id).first() is None
+            # an undelivered push doesn't mark the message read
+            rv = self.app.get('/message/unread?uuid={}'.format(self.uuid))
+            assert _failing_loader(rv.data)['unread'] == 1
+        else:
+            _LOGGER.warning("GCM is disabled, not testing gcm_send_prunes_dead")
+
+    def test_gcm_send_canonical_id(self):
+        if self.gcm_enable:
+            from models import Gcm
+            reg_id = self.test_gcm_register()
+            canonical = _random_str(40, unicode=False)
+            self.app_real.config['TESTING_GCM_RESPONSES'].append(
+                {'results': [{'message_id': '1', 'registration_id': canonical}]})
+            self.test_message_send()
+
+            with self.app_real.app_context():
+                assert Gcm.query.filter_by(gcmid=reg_id).first() is None
+                assert Gcm.query.filter_by(gcmid=canonical).first().uuid == self.uuid
+        else:
+            _LOGGER.warning("GCM is disabled, not testing gcm_send_canonical_id")
+
+    def test_gcm_send_retry(self):
+        from models import Gcm
+        ids = [_random_str(40, unicode=False) for _ in range(3)]
+        self.app_real.config['TESTING_GCM_RESPONSES'].extend([
+            {'results': [{'message_id': '1'}, {'error': 'Unavailable'}, {'error': 'InvalidRegistration'}]},
+            {'results': [{'message_id': '2'}]},
+        ])
+        with self.app_real.app_context():
+            delivered, dead, canonical = Gcm.gcm_send(ids, {}, backoff=0)
+        assert delivered == {ids[0], ids[1]}
+        assert dead == {ids[2]}
+        assert not canonical
+        assert self.gcm[-1]['registration_ids'] == [ids[1]]
+
     def test_mqtt_register(self):
         if self.mqtt_enable:
             data = {'uuid': self.uuid}
             rv = self.app.post('/mqtt', data=data).data
-            _failing_loader(rv)
+            topics = _failing_loader(rv)['topics']
+            cfg = Config.get_global_instance()
+            if cfg.mqtt_delivery_mode == 'device':
+                assert topics == [self.uuid]
         else:
             _LOGGER.warning("MQTT is disabled, not testing mqtt_register")
 
@@ -370,12 +1415,62 @@ class PushFishTestCase(unittest.TestCase):
         else:
             _LOGGER.warning("MQTT is disabled, not testing mqtt_send")
 
-    #    def test_get_version(self):
-    #        version = self.app.get('/version').data
-    #
-    #        assert len(version) is 7
-    #        with open('.git/refs/heads/master', 'r') as f:
-    #            assert f.read()[:7] == version
+    def test_get_version(self):
+        from health import resolve_version
+        commit = 'a8c99772b0e5d3f41c6e9d8b7a6f5e4d3c2b1a09'
+        root = tempfile.mkdtemp()
+        env = os.environ.get('PUSHFISH_VERSION')
+        os.environ['PUSHFISH_VERSION'] = '1.2.3'
+        try:
+            # outside of a checkout
+            assert resolve_version(root) == '1.2.3'
+            os.makedirs(os.path.join(root, '.git', 'refs', 'heads'))
+            with open(os.path.join(root, '.git', 'HEAD'), 'w') as f:
+                f.write('ref: refs/heads/master\n')
+            with open(os.path.join(root, '.git', 'packed-refs'), 'w') as f:
+                f.write('# pack-refs with: peeled\n{} refs/heads/master\n'.format(commit))
+            assert resolve_version(root) == commit[:7]
+            with open(os.path.join(root, '.git', 'refs', 'heads', 'master'), 'w') as f:
+                f.write('f' * 40 + '\n')
+            assert resolve_version(root) == 'f' * 7
+            # detached
+            with open(os.path.join(root, '.git', 'HEAD'), 'w') as f:
+                f.write(commit + '\n')
+            assert resolve_version(root) == commit[:7]
+        finally:
+            shutil.rmtree(root)
+            if env is None:
+                del os.environ['PUSHFISH_VERSION']
+            else:
+                os.environ['PUSHFISH_VERSION'] = env
+
+        rv = self.app.get('/version')
+        assert rv.status_code == 200 and rv.data
+
+    def test_get_health(self):
+        from health import monitor
+        rv = self.app.get('/healthz')
+        assert rv.status_code == 200
+        report = _failing_loader(rv.data)
+        assert report['database']['ok'] and report['database']['shards'][0]['shard'] == 0
+        assert report['dispatch']['backlog'] == 0
+
+        rv = self.app.get('/readyz')
+        assert rv.status_code == (200 if report['ready'] else 503)
+        # probes within the cache interval get the same report
+        assert monitor.report() is monitor.report()
+
+        # an unreachable broker is reported, but the instance stays ready
+        cfg = Config.get_global_instance()
+        address = cfg._cfg['dispatch'].get('mqtt_broker_address', '')
+        cfg._cfg['dispatch']['mqtt_broker_address'] = '127.0.0.1:1'
+        try:
+            with self.app_real.app_context():
+                ready, report = monitor.check()
+        finally:
+            cfg._cfg['dispatch']['mqtt_broker_address'] = address
+        assert report['mqtt'] == dict(report['mqtt'], enabled=True, ok=False)
+        assert ready and report['database']['ok']
 
     def test_get_static(self):
         files = ['robots.txt', 'favicon.ico']
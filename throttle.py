@@ -0,0 +1,109 @@
+""" per service accounting of sends against quotas, and the throttling of services that exceed them """
+import threading
+from time import monotonic
+
+THROTTLE_NONE = 0
+THROTTLE_QUEUE = 1
+THROTTLE_COALESCE = 2
+THROTTLE_REJECT = 3
+THROTTLE_NAMES = {THROTTLE_NONE: 'none', THROTTLE_QUEUE: 'queue',
+                  THROTTLE_COALESCE: 'coalesce', THROTTLE_REJECT: 'reject'}
+# share of its quota a service has used in the last minute from which each stage applies
+THROTTLE_STAGES = ((2.0, THROTTLE_REJECT), (1.5, THROTTLE_COALESCE), (1.0, THROTTLE_QUEUE))
+USAGE_SECONDS = 60
+MAX_TRACKED_SERVICES = 100000
+
+
+class _Usage:
+    """ messages and notifications of a service over the last minute, in one second buckets """
+    __slots__ = ('public', 'seconds', 'messages', 'notifications', 'stage')
+
+    def __init__(self, public):
+        self.public = public
+        self.seconds = [0] * USAGE_SECONDS
+        self.messages = [0] * USAGE_SECONDS
+        self.notifications = [0] * USAGE_SECONDS
+        self.stage = THROTTLE_NONE
+
+    def _slot(self, second):
+        slot = second % USAGE_SECONDS
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.messages[slot] = 0
+            self.notifications[slot] = 0
+        return slot
+
+    def add(self, now, messages, notifications):
+        slot = self._slot(int(now))
+        self.messages[slot] += messages
+        self.notifications[slot] += notifications
+
+    def per_minute(self, now):
+        oldest = int(now) - USAGE_SECONDS
+        live = [i for i, second in enumerate(self.seconds) if second > oldest]
+        return sum(self.messages[i] for i in live), sum(self.notifications[i] for i in live)
+
+
+class Throttle:
+    """
+    counts the messages and device notifications (subscribers reached) each
+    service sent over the last minute and degrades the services exceeding
+    their Service.quotas step by step: their deliveries are queued behind
+    everyone else's, then coalesced, then new messages are rejected with
+    Error.RATE_TOOFAST. Rejected messages are not counted, so a sender gets
+    through again as soon as its last minute drops back under the limit.
+
+    Accounting is per process, every API process enforces the full quota.
+    """
+
+    def __init__(self):
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    def admit(self, service, subscribers, now=None):
+        """ the throttling stage for a new message of service, counted unless it is rejected """
+        now = monotonic() if now is None else now
+        max_messages, max_notifications = service.quotas()
+        with self._lock:
+            usage = self._get(service)
+            messages, notifications = usage.per_minute(now)
+            load = max(self._share(messages + 1, max_messages),
+                       self._share(notifications + subscribers, max_notifications))
+            usage.stage = next((stage for share, stage in THROTTLE_STAGES if load > share), THROTTLE_NONE)
+            if usage.stage != THROTTLE_REJECT:
+                usage.add(now, 1, subscribers)
+            return usage.stage
+
+    def refund(self, service, subscribers, now=None):
+        """ takes back an admitted message that was not sent after all, e.g. a concurrent duplicate """
+        now = monotonic() if now is None else now
+        with self._lock:
+            # may land in a later bucket than the admit, the minute's totals come out the same
+            self._get(service).add(now, -1, -subscribers)
+
+    def top(self, limit=10, now=None):
+        """ the services with the most notifications over the last minute """
+        now = monotonic() if now is None else now
+        with self._lock:
+            rows = [(usage.public, usage.per_minute(now), usage.stage) for usage in self._usage.values()]
+        rows = [r for r in rows if r[1][0]]
+        rows.sort(key=lambda r: r[1][1], reverse=True)
+        return [{'service': public, 'messages': messages, 'notifications': notifications,
+                 'throttle': THROTTLE_NAMES[stage]}
+                for public, (messages, notifications), stage in rows[:limit]]
+
+    @staticmethod
+    def _share(used, quota):
+        return used / quota if quota else 0.0
+
+    def _get(self, service):
+        usage = self._usage.get(service.public)
+        if usage is None:
+            if len(self._usage) >= MAX_TRACKED_SERVICES:
+                now = monotonic()
+                self._usage = {k: u for k, u in self._usage.items() if u.per_minute(now)[0]}
+            usage = self._usage[service.public] = _Usage(service.public)
+        return usage
+
+
+throttle = Throttle()
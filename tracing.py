@@ -0,0 +1,211 @@
+""" lightweight request tracing: nested spans of sampled requests written to a JSON-lines file """
+import json
+import logging
+import os
+import random
+from contextlib import contextmanager
+from threading import Lock
+from time import time_ns
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+TRACE_FORMAT_JSON = 'json'
+TRACE_FORMAT_OTLP = 'otlp'
+SPAN_KIND_INTERNAL = 'internal'
+SPAN_KIND_SERVER = 'server'
+SPAN_KIND_CLIENT = 'client'
+_OTLP_KINDS = {SPAN_KIND_INTERNAL: 1, SPAN_KIND_SERVER: 2, SPAN_KIND_CLIENT: 3}
+STATEMENT_MAX_LENGTH = 500  # characters of SQL kept on a db span
+
+
+class Span:
+    __slots__ = ('span_id', 'parent_id', 'name', 'kind', 'start', 'end', 'attributes')
+
+    def __init__(self, parent_id, name, kind, attributes):
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time_ns()
+        self.end = None
+        self.attributes = attributes
+
+
+class _Trace:
+    __slots__ = ('trace_id', 'spans', 'stack')
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self.stack = []
+
+
+class Tracer:
+    """
+    samples requests at sample_rate and records a span for the request, for
+    every block run inside tracer.span() and for every DB statement it
+    executes. Spans of a sampled request are appended to the trace file
+    when the request is torn down, one span per line in the json format or
+    one OTLP/JSON export request per trace in the otlp format. Requests
+    that are not sampled only pay for a g lookup per span.
+
+    Deliveries handed to background dispatch workers run outside the
+    request and are not traced.
+    """
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.path = ''
+        self.format = TRACE_FORMAT_JSON
+        self._lock = Lock()
+
+    def init_app(self, app, sample_rate, path, format_=TRACE_FORMAT_JSON):
+        self.sample_rate = sample_rate
+        self.path = path
+        self.format = format_
+        if sample_rate and not path:
+            _LOGGER.warning("tracing disabled, please enter a trace file")
+        app.before_request(self._start_request)
+        app.after_request(self._record_status)
+        app.teardown_request(self._end_request)
+
+    @staticmethod
+    def _current():
+        return g.get('trace') if has_app_context() else None
+
+    def open(self, name, kind=SPAN_KIND_INTERNAL, **attributes):
+        """ starts a child of the innermost open span, returns None if the request is not sampled """
+        trace = self._current()
+        if trace is None:
+            return None
+        span = Span(trace.stack[-1].span_id if trace.stack else None, name, kind, attributes)
+        trace.spans.append(span)
+        trace.stack.append(span)
+        return span
+
+    def close(self, span):
+        trace = self._current()
+        if span is None or trace is None:
+            return
+        span.end = time_ns()
+        if trace.stack and trace.stack[-1] is span:
+            trace.stack.pop()
+
+    @contextmanager
+    def span(self, name, kind=SPAN_KIND_INTERNAL, **attributes):
+        span = self.open(name, kind, **attributes)
+        try:
+            yield span
+        finally:
+            self.close(span)
+
+    def _start_request(self):
+        if not self.sample_rate or not self.path or random.random() >= self.sample_rate:
+            return
+        g.trace = _Trace()
+        route = request.url_rule.rule if request.url_rule else request.path
+        self.open('{} {}'.format(request.method, route), SPAN_KIND_SERVER,
+                  **{'http.method': request.method, 'http.route': route})
+
+    def _record_status(self, response):
+        trace = self._current()
+        if trace is not None and trace.spans:
+            trace.spans[0].attributes['http.status_code'] = response.status_code
+        return response
+
+    def _end_request(self, exc=None):
+        trace = g.pop('trace', None)
+        if trace is None:
+            return
+        end = time_ns()
+        for span in trace.spans:
+            if span.end is None:
+                span.end = end
+        if exc is not None:
+            trace.spans[0].attributes['error'] = repr(exc)
+        self.export(trace)
+
+    def export(self, trace):
+        if self.format == TRACE_FORMAT_OTLP:
+            lines = [json.dumps(self._otlp(trace))]
+        else:
+            lines = [json.dumps(self._json(trace, span)) for span in trace.spans]
+        try:
+            with self._lock, open(self.path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+        except OSError as err:
+            _LOGGER.warning("failed to write trace: %s", err)
+
+    @staticmethod
+    def _json(trace, span):
+        return {
+            'trace_id': trace.trace_id,
+            'span_id': span.span_id,
+            'parent_id': span.parent_id,
+            'name': span.name,
+            'kind': span.kind,
+            'start': span.start,
+            'duration_ms': (span.end - span.start) / 1e6,
+            'attributes': span.attributes,
+        }
+
+    @staticmethod
+    def _otlp_value(value):
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            # 64 bit integers are strings in OTLP/JSON
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    @staticmethod
+    def _otlp_attributes(attributes):
+        return [{'key': k, 'value': Tracer._otlp_value(v)} for k, v in attributes.items()]
+
+    @staticmethod
+    def _otlp(trace):
+        """ an OTLP/JSON ExportTraceServiceRequest, as the OpenTelemetry collector file exporter writes it """
+        spans = [{
+            'traceId': trace.trace_id,
+            'spanId': span.span_id,
+            'parentSpanId': span.parent_id or '',
+            'name': span.name,
+            'kind': _OTLP_KINDS[span.kind],
+            'startTimeUnixNano': str(span.start),
+            'endTimeUnixNano': str(span.end),
+            'attributes': Tracer._otlp_attributes(span.attributes),
+        } for span in trace.spans]
+        return {'resourceSpans': [{
+            'resource': {'attributes': Tracer._otlp_attributes({'service.name': 'pushfish-api'})},
+            'scopeSpans': [{'scope': {'name': 'pushfish_API'}, 'spans': spans}],
+        }]}
+
+
+tracer = Tracer()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._trace_span = tracer.open('db', SPAN_KIND_CLIENT,
+                                          **{'db.system': conn.dialect.name,
+                                             'db.statement': statement[:STATEMENT_MAX_LENGTH]})
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        tracer.close(getattr(context, '_trace_span', None))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    if context is not None:
+        tracer.close(getattr(context, '_trace_span', None))
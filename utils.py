@@ -1,11 +1,15 @@
 from re import compile
 from json import dumps
 from functools import wraps
+from hashlib import sha1
 
-from flask import request, jsonify
+from flask import request, jsonify, g
+from werkzeug.http import quote_etag
 
-from models import Service
-from shared import zmq_relay_socket
+from models import Service, Outbox, ShardDirectory
+from shared import db
+from routing import use_shard
+from tracing import tracer
 
 uuid = compile(r'^[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}$')
 service = compile(r'^[a-zA-Z0-9]{4}-[a-zA-Z0-9]{6}-[a-zA-Z0-9]{12}-[a-zA-Z0-9]{5}-[a-zA-Z0-9]{9}$')
@@ -34,11 +38,16 @@ class Error:
     CONNECTION_CLOSING = _e.__func__('Connection closing', 9, 499)  # Client closed request
     NO_CHANGES = _e.__func__('No changes were made', 10, 400)  # Bad request
     NOT_SUBSCRIBED = _e.__func__('Not subscribed to that service', 11, 409)  # Conflict
+    FORBIDDEN = _e.__func__('Forbidden', 13, 403)  # Forbidden
 
     @staticmethod
     def ARGUMENT_MISSING(arg):
         return Error._e('Missing argument {}'.format(arg), 7, 400)  # Bad request
 
+    @staticmethod
+    def ARGUMENT_INVALID(arg):
+        return Error._e('Invalid argument {}'.format(arg), 12, 400)  # Bad request
+
 
 def has_uuid(f):
     @wraps(f)
@@ -48,6 +57,7 @@ def has_uuid(f):
             return Error.ARGUMENT_MISSING('uuid')
         if not is_uuid(client):
             return Error.INVALID_CLIENT
+        g.device = client
         return f(*args, client=client, **kwargs)
 
     return df
@@ -62,7 +72,8 @@ def has_service(f):
         if not is_service(service):
             return Error.INVALID_SERVICE
 
-        srv = Service.query.filter_by(public=service).first()
+        use_shard(ShardDirectory.shard_for(service))
+        srv = Service.active().filter_by(public=service).first()
         if not srv:
             return Error.SERVICE_NOTFOUND
         return f(*args, service=srv, **kwargs)
@@ -79,7 +90,9 @@ def has_secret(f):
         if not is_secret(secret):
             return Error.INVALID_SECRET
 
-        srv = Service.query.filter_by(secret=secret).first()
+        with tracer.span('has_secret'):
+            use_shard(ShardDirectory.shard_for(Service.public_for(secret)))
+            srv = Service.active().filter_by(secret=secret).first()
         if not srv:
             return Error.SERVICE_NOTFOUND
         return f(*args, service=srv, **kwargs)
@@ -87,5 +100,44 @@ def has_secret(f):
     return df
 
 
+def replica_reads(f):
+    """ lets the handler's queries be served by a read replica. Writes
+    still go to the primary, see routing.RoutingSession """
+    @wraps(f)
+    def df(*args, **kwargs):
+        g.replica_reads = True
+        return f(*args, **kwargs)
+
+    return df
+
+
+def make_etag(*markers):
+    """ strong ETag over cheap version markers (row ids, counters, update times) """
+    return sha1(repr(markers).encode('utf-8')).hexdigest()
+
+
+def _matching_etag(etag):
+    """ the tag from If-None-Match naming this version, in any content coding """
+    if request.if_none_match.star_tag:
+        return etag
+    for tag in request.if_none_match.as_set():
+        # compressed representations carry the coding as a suffix
+        if tag == etag or tag.startswith(etag + '-'):
+            return tag
+    return None
+
+
+def is_not_modified(etag):
+    """ whether the client's If-None-Match already names this version """
+    return _matching_etag(etag) is not None
+
+
+def not_modified(etag):
+    return '', 304, {'ETag': quote_etag(_matching_etag(etag) or etag)}
+
+
 def queue_zmq_message(message):
-    zmq_relay_socket.send_string(message)
+    """ adds a relay event to the outbox. It is only published once the
+    caller commits, together with the change it announces """
+    with tracer.span('zmq'):
+        db.session.add(Outbox(message))
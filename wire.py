@@ -0,0 +1,98 @@
+""" the wire formats of API responses and channel payloads, JSON and MessagePack
+
+Every payload is built from the as_dict of the models, which only hold
+strings, integers, booleans, None, lists and string keyed dicts, so both
+formats carry exactly the same documents: a client may switch formats
+without any change to how it reads the fields.
+"""
+import logging
+from json import dumps as json_encode, loads as json_decode
+
+from flask import Response, request
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_LOGGER = logging.getLogger(name="pushfish_API")
+
+FORMAT_JSON = 'json'
+FORMAT_MSGPACK = 'msgpack'
+MIMETYPES = {FORMAT_JSON: 'application/json', FORMAT_MSGPACK: 'application/msgpack'}
+# also sent by older MessagePack clients
+_MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+_warned = False
+
+
+def message_payload(message, count=1):
+    """ what the push channels send for a message, count being the number of messages it stands for """
+    data = dict(message=message.as_dict(), encrypted=False)
+    if count > 1:
+        data['count'] = count
+    return data
+
+
+def payload_format(name):
+    """ the configured format of a channel, JSON if it is unknown or MessagePack is not installed """
+    global _warned
+    if name == FORMAT_MSGPACK:
+        if msgpack is not None:
+            return FORMAT_MSGPACK
+        if not _warned:
+            _LOGGER.warning("msgpack is not installed, sending JSON instead")
+            _warned = True
+    return FORMAT_JSON
+
+
+def encode(data, format_=FORMAT_JSON):
+    """ data as a str in JSON, as bytes in MessagePack """
+    if format_ == FORMAT_MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    return json_encode(data)
+
+
+def decode(payload, format_=FORMAT_JSON):
+    if format_ == FORMAT_MSGPACK:
+        return msgpack.unpackb(payload, raw=False)
+    return json_decode(payload)
+
+
+def negotiate_format():
+    """ the format the request's Accept header prefers, JSON unless MessagePack ranks higher """
+    if msgpack is None:
+        return FORMAT_JSON
+    accepted = request.accept_mimetypes
+    msgpack_quality = max(accepted[m] for m in _MSGPACK_MIMETYPES)
+    # exact matches only: */* and missing headers keep getting JSON
+    json_quality = accepted['application/json'] if accepted else 1
+    return FORMAT_MSGPACK if msgpack_quality > json_quality else FORMAT_JSON
+
+
+def respond(data, format_=FORMAT_JSON):
+    """ a response holding data in format_ """
+    response = Response(encode(data, format_), mimetype=MIMETYPES[format_])
+    response.vary.add('Accept')
+    return response
+
+
+def pack_document(key, count, items, extra=None):
+    """
+    yields the MessagePack of {key: [*items], **extra} piece by piece, the
+    items being packed as they come, e.g. off a cursor. MessagePack needs
+    the length of an array up front, so count is taken beforehand: items
+    beyond it are left out, and missing ones go out as nil
+    """
+    packer = msgpack.Packer(use_bin_type=True)
+    extra = extra or {}
+    yield packer.pack_map_header(1 + len(extra)) + packer.pack(key) + packer.pack_array_header(count)
+    packed = 0
+    for item in items:
+        if packed == count:
+            break
+        yield packer.pack(item)
+        packed += 1
+    for _ in range(count - packed):
+        yield packer.pack(None)
+    for k, v in extra.items():
+        yield packer.pack(k) + packer.pack(v)